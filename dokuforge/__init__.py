@@ -9,11 +9,14 @@ except ImportError:
 from dokuforge.application import Application
 from dokuforge.paths import PathConfig
 
-def buildapp(pathconfig=PathConfig()):
+def buildapp(pathconfig=PathConfig(), app=None):
     """
     @type pathconfig: PathConfig
+    @param app: the application to serve, if already built from pathconfig
+    @type app: None or Application
     """
-    app = Application(pathconfig)
+    if app is None:
+        app = Application(pathconfig)
     app = SharedDataMiddleware(
         app, {"/%s" % pathconfig.staticservepath:
               os.path.join(os.path.dirname(__file__), "static")})
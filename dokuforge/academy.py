@@ -1,13 +1,13 @@
+from concurrent.futures import ProcessPoolExecutor
 import os
 import operator
-from datetime import datetime, timezone
 
 import werkzeug.exceptions
 
 from dokuforge.course import Course
 from dokuforge.storagedir import StorageDir
 import dokuforge.common as common
-from dokuforge.common import CheckError
+from dokuforge.common import CheckError, TarWriter
 try:
     from dokuforge.versioninfo import commitid
 except ImportError:
@@ -165,12 +165,79 @@ class Academy(StorageDir):
         functions.update(extrafunctions)
         return StorageDir.view(self, functions)
 
-    def texExportIterator(self, tarwriter, static=None):
+    def texExport(self, static=None, gzip=False, workers=0, cache=None,
+                  gziplevel=9, gzipthreads=0, tarwriter=None, courses=None):
+        """
+        yield the tex export of the academy as tar archive with all files
+        placed in the directory texexport_<academy name>.
+
+        @param static: directory whose contents are added to the export
+        @type static: None or bytes
+        @type gzip: bool
+        @param workers: number of worker processes used for parsing the
+            pages; with 0 everything is done within the calling process.
+            The produced archive does not depend on this number.
+        @type workers: int
+        @param cache: if given, courses are taken from and stored to it
+        @type cache: None or ExportCache
+        @param gziplevel: passed on to TarWriter
+        @type gziplevel: int
+        @param gzipthreads: passed on to TarWriter
+        @type gzipthreads: int
+        @param tarwriter: if given, the export is written to this TarWriter
+            instead of a new one and the gzip options are ignored
+        @type tarwriter: None or TarWriter
+        @param courses: passed on to texExportIterator
+        @type courses: None or [Course]
+        @rtype: iter(bytes)
+        """
+        if tarwriter is None:
+            tarwriter = TarWriter(gzip=gzip, gziplevel=gziplevel,
+                                  gzipthreads=gzipthreads)
+        tarwriter.pushd(b"texexport_" + self.name)
+        executor = None
+        if workers > 0:
+            executor = ProcessPoolExecutor(max_workers=workers)
+        try:
+            for chunk in self.texExportIterator(tarwriter, static=static,
+                                                executor=executor,
+                                                cache=cache, courses=courses):
+                yield chunk
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        tarwriter.popd()
+        yield tarwriter.close()
+
+    def texExportIterator(self, tarwriter, static=None, executor=None,
+                          cache=None, courses=None):
         """
         yield a tar archive containing the tex-export of the academy.
+
+        @param executor: if given, the pages of all courses are rendered
+            within this executor while the archive is assembled in order
+        @type executor: None or concurrent.futures.Executor
+        @param cache: if given, only the courses without an up to date
+            entry in the cache are generated
+        @type cache: None or ExportCache
+        @param courses: if given, only these courses are exported. Since the
+            files listing all courses would be incomplete, contents.tex and
+            fortschritt-courselist.txt are left out, so the result can be
+            unpacked over a full export.
+        @type courses: None or [Course]
         """
-        timeStampNow = datetime.now(timezone.utc)
-        timeStampNow.replace(tzinfo=timezone.utc)
+        partial = courses is not None
+        if not partial:
+            courses = self.listCourses()
+        pagetexs = dict()
+        if executor is not None:
+            for course in courses:
+                if cache is None or not cache.iscached(course):
+                    pagetexs[course.name] = course.submitTexExport(executor)
+        # Use a time stamp derived from the contents, so that exporting the
+        # same contents twice yields the same archive.
+        timeStamp = common.findlastchange([c.lastchange()
+                                           for c in courses])['date']
         yield tarwriter.addChunk(b"WARNING",
 (u"""The precise semantics of the exporter is still
 subject to discussion and may change in future versions.
@@ -179,20 +246,28 @@ same exporter semantics, keep the following version string
 for your reference
 
 %s
-""" % commitid).encode("ascii"),timeStampNow)
+""" % commitid).encode("ascii"),timeStamp)
         if static is not None:
             for chunk in tarwriter.addDirChunk(b"", static, excludes=[b".svn"]):
                 yield chunk
         contents = u""
         fortschrittCourselist = ""
-        for course in self.listCourses():
+        for course in courses:
             contents += u"\\input{%s/chap}\n" % course.name.decode("ascii")
             fortschrittCourselist += f"Kurs {course.number:02d}      {course.gettitle()}\n[ ] Redaktion: NN\n[ ] Bilder/Grafiken: NN\n\n"
-            for chunk in course.texExportIterator(tarwriter):
+            if cache is None:
+                chunks = course.texExportIterator(tarwriter,
+                                                  pagetexs.get(course.name))
+            else:
+                chunks = cache.texExportIterator(course, tarwriter,
+                                                 pagetexs.get(course.name))
+            for chunk in chunks:
                 yield chunk
+        if partial:
+            return
         yield tarwriter.addChunk(b"contents.tex",
                                  contents.encode("utf8"),
-                                 timeStampNow)
+                                 timeStamp)
         yield tarwriter.addChunk(b"fortschritt-courselist.txt",
                                  fortschrittCourselist.encode("utf8"),
-                                 timeStampNow)
+                                 timeStamp)
@@ -7,15 +7,12 @@ try:
 except ImportError:
     import configparser
     from configparser import ConfigParser
-import copy
 import datetime
+import hashlib
 from hashlib import md5 as getmd5
 import io
 import logging
-import operator
 import os
-import random
-import sqlite3
 import sys
 import time
 import urllib
@@ -30,141 +27,34 @@ except NameError:
 
 import jinja2
 import werkzeug.exceptions
+import werkzeug.http
 import werkzeug.routing
+import werkzeug.test
 import werkzeug.utils
+import werkzeug.wsgi
 from werkzeug.wrappers import Request, Response
-from wsgitools.digest import LazyDBAPI2Opener
 
 from dokuforge.academy import Academy
+from dokuforge.catalog import Catalog
 import dokuforge.common as common
 from dokuforge.common import CheckError
-from dokuforge.parser import dfLineGroupParser, Estimate
+from dokuforge.exportbuilder import ExportBuilder
+from dokuforge.exportcache import ExportCache, exporterversion
+from dokuforge.exportdelta import ManifestStore
+from dokuforge.fragmentcache import FragmentCache, directorystate, filestate
+from dokuforge.outlinecache import OutlineCache
+from dokuforge.parser import Estimate
+from dokuforge.session import SessionHandler, SignedSessionHandler, \
+    ThreadLocalDB, connectsessiondb
+from dokuforge.user import User
+from dokuforge.view import LazyView
 try:
     from dokuforge.versioninfo import commitid
 except ImportError:
     commitid = u"unknown"
 
-sysrand = random.SystemRandom()
-
 logger = logging.getLogger(__name__)
 
-def gensid(bits=64):
-    """
-    @type bits: int
-    @param bits: randomness in bits of the resulting string
-    @rtype: unicode
-    @returns: a random string
-    """
-    return u"%x" % sysrand.getrandbits(bits)
-
-class SessionHandler:
-    """Associate users with session ids in a DBAPI2 database. The database
-    may be optimized for performance -- that is we accept an unlikely loss
-    of the session database for performance reasons since the information
-    therein is ephemeral by nature and loss has little impact."""
-    create_table = "CREATE TABLE IF NOT EXISTS sessions " + \
-                   "(sid TEXT, user TEXT, updated INTEGER, UNIQUE(sid));"
-    cookie_name = "sid"
-    hit_interval = 60
-    expire_after = 60 * 60 * 24 * 7 # a week
-
-    def __init__(self, db):
-        """
-        @param db: a DBAPI2 database that has a sessions table as described
-                in the create_table class variable
-        """
-        self.db = db
-        self.lastexpire = 0
-
-    def get(self, request):
-        """Find a user session.
-        @type request: werkzeug.wrappers.Request
-        @rtype: (unicode or None, unicode or None)
-        @returns: a pair (sid, username). sid is None if the cookie is missing
-                and username is None if sid cannot be found in the database
-        """
-        now = time.time()
-        self.expire(now)
-
-        sid = request.cookies.get(self.cookie_name)
-
-        if sid is None:
-            logger.debug("SessionHandler.get: no cookie found")
-            return (None, None)
-        cur = self.db.cursor()
-        cur.execute("SELECT user, updated FROM sessions WHERE sid = ?;", (sid,))
-        results = cur.fetchall()
-        if len(results) != 1:
-            logger.debug("SessionHandler.get: cookie %r not found", sid)
-            self.db.commit()
-            cur.close()
-            return (sid, None)
-        username, updated = results[0]
-        assert isinstance(username, unicode)
-        if updated + self.hit_interval < now:
-            cur.execute("UPDATE sessions SET updated = ? WHERE sid = ?;",
-                             (now, sid))
-            self.db.commit()
-        logger.debug("SessionHandler.get: cookie %r matches user %r", sid,
-                username)
-        self.db.commit()
-        cur.close()
-        return (sid, username)
-
-    def set(self, response, username, sid=None):
-        """Initiate a user session.
-        @type response: werkzeug.wrappers.Response
-        @type username: unicode
-        @type sid: unicode or None
-        @rtype: unicode
-        @returns: sid
-        """
-        action = "reusing"
-        if sid is None:
-            sid = gensid()
-            response.set_cookie(self.cookie_name, sid)
-            action = "generating new"
-        logger.debug("SessionHandler.set: %s cookie %r for user %r", action,
-                    sid, username)
-        cur = self.db.cursor()
-        cur.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?);",
-                         (sid, username, time.time()))
-        self.db.commit()
-        cur.close()
-        return sid
-
-    def delete(self, response, sid):
-        """Delete a user session.
-        @type response: werkzeug.wrappers.Response
-        @type sid: str
-        """
-        if sid is not None:
-            logger.debug("SessionHandler.delete: deleting cookie %r", sid)
-            cur = self.db.cursor()
-            cur.execute("DELETE FROM sessions WHERE sid = ?;", (sid,))
-            self.db.commit()
-            cur.close()
-            response.delete_cookie(self.cookie_name)
-        else:
-            logger.debug("SessionHandler.delete: no cookie to delete")
-
-    def expire(self, now=None):
-        """Delete old cookies unless there was active expire call within the
-        last hit_interval seconds.
-        @type now: None or float
-        @param now: time.time() result if already present
-        """
-        if now is None:
-            now = time.time()
-        if self.lastexpire + self.hit_interval < now:
-            logger.debug("SessionHandler.expire: taking action")
-            cur = self.db.cursor()
-            cur.execute("DELETE FROM sessions WHERE updated < ?;",
-                             (now - self.expire_after,))
-            self.db.commit()
-            cur.close()
-            self.lastexpire = now
-
 class RequestState:
     """
     @type endpoint_args: {str: object}
@@ -172,17 +62,24 @@ class RequestState:
         werkzeug's url matcher
     """
     def __init__(self, request, sessionhandler, userdb, mapadapter):
+        """
+        @param sessionhandler: None for rendering outside of a request
+            without any session (the user has to be set by the caller)
+        """
         self.request = request
         self.response = Response()
         self.sessionhandler = sessionhandler
         self.userdb = userdb
-        self.sid, username = self.sessionhandler.get(request)
-        self.user = copy.deepcopy(self.userdb.db.get(username))
+        if sessionhandler is None:
+            self.sid, self.user = None, None
+        else:
+            self.sid, username = self.sessionhandler.get(request)
+            self.user = self.userdb.db.get(username)
         self.mapadapter = mapadapter
         self.endpoint_args = None # set later in Application.render
 
     def login(self, username):
-        self.user = copy.deepcopy(self.userdb.db[username])
+        self.user = self.userdb.db[username]
         self.sid = self.sessionhandler.set(self.response, self.user.name,
                 self.sid)
 
@@ -211,17 +108,52 @@ class Application:
         @type pathconfig: PathConfig
         """
         self.sessiondbpath = pathconfig.sessiondbpath
-        sessiondb = LazyDBAPI2Opener(self.connectdb)
-        self.sessionhandler = SessionHandler(sessiondb)
+        if pathconfig.sessionbackend == u"signed":
+            secret = pathconfig.sessionsecret
+            if secret is None:
+                ## restarting the application logs out all users
+                logger.warning("no sessionsecret configured, using a "
+                               "random one")
+                secret = os.urandom(32)
+            self.sessionhandler = SignedSessionHandler(
+                secret, pathconfig.sessionrevocationpath)
+        else:
+            sessiondb = ThreadLocalDB(self.sessiondbpath)
+            ## a database in memory is private to its connection
+            self.sessionhandler = SessionHandler(
+                sessiondb, connect=None if self.sessiondbpath == u":memory:"
+                else self.connectdb)
         self.userdb = pathconfig.loaduserdb()
         self.acapath = pathconfig.dfdir
+        self.catalog = Catalog(self.acapath, self.listGroups)
         self.templatepath = os.path.join(os.path.dirname(__file__), "templates")
+        bytecodecache = None
+        if pathconfig.templatecachedir is not None:
+            if not os.path.isdir(pathconfig.templatecachedir):
+                os.makedirs(pathconfig.templatecachedir)
+            bytecodecache = jinja2.FileSystemBytecodeCache(
+                os.fsdecode(pathconfig.templatecachedir))
         self.jinjaenv = jinja2.Environment(
-                loader=jinja2.FileSystemLoader(self.templatepath))
+                loader=jinja2.FileSystemLoader(self.templatepath),
+                bytecode_cache=bytecodecache,
+                auto_reload=pathconfig.templateautoreload)
+        if pathconfig.templateprecompile:
+            self.precompileTemplates()
         self.groupstore = pathconfig.groupstore
+        self.fragmentcache = FragmentCache(pathconfig.fragmentcachesize)
         self.staticservepath = pathconfig.staticservepath
         self.mathjaxuri = pathconfig.mathjaxuri
         self.staticexportdir = pathconfig.staticexportdir
+        self.exportworkers = pathconfig.exportworkers
+        self.exportcache = ExportCache(pathconfig.cachedir)
+        self.gzipoptions = dict(gziplevel=pathconfig.exportgziplevel,
+                                gzipthreads=pathconfig.exportgzipthreads)
+        self.manifeststore = ManifestStore(pathconfig.cachedir)
+        self.outlinecache = OutlineCache(pathconfig.cachedir)
+        self.exportbuilder = ExportBuilder(
+            self.acapath, pathconfig.cachedir, self.staticexportdir,
+            delay=pathconfig.exportrebuilddelay, workers=self.exportworkers,
+            **self.gzipoptions)
         rule = werkzeug.routing.Rule
         self.routingmap = werkzeug.routing.Map([
             rule("/", methods=("GET", "HEAD"), endpoint="start"),
@@ -285,6 +217,8 @@ class Application:
                  methods=("POST",), endpoint="relink"),
             rule("/docs/<identifier:academy>/<identifier:course>/!raw",
                  methods=("GET", "HEAD"), endpoint="raw"),
+            rule("/docs/<identifier:academy>/<identifier:course>/!export",
+                 methods=("GET", "HEAD"), endpoint="courseexport"),
             rule("/docs/<identifier:academy>/<identifier:course>/!title",
                  methods=("GET", "HEAD"), endpoint="coursetitle"),
             rule("/docs/<identifier:academy>/<identifier:course>/!title",
@@ -323,16 +257,75 @@ class Application:
                  methods=("POST",), endpoint="blobdelete"),
         ], converters=dict(identifier=IdentifierConverter))
 
+    def precompileTemplates(self):
+        """Load all templates. Processes forked afterwards start with the
+        compiled templates and the bytecode cache is filled for the others."""
+        names = self.jinjaenv.list_templates(extensions=["html"])
+        for name in names:
+            self.jinjaenv.get_template(name)
+        logger.debug("precompiled %d templates" % len(names))
+
+    def warmup(self, academies=None, pages=0, scriptname=u""):
+        """Fill the caches held in memory, so that processes forked
+        afterwards start with them. The groups, the templates and the
+        catalog entries of the given academies are loaded and the outlines
+        of their courses (as seen with and without write access) and the
+        first pages of each course are rendered.
+
+        @param academies: names of the academies to load or None for all
+        @type academies: None or [unicode]
+        @param pages: number of pages of each course to render
+        @type pages: int
+        @param scriptname: the SCRIPT_NAME the application is served under,
+            the fragments are cached per script root
+        @type scriptname: unicode
+        """
+        starttime = time.time()
+        self.listGroups()
+        self.precompileTemplates()
+        if academies is None:
+            academies = [aca.name.decode("utf8")
+                         for aca in self.listAcademies()]
+        ## the outline of a course is cached separately for users with and
+        ## without write access, the pages do not depend on the user
+        writer = User(u"warmup", u"", u"", {u"df_superadmin": True})
+        reader = User(u"warmup", u"", u"", {u"df_read": True})
+        rendered = 0
+        for aca in map(self.getAcademy, academies):
+            for c in self.catalog.listCourses(aca):
+                paths = [u"/docs/%s/%s/" % (aca.name.decode("utf8"),
+                                            c.name.decode("utf8"))]
+                paths.extend(u"%s%d/" % (paths[0], page)
+                             for page in c.listpages()[:pages])
+                for path in paths:
+                    builder = werkzeug.test.EnvironBuilder(
+                        path=path, base_url=u"http://localhost" + scriptname)
+                    request = Request(builder.get_environ())
+                    mapadapter = self.routingmap.bind_to_environ(
+                        request.environ)
+                    endpoint, endpoint_args = mapadapter.match()
+                    users = [writer, reader] if endpoint == "course" \
+                            else [writer]
+                    for user in users:
+                        ## without a session lookup, which would start the
+                        ## expirer thread of the session handler before the
+                        ## workers are forked
+                        rs = RequestState(request, None, self.userdb,
+                                          mapadapter)
+                        rs.user = user
+                        rs.endpoint_args = endpoint_args
+                        if endpoint == "course":
+                            self.render_course(rs, aca, c)
+                        else:
+                            self.render_show(rs, aca, c,
+                                             endpoint_args["page"])
+                        rendered += 1
+        logger.info("warmup of %d academies rendered %d views in %.1f s" %
+                    (len(academies), rendered, time.time() - starttime))
+
     def connectdb(self):
         """Connect to the session database and create missing tables."""
-        sessiondb = sqlite3.connect(self.sessiondbpath)
-        cur = sessiondb.cursor()
-        # Disable safety -- this increases performance (in a relevant way);
-        # if the sessiondb should be lost at some point it's not uber-tragic
-        cur.execute("PRAGMA synchronous = OFF;")
-        cur.execute(SessionHandler.create_table)
-        sessiondb.commit()
-        return sessiondb
+        return connectsessiondb(self.sessiondbpath)
 
     def buildurl(self, rs, endpoint, args):
         """Looks up up the given endpoint in the routingmap and builds the
@@ -403,7 +396,8 @@ class Application:
         except CheckError:
             raise werkzeug.exceptions.NotFound()
         aca = Academy(os.path.join(self.acapath, name), self.listGroups)
-        if user is not None and not user.allowedRead(aca):
+        if user is not None and \
+                not user.allowedRead(self.catalog.viewAcademy(aca)):
             raise werkzeug.exceptions.Forbidden()
         return aca
 
@@ -419,7 +413,9 @@ class Application:
         c = aca.getCourse(coursename) # checks name
         if c is None:
             raise werkzeug.exceptions.NotFound()
-        if user is not None and not user.allowedRead(aca, c):
+        if user is not None and \
+                not user.allowedRead(self.catalog.viewAcademy(aca),
+                                     self.catalog.viewCourse(c)):
             raise werkzeug.exceptions.Forbidden()
         return c
 
@@ -451,10 +447,7 @@ class Application:
         """
         @rtype: [Academy]
         """
-        ret = [self.getAcademy(p.decode("utf8"))
-               for p in os.listdir(self.acapath)]
-        ret.sort(key=operator.attrgetter('name'))
-        return ret
+        return self.catalog.listAcademies()
 
     def listGroups(self):
         """
@@ -480,9 +473,12 @@ class Application:
             endpoint, args = mapadapter.match()
             ## grab a copy of the parameters for url building
             rs.endpoint_args = args
-            return getattr(self, "do_%s" % endpoint)(rs, **args)
+            response = getattr(self, "do_%s" % endpoint)(rs, **args)
         except werkzeug.exceptions.HTTPException as e:
             return e
+        if request.method == "POST" and "academy" in args:
+            self.exportbuilder.schedule(args["academy"].encode("utf8"))
+        return response
 
     def check_login(self, rs):
         """
@@ -492,6 +488,41 @@ class Application:
         if rs.user is None:
             raise TemporaryRequestRedirect(rs.request.url_root)
 
+    def check_modified(self, rs, directories):
+        """
+        Tag the response with an ETag and a Last-Modified date derived from
+        the sizes and modification times of the rcs files in the given
+        directories, the user database, the groups, the name of the user and
+        the version of dokuforge. None of these requires running rcs, so a
+        client holding the current version is answered before anything is
+        checked out or rendered. Since the response depends on the user,
+        caches are asked to revalidate every time.
+
+        @type rs: RequestState
+        @param directories: the directories containing the rcs files the
+            response is generated from
+        @type directories: [bytes]
+        @returns: whether the response was turned into a 304
+        @rtype: bool
+        """
+        state, lastmodified = directorystate(directories)
+        lastmodified = max(lastmodified, self.userdb.timestamp,
+                           self.groupstore.timestamp())
+        digest = hashlib.sha1(exporterversion())
+        digest.update(b"\0" + rs.user.name.encode("utf8"))
+        digest.update(("\0%s\0%r" % (state, lastmodified)).encode("utf8"))
+        etag = digest.hexdigest()
+        lastmodified = lastmodified.replace(microsecond=0)
+        rs.response.set_etag(etag)
+        rs.response.last_modified = lastmodified
+        rs.response.headers['Cache-Control'] = "private, no-cache"
+        rs.response.vary.add("Cookie")
+        if werkzeug.http.is_resource_modified(rs.request.environ, etag=etag,
+                                              last_modified=lastmodified):
+            return False
+        rs.response.status_code = 304
+        return True
+
     def do_file(self, rs, filestore, template, extraparams=dict()):
         """
         Function to generically handle editing a single file.
@@ -650,6 +681,9 @@ class Application:
         @type rs: RequestState
         """
         self.check_login(rs)
+        if self.check_modified(rs, [aca.path
+                                    for aca in self.listAcademies()]):
+            return rs.response
         return self.render_index(rs)
 
     def do_academy(self, rs, academy = None):
@@ -660,6 +694,9 @@ class Application:
         assert academy is not None
         self.check_login(rs)
         aca = self.getAcademy(academy, rs.user)
+        if self.check_modified(rs, [aca.path] + [
+                c.path for c in self.catalog.listCourses(aca)]):
+            return rs.response
         return self.render_academy(rs, aca)
 
     def do_course(self, rs, academy = None, course = None):
@@ -672,6 +709,8 @@ class Application:
         self.check_login(rs)
         aca = self.getAcademy(academy, rs.user)
         c = self.getCourse(aca, course, rs.user)
+        if self.check_modified(rs, [aca.path, c.path]):
+            return rs.response
         return self.render_course(rs, aca, c)
 
     def do_showdeadpages(self, rs, academy=None, course=None):
@@ -1063,7 +1102,7 @@ class Application:
             return werkzeug.exceptions.Forbidden()
         rs.response.content_type = "application/octet-stream"
         def export_iterator(course):
-            tarwriter = common.TarWriter(gzip=True)
+            tarwriter = common.TarWriter(gzip=True, **self.gzipoptions)
             for chunk in course.rawExportIterator(tarwriter):
                 yield chunk
             yield tarwriter.close()
@@ -1087,20 +1126,89 @@ class Application:
             return werkzeug.exceptions.Forbidden()
         if not rs.user.mayExport(aca):
             return werkzeug.exceptions.Forbidden()
+        tarwriter = self.delta_tarwriter(rs, aca, "raw")
+        if tarwriter is None and "since" in rs.request.args:
+            return werkzeug.exceptions.BadRequest()
         rs.response.content_type = "application/octet-stream"
-        def export_iterator(academy):
-            tarwriter = common.TarWriter(gzip=True)
-            for chunk in academy.rawExportIterator(tarwriter):
-                yield chunk
-            yield tarwriter.close()
-        rs.response.response = export_iterator(aca)
-        filename = b"%s.tar.gz" % aca.name
+        if tarwriter is not None or not self.serve_prebuilt(rs, aca, "raw"):
+            def export_iterator(academy, tarwriter):
+                if tarwriter is None:
+                    tarwriter = common.TarWriter(gzip=True,
+                                                 **self.gzipoptions)
+                for chunk in academy.rawExportIterator(tarwriter):
+                    yield chunk
+                yield tarwriter.close()
+            rs.response.response = export_iterator(aca, tarwriter)
+        if tarwriter is None:
+            filename = b"%s.tar.gz" % aca.name
+        else:
+            filename = b"%s_delta.tar.gz" % aca.name
         if sys.version_info >= (3,):
             filename = filename.decode("ascii")
         rs.response.headers['Content-Disposition'] = \
                 "attachment; filename=" + filename
         return rs.response
 
+    def delta_tarwriter(self, rs, aca, kind):
+        """
+        Create a TarWriter for an incremental export if the request asks
+        for one by passing a token or a unix timestamp as since parameter.
+
+        @type rs: RequestState
+        @type aca: Academy
+        @param kind: texexport or raw
+        @type kind: str
+        @returns: None if no incremental export was requested or since is
+            invalid (e.g. an expired token)
+        @rtype: None or DeltaTarWriter
+        """
+        since = rs.request.args.get("since")
+        if since is None:
+            return None
+        return self.manifeststore.tarwriter(aca.name, kind, since, gzip=True,
+                                            **self.gzipoptions)
+
+    def serve_prebuilt(self, rs, aca, kind):
+        """
+        Tag the response with the key of the export as ETag. Exports are
+        reproducible, so an export the client already has is answered with
+        304 right away. Otherwise a prebuilt export is served if an up to
+        date one exists. If neither applies, a rebuild is scheduled and the
+        caller has to generate the export.
+
+        @type rs: RequestState
+        @type aca: Academy
+        @param kind: see dokuforge.exportbuilder.kinds
+        @type kind: str
+        @returns: whether the response was filled in
+        @rtype: bool
+        """
+        key = self.exportbuilder.key(aca, kind)
+        rs.response.set_etag(key.decode("ascii"))
+        rs.response.headers['Cache-Control'] = "private"
+        if not werkzeug.http.is_resource_modified(rs.request.environ,
+                                                  etag=key.decode("ascii")):
+            rs.response.status_code = 304
+            return True
+        found = self.exportbuilder.lookup(aca, kind, key)
+        if found is None:
+            self.exportbuilder.schedule(aca.name)
+            return False
+        filename, key = found
+        try:
+            prebuilt = open(filename, "rb")
+        except IOError: # replaced by a rebuild in the meantime
+            return False
+        st = os.fstat(prebuilt.fileno())
+        rs.response.response = werkzeug.wsgi.wrap_file(rs.request.environ,
+                                                       prebuilt)
+        rs.response.direct_passthrough = True
+        rs.response.content_length = st.st_size
+        rs.response.last_modified = datetime.datetime.fromtimestamp(
+            int(st.st_mtime), datetime.timezone.utc)
+        rs.response.make_conditional(rs.request)
+        return True
+
     def do_export(self, rs, academy=None):
         """
         @type rs: RequestState
@@ -1111,24 +1219,54 @@ class Application:
         aca = self.getAcademy(academy, rs.user)
         if not rs.user.mayExport(aca):
             return werkzeug.exceptions.Forbidden()
+        tarwriter = self.delta_tarwriter(rs, aca, "texexport")
+        if tarwriter is None and "since" in rs.request.args:
+            return werkzeug.exceptions.BadRequest()
         rs.response.content_type = "application/octet-stream"
         prefix = b"texexport_" + aca.name
-        def export_iterator(aca, static, prefix):
-            tarwriter = common.TarWriter(gzip=True)
-            tarwriter.pushd(prefix)
-            for chunk in aca.texExportIterator(tarwriter,
-                                               static=static):
-                yield chunk
-            tarwriter.popd()
-            yield tarwriter.close()
-        rs.response.response = export_iterator(aca, self.staticexportdir,
-                                               prefix)
+        if tarwriter is not None or \
+                not self.serve_prebuilt(rs, aca, "texexport"):
+            rs.response.response = aca.texExport(
+                static=self.staticexportdir, gzip=True,
+                workers=self.exportworkers, cache=self.exportcache,
+                tarwriter=tarwriter, **self.gzipoptions)
+        if tarwriter is not None:
+            prefix += b"_delta"
         filename_prefix = \
             prefix.decode("ascii") if sys.version_info >= (3,) else prefix
         rs.response.headers['Content-Disposition'] = \
                 "attachment; filename=%s.tar.gz" % filename_prefix
         return rs.response
 
+    def do_courseexport(self, rs, academy=None, course=None):
+        """
+        Export a single course in the layout of the academy export. The
+        static export directory is only included with static=true.
+
+        @type rs: RequestState
+        @type academy: unicode
+        @type course: unicode
+        """
+        assert academy is not None and course is not None
+        self.check_login(rs)
+        aca = self.getAcademy(academy, rs.user)
+        c = self.getCourse(aca, course, rs.user)
+        if not rs.user.mayExport(aca) or not rs.user.allowedRead(aca, c):
+            return werkzeug.exceptions.Forbidden()
+        static = None
+        if common.strtobool(rs.request.args.get("static", u"false")):
+            static = self.staticexportdir
+        rs.response.content_type = "application/octet-stream"
+        rs.response.response = aca.texExport(
+            static=static, gzip=True, workers=self.exportworkers,
+            cache=self.exportcache, courses=[c], **self.gzipoptions)
+        filename = b"texexport_%s_%s.tar.gz" % (aca.name, c.name)
+        if sys.version_info >= (3,):
+            filename = filename.decode("ascii")
+        rs.response.headers['Content-Disposition'] = \
+                "attachment; filename=" + filename
+        return rs.response
+
     def do_moveup(self, rs, academy=None, course=None):
         """
         @type rs: RequestState
@@ -1160,6 +1298,8 @@ class Application:
         self.check_login(rs)
         aca = self.getAcademy(academy, rs.user)
         c = self.getCourse(aca, course, rs.user)
+        if self.check_modified(rs, [aca.path, c.path]):
+            return rs.response
         return self.render_show(rs, aca, c, page)
 
     def do_edit(self, rs, academy = None, course = None, page = None):
@@ -1340,7 +1480,8 @@ class Application:
             return werkzeug.exceptions.Forbidden()
         return self.do_property(rs, aca.gettitle,
                                 "academytitle.html",
-                                extraparams={'academy': aca.view()})
+                                extraparams={
+                                    'academy': self.catalog.viewAcademy(aca)})
 
     def do_academytitlesave(self, rs, academy=None):
         """
@@ -1354,7 +1495,9 @@ class Application:
             return werkzeug.exceptions.Forbidden()
         return self.do_propertysave(rs, aca.settitle,
                                     "academytitle.html",
-                                    extraparams = {'academy': aca.view()})
+                                    extraparams = {
+                                        'academy':
+                                            self.catalog.viewAcademy(aca)})
 
     def do_coursetitle(self, rs, academy=None, course=None):
         """
@@ -1370,8 +1513,9 @@ class Application:
             return werkzeug.exceptions.Forbidden()
         return self.do_property(rs, c.gettitle,
                                 "coursetitle.html",
-                                extraparams={'academy': aca.view(),
-                                             'course': c.view()})
+                                extraparams={
+                                    'academy': self.catalog.viewAcademy(aca),
+                                    'course': self.catalog.viewCourse(c)})
 
     def do_coursetitlesave(self, rs, academy=None, course=None):
         """
@@ -1387,8 +1531,10 @@ class Application:
             return werkzeug.exceptions.Forbidden()
         return self.do_propertysave(rs, c.settitle,
                                     "coursetitle.html",
-                                    extraparams={'academy': aca.view(),
-                                                 'course': c.view()})
+                                    extraparams={
+                                        'academy':
+                                            self.catalog.viewAcademy(aca),
+                                        'course': self.catalog.viewCourse(c)})
 
     def do_admin(self, rs):
         """
@@ -1484,8 +1630,8 @@ class Application:
         assert isinstance(theversion, unicode)
         assert isinstance(thecontent, unicode)
         params = dict(
-            academy=theacademy.view(),
-            course=thecourse.view(),
+            academy=self.catalog.viewAcademy(theacademy),
+            course=self.catalog.viewCourse(thecourse),
             page=thepage,
             ## Note: must use the provided content, as it has to fit with the
             ## version
@@ -1502,14 +1648,18 @@ class Application:
         """
         groups = {group: title for group, title in self.listGroups().items()
                   if rs.user.allowedList(group) or group == rs.user.defaultGroup()}
-        all_academies = self.listAcademies()
+        all_academies = [self.catalog.viewAcademy(academy)
+                         for academy in self.listAcademies()]
         academies = {
-            group: [academy.view() for academy in all_academies
-                    if group in academy.view()["groups"]]
+            group: [academy for academy in all_academies
+                    if group in academy["groups"]]
             for group in groups
         }
+        readable = frozenset(academy["name"] for academy
+                             in rs.user.filterReadable(all_academies))
         params = dict(
             academies=academies,
+            readable=readable,
             groups=groups)
         return self.render("index.html", rs, params)
 
@@ -1518,8 +1668,15 @@ class Application:
         @type rs: RequestState
         @type theacademy: Academy
         """
+        academyview = self.catalog.viewAcademy(theacademy)
+        courses = self.catalog.listCourses(theacademy)
+        readable = frozenset(c.name for c in
+                             rs.user.filterReadable(courses, academyview))
+        fragmentkey = (directorystate([c.path for c in courses])[0],
+                       tuple(sorted(readable)))
         return self.render("academy.html", rs,
-                           dict(academy=theacademy.view()))
+                           dict(academy=academyview, readable=readable),
+                           fragmentkey)
 
     def render_deadcourses(self, rs, theacademy):
         """
@@ -1527,7 +1684,7 @@ class Application:
         @type theacademy: Academy
         """
         return self.render("deadcourses.html", rs,
-                           dict(academy=theacademy.view()))
+                           dict(academy=self.catalog.viewAcademy(theacademy)))
 
     def render_deadblobs(self, rs, theacademy, thecourse, thepage):
         """
@@ -1537,8 +1694,8 @@ class Application:
         @type thepage: int
         """
         params = dict(
-            academy=theacademy.view(),
-            course=thecourse.view(),
+            academy=self.catalog.viewAcademy(theacademy),
+            course=self.catalog.viewCourse(thecourse),
             page=thepage,
             blobs=[thecourse.viewblob(i) for i in thecourse.listdeadblobs()])
         return self.render("deadblobs.html", rs, params)
@@ -1550,8 +1707,8 @@ class Application:
         @type thecourse: Course
         """
         params = dict(
-            academy=theacademy.view(),
-            course=thecourse.view())
+            academy=self.catalog.viewAcademy(theacademy),
+            course=self.catalog.viewCourse(thecourse))
         return self.render("dead.html", rs, params)
 
     def render_course(self, rs, theacademy, thecourse):
@@ -1560,15 +1717,16 @@ class Application:
         @type theacademy: Academy
         @type thecourse: Course
         """
-        courseview = thecourse.view()
-        theestimate = Estimate.fromNothing()
-        for x in courseview['outlines']:
-            theestimate += x.estimate
+        courseview = self.catalog.viewCourse(thecourse, dict(
+            outlines=lambda: self.outlinecache.outlines(thecourse),
+            estimate=lambda: Estimate.sum(
+                x.estimate for x in courseview['outlines'])))
         params = dict(
-            academy=theacademy.view(),
-            course=courseview,
-            estimate=theestimate)
-        return self.render("course.html", rs, params)
+            academy=self.catalog.viewAcademy(theacademy),
+            course=courseview)
+        fragmentkey = (directorystate([thecourse.path])[0],
+                       rs.user.allowedWrite(theacademy, thecourse))
+        return self.render("course.html", rs, params, fragmentkey)
 
     def render_addblob(self, rs, theacademy, thecourse, thepage, ok=None,
                        error=None):
@@ -1579,8 +1737,8 @@ class Application:
         @type thepage: int
         """
         params = dict(
-            academy=theacademy.view(),
-            course=thecourse.view(),
+            academy=self.catalog.viewAcademy(theacademy),
+            course=self.catalog.viewCourse(thecourse),
             page=thepage,
             ok=ok,
             error=error,
@@ -1596,8 +1754,8 @@ class Application:
         @type thepage: int
         """
         params = dict(
-            academy=theacademy.view(),
-            course=thecourse.view(),
+            academy=self.catalog.viewAcademy(theacademy),
+            course=self.catalog.viewCourse(thecourse),
             page=thepage,
             allowMathChange = False)
         return self.render("uploadblob.html", rs, params)
@@ -1613,8 +1771,8 @@ class Application:
         @type blobhash: None or str
         """
         params = dict(
-            academy=theacademy.view(),
-            course=thecourse.view(),
+            academy=self.catalog.viewAcademy(theacademy),
+            course=self.catalog.viewCourse(thecourse),
             page=thepage,
             blob=thecourse.viewblob(blob),
             blobhash=blobhash)
@@ -1632,8 +1790,8 @@ class Application:
         @type error: None or CheckError
         """
         params = dict(
-            academy=theacademy.view(),
-            course=thecourse.view(),
+            academy=self.catalog.viewAcademy(theacademy),
+            course=self.catalog.viewCourse(thecourse),
             page=thepage,
             blob=thecourse.viewblob(blob),
             ok=ok,
@@ -1649,7 +1807,7 @@ class Application:
         @type ok: None or Boolean
         @type error: None or CheckError
         """
-        params = dict(academy=theacademy.view(),
+        params = dict(academy=self.catalog.viewAcademy(theacademy),
                       ok=ok,
                       error=error,
                       allowMathChange = False)
@@ -1672,7 +1830,7 @@ class Application:
         @type rs: RequestState
         @type theacademy: Academy
         """
-        params = dict(academy = theacademy.view(),
+        params = dict(academy = self.catalog.viewAcademy(theacademy),
                       allgroups = self.listGroups(),
                       allowMathChange = False,
                       ok = ok,
@@ -1687,19 +1845,26 @@ class Application:
         @type thepage: int
         @type saved: bool
         """
-        parsed = dfLineGroupParser(thecourse.showpage(thepage))
         theblobs = [thecourse.viewblob(i) for i in thecourse.listblobs(thepage)]
-        theestimate = parsed.toEstimate() + Estimate.fromBlobs(theblobs)
+        # Only evaluated when the fragments of the page are not cached.
+        pageview = LazyView(dict(
+            parsed=lambda: thecourse.parsepage(thepage),
+            commit=lambda: thecourse.getcommit(thepage),
+            content=lambda: pageview['parsed'].toHtml(),
+            estimate=lambda: pageview['parsed'].toEstimate() +
+                             Estimate.fromBlobs(theblobs)))
         params = dict(
-            academy=theacademy.view(),
-            course=thecourse.view(),
+            academy=self.catalog.viewAcademy(theacademy),
+            course=self.catalog.viewCourse(thecourse),
             page=thepage,
-            commit = thecourse.getcommit(thepage),
-            content=parsed.toHtml(),
-            estimate=theestimate,
+            pageview=pageview,
             saved=saved,
             blobs=theblobs)
-        return self.render("show.html", rs, params)
+        pagefile = thecourse.getstorage((u"page%d" % thepage).encode("ascii"))
+        fragmentkey = (filestate([
+            pagefile.fullpath(postfix=b",v"),
+            thecourse.getstorage(b"Index").fullpath(postfix=b",v")])[0],)
+        return self.render("show.html", rs, params, fragmentkey)
 
     def render_file(self, rs, templatename, theversion, thecontent, ok=None,
                     error=None, extraparams=dict()):
@@ -1746,13 +1911,27 @@ class Application:
         params.update(extraparams)
         return self.render(templatename, rs, params)
 
-    def render(self, templatename, rs, extraparams=dict()):
+    def render(self, templatename, rs, extraparams=dict(), fragmentkey=None):
         """
         @type templatename: str
         @type rs: RequestState
         @type extraparams: dict
+        @param fragmentkey: if given, the parts of the template enclosed in
+            a call of fragment are taken from the fragmentcache. The key has
+            to cover everything these parts depend on beyond the template and
+            the version of dokuforge.
+        @type fragmentkey: None or tuple
         """
         assert isinstance(templatename, str)
+        template = self.jinjaenv.get_template(templatename)
+        if fragmentkey is None:
+            fragment = lambda name, caller: caller()
+        else:
+            fragmentkey = (templatename, os.path.getmtime(template.filename),
+                           exporterversion(), rs.request.script_root) + \
+                fragmentkey
+            fragment = lambda name, caller: self.fragmentcache.lookup(
+                fragmentkey + (name,), caller)
         rs.response.content_type = "text/html; charset=utf8"
         allowMathChange = True
         if rs.request.method == "POST":
@@ -1765,8 +1944,8 @@ class Application:
             basejoin = lambda tail: urllib.basejoin(rs.request.url_root, tail),
             staticjoin = lambda name: self.staticjoin(name, rs),
             mathjaxjoin = lambda name: self.mathjaxjoin(name, rs),
+            fragment = fragment,
             allowMathChange = allowMathChange)
         params.update(extraparams)
-        template = self.jinjaenv.get_template(templatename)
         rs.response.data = template.render(params).encode("utf8")
         return rs.response
@@ -0,0 +1,152 @@
+"""
+In memory catalog of the academies and their courses.
+
+Listing the academies or the courses of an academy requires checking out the
+title, the groups and the deletion flag of each of them. The L{Catalog}
+keeps these values in memory. An entry stays valid as long as the
+modification time of its directory and the sizes and modification times of
+the rcs files the values are read from do not change. Since rcs replaces an
+rcs file by renaming a new one into place, any modification within a
+directory also updates the modification time of the directory.
+"""
+
+import os
+import threading
+
+from dokuforge.academy import Academy
+from dokuforge.common import CheckError
+import dokuforge.common as common
+from dokuforge.course import Course
+from dokuforge.fragmentcache import filestate
+
+def listAcademyNames(path):
+    """
+    @param path: the directory containing the academies
+    @type path: bytes
+    @returns: the names of all academies sorted by name; entries that are
+        not valid academy names, like lost+found, are skipped
+    @rtype: [bytes]
+    """
+    names = []
+    for name in os.listdir(path):
+        try:
+            common.validateInternalName(name.decode("utf8"))
+        except (CheckError, UnicodeDecodeError):
+            continue
+        if os.path.isdir(os.path.join(path, name)):
+            names.append(name)
+    return sorted(names)
+
+class Catalog(object):
+    def __init__(self, path, listAllGroups):
+        """
+        @param path: the directory containing the academies
+        @type path: bytes
+        @param listAllGroups: passed on to the Academy objects
+        """
+        assert isinstance(path, bytes)
+        self.path = path
+        self.listAllGroups = listAllGroups
+        self.entries = dict()
+        self.lock = threading.Lock()
+
+    def lookup(self, path, filenames, compute):
+        """
+        @param path: a directory
+        @type path: bytes
+        @param filenames: the rcs files within path the values are read from
+        @type filenames: [bytes]
+        @param compute: function computing the values
+        @type compute: () -> object
+        @returns: the values computed for the current state of path
+        @rtype: object
+        """
+        state = (os.stat(path).st_mtime_ns, filestate(
+            [os.path.join(path, filename) for filename in filenames])[0])
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is not None and entry[0] == state:
+            return entry[1]
+        values = compute()
+        with self.lock:
+            self.entries[path] = (state, values)
+        return values
+
+    def listAcademies(self):
+        """
+        @returns: all academies sorted by name
+        @rtype: [Academy]
+        """
+        return [Academy(os.path.join(self.path, name), self.listAllGroups)
+                for name in self.lookup(self.path, [],
+                                        lambda: listAcademyNames(self.path))]
+
+    def academy(self, academy):
+        """
+        @type academy: Academy
+        @returns: a dict with the keys title(unicode), groups([unicode]) and
+            courses([bytes]), the latter containing the names of all courses
+            including the deleted ones
+        @rtype: {str: object}
+        """
+        return self.lookup(academy.path, [b"title,v", b"groups,v"],
+                           lambda: dict(title=academy.gettitle(),
+                                        groups=academy.getgroups(),
+                                        courses=[c.name for c in
+                                                 academy.listAllCourses()]))
+
+    def course(self, course):
+        """
+        @type course: Course
+        @returns: a dict with the keys title(unicode), deleted(bool) and
+            timestamp(datetime)
+        @rtype: {str: object}
+        """
+        return self.lookup(course.path, [b"title,v", b"isDeleted,v"],
+                           lambda: dict(title=course.gettitle(),
+                                        deleted=course.isDeleted,
+                                        timestamp=course.timestamp()))
+
+    def listCourses(self, academy, deleted=False):
+        """
+        @type academy: Academy
+        @param deleted: whether to list the deleted courses instead
+        @type deleted: bool
+        @returns: the courses of the academy sorted by name
+        @rtype: [Course]
+        """
+        courses = [Course(os.path.join(academy.path, name))
+                   for name in self.academy(academy)["courses"]]
+        return [c for c in courses if self.course(c)["deleted"] == deleted]
+
+    def viewAcademy(self, academy, extrafunctions=dict()):
+        """
+        @type academy: Academy
+        @type extrafunctions: {str: function}
+        @returns: Academy.view with the title, groups and courses taken from
+            the catalog
+        @rtype: LazyView
+        """
+        functions = dict(
+            title=lambda: self.academy(academy)["title"],
+            groups=lambda: self.academy(academy)["groups"],
+            courses=lambda: [self.viewCourse(c)
+                             for c in self.listCourses(academy)],
+            deadcourses=lambda: [self.viewCourse(c) for c in
+                                 self.listCourses(academy, deleted=True)])
+        functions.update(extrafunctions)
+        return academy.view(functions)
+
+    def viewCourse(self, course, extrafunctions=dict()):
+        """
+        @type course: Course
+        @type extrafunctions: {str: function}
+        @returns: Course.view with the title and timestamp taken from the
+            catalog
+        @rtype: LazyView
+        """
+        functions = dict(
+            title=lambda: self.course(course)["title"],
+            timestamp=lambda: self.course(course)["timestamp"])
+        functions.update(extrafunctions)
+        return course.view(functions)
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import io
 import random
 import subprocess
@@ -11,9 +13,11 @@ try:
 except ImportError:
     import configparser
     from configparser import ConfigParser
+import struct
 import tarfile
 from datetime import datetime, timezone
 import calendar
+import zlib
 
 try:
     check_output = subprocess.check_output
@@ -291,19 +295,140 @@ def validateRcsRevision(versionnumber):
         raise RcsUserInputError(u"rcs version number syntactically malformed",
                                 u"can only happen in hand-crafted requests")
 
+class ParallelCompressor(object):
+    """
+    Replacement for a raw deflate compressobj distributing the work on
+    several threads like pigz does. The input is cut into blocks of
+    blocksize bytes that are compressed independently, each using the end
+    of the previous block as preset dictionary. All but the last block are
+    terminated with a sync flush, so the concatenation of the compressed
+    blocks is a single ordinary deflate stream. zlib releases the GIL while
+    compressing, so the threads actually run in parallel.
+    """
+    blocksize = 128 * 1024
+    dictsize = 32 * 1024
+
+    def __init__(self, level, threads):
+        """
+        @type level: int
+        @param threads: number of compressing threads
+        @type threads: int
+        """
+        assert threads > 0
+        self.level = level
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.maxpending = 2 * threads
+        self.buffer = []
+        self.buffered = 0
+        self.dictionary = b""
+        self.pending = collections.deque()
+
+    @staticmethod
+    def compressblock(level, data, dictionary, last):
+        if dictionary:
+            compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                          -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                          0, dictionary)
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                          -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                          0)
+        return compressor.compress(data) + \
+            compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    def submit(self, data, last):
+        self.pending.append(self.executor.submit(
+            self.compressblock, self.level, data, self.dictionary, last))
+        self.dictionary = data[-self.dictsize:]
+
+    def collect(self, wait):
+        """
+        @param wait: whether to wait for all submitted blocks; otherwise only
+            wait until no more than maxpending blocks are in flight
+        @returns: the compressed blocks finished so far in order
+        @rtype: bytes
+        """
+        output = []
+        while self.pending and (wait or self.pending[0].done() or
+                                len(self.pending) > self.maxpending):
+            output.append(self.pending.popleft().result())
+        return b"".join(output)
+
+    def compress(self, data):
+        """
+        @type data: bytes
+        @rtype: bytes
+        """
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.blocksize:
+            data = b"".join(self.buffer)
+            end = len(data) - len(data) % self.blocksize
+            for start in range(0, end, self.blocksize):
+                self.submit(data[start:start + self.blocksize], False)
+            self.buffer = [data[end:]]
+            self.buffered = len(data) - end
+        return self.collect(False)
+
+    def flush(self):
+        """
+        Compress the remaining input and end the deflate stream.
+        @rtype: bytes
+        """
+        self.submit(b"".join(self.buffer), True)
+        self.buffer = []
+        self.buffered = 0
+        try:
+            return self.collect(True)
+        finally:
+            self.executor.shutdown()
+
 class TarWriter:
-    def __init__(self, gzip=False):
-        self.io = io.BytesIO()
+    """
+    Generate a tar archive (optionally gzip compressed) piece by piece. The
+    archive is identical to what tarfile would write in stream mode, but no
+    member is ever held in memory as a whole: file contents are read in
+    blocks of at most blocksize bytes and each block is handed out before
+    the next one is read. For uncompressed archives the blocks are passed
+    on without copying.
+
+    The archive only depends on the added members: directories are added in
+    sorted order and the gzip header carries no time stamp (like gzip -n).
+    """
+    blocksize = 64 * 1024
+
+    def __init__(self, gzip=False, gziplevel=9, gzipthreads=0):
+        """
+        @type gzip: bool
+        @param gziplevel: compression level from 1 (fastest) to 9 (best)
+        @type gziplevel: int
+        @param gzipthreads: number of threads compressing in parallel; with 0
+            everything is compressed in the calling thread and the result is
+            identical to what tarfile writes
+        @type gzipthreads: int
+        """
         # tarfile requires the use of decoded strings, so choose any encoding
         # that will never fail decoding arbitrary bytes. In particular choose
         # the encoding used by wsgi: iso8859-1. Note that we do not rely on
         # the decoded data to carry any meaning beyond being able to encode it.
+        self.encoding = "iso8859-1"
+        self.pending = []
+        self.offset = 0
         if gzip:
-            self.tar = tarfile.open(mode="w|gz", fileobj=self.io,
-                                    encoding="iso8859-1")
+            # same parameters and header as tarfile's "w|gz" mode, except
+            # for the time stamp
+            if gzipthreads > 0:
+                self.compressor = ParallelCompressor(gziplevel, gzipthreads)
+            else:
+                self.compressor = zlib.compressobj(gziplevel, zlib.DEFLATED,
+                                                   -zlib.MAX_WBITS,
+                                                   zlib.DEF_MEM_LEVEL, 0)
+            self.crc = zlib.crc32(b"")
+            extraflags = {1: b"\004", 9: b"\002"}.get(gziplevel, b"\0")
+            self.pending.append(b"\037\213\010\010" + struct.pack("<L", 0) +
+                                extraflags + b"\377\0")
         else:
-            self.tar = tarfile.open(mode="w|", fileobj=self.io,
-                                    encoding="iso8859-1")
+            self.compressor = None
         self.dirs = []
 
     @property
@@ -331,12 +456,50 @@ class TarWriter:
         assert self.dirs
         return self.dirs.pop()
 
+    def write(self, data):
+        """
+        Append raw tar data to the archive.
+        @type data: bytes
+        """
+        self.offset += len(data)
+        if self.compressor is None:
+            self.pending.append(data)
+        else:
+            self.crc = zlib.crc32(data, self.crc)
+            self.pending.append(self.compressor.compress(data))
+
     def read(self):
-        data = self.io.getvalue()
-        self.io.seek(0)
-        self.io.truncate(0)
+        """
+        @returns: the archive data generated since the last call
+        @rtype: bytes
+        """
+        if len(self.pending) == 1:
+            data = self.pending[0]
+        else:
+            data = b"".join(self.pending)
+        del self.pending[:]
         return data
 
+    def writeheader(self, name, size, mtime):
+        """
+        @type name: bytes
+        @type size: int
+        @type mtime: int or float
+        """
+        if not isinstance(name, str):
+            name = name.decode("iso8859-1")
+        info = tarfile.TarInfo(self.prefix + name)
+        info.size = size
+        info.mtime = mtime
+        self.write(info.tobuf(tarfile.DEFAULT_FORMAT, self.encoding,
+                              "surrogateescape"))
+
+    def writepadding(self):
+        """Pad the archive to a full tar block."""
+        remainder = self.offset % tarfile.BLOCKSIZE
+        if remainder:
+            self.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+
     def addChunk(self, name, content, lastchanged):
         """
         Add a file with given content and return some tar content generated
@@ -349,34 +512,47 @@ class TarWriter:
         """
         assert isinstance(name, bytes)
         assert isinstance(content, bytes)
-        if not isinstance(name, str):
-            name = name.decode("iso8859-1")
         assert isinstance(lastchanged, datetime)
-
-        info = tarfile.TarInfo(self.prefix + name)
-        info.size = len(content)
-        info.mtime = calendar.timegm(lastchanged.utctimetuple())
-        self.tar.addfile(info, io.BytesIO(content))
+        self.writeheader(name, len(content),
+                         calendar.timegm(lastchanged.utctimetuple()))
+        self.write(content)
+        self.writepadding()
         return self.read()
 
+    def addFileIterator(self, name, filename):
+        """
+        Add a regular file with given (tar) name and given (filesystem)
+        filename. The tar content is generated while reading the file and
+        returned as a bytes iterator.
+        @type name: bytes
+        @type filename: bytes
+        @rtype: iter(bytes)
+        """
+        with open(filename, "rb") as infile:
+            st = os.fstat(infile.fileno())
+            self.writeheader(name, st.st_size, st.st_mtime)
+            yield self.read()
+            remaining = st.st_size
+            while remaining > 0:
+                block = infile.read(min(remaining, self.blocksize))
+                if not block:
+                    raise IOError("%r shrunk while adding it to the tar "
+                                  "archive" % filename)
+                remaining -= len(block)
+                self.write(block)
+                yield self.read()
+        self.writepadding()
+
     def addFileChunk(self, name, filename):
         """
         Add a regular file with given (tar) name and given (filesystem)
-        filename and return some tar content generated along the way.
+        filename and return some tar content generated along the way. Use
+        addFileIterator for files that may be large.
         @type name: bytes
         @type filename: bytes
         @rtype: bytes
         """
-        if not isinstance(name, str):
-            name = name.decode("iso8859-1")
-        info = tarfile.TarInfo(self.prefix + name)
-        with open(filename, "rb") as infile:
-            infile.seek(0, 2)
-            info.size = infile.tell()
-            info.mtime = os.path.getmtime(filename)
-            infile.seek(0)
-            self.tar.addfile(info, infile)
-        return self.read()
+        return b"".join(self.addFileIterator(name, filename)) + self.read()
 
     def addDirChunk(self, name, dirname, excludes=[]):
         """
@@ -391,12 +567,13 @@ class TarWriter:
         if name:
             self.pushd(name)
         try:
-            for entry in os.listdir(dirname):
+            for entry in sorted(os.listdir(dirname)):
                 if entry in excludes:
                     continue
                 fullpath = os.path.join(dirname, entry)
                 if os.path.isfile(fullpath):
-                    yield self.addFileChunk(entry, fullpath)
+                    for chunk in self.addFileIterator(entry, fullpath):
+                        yield chunk
                 elif os.path.isdir(fullpath):
                     for chunk in self.addDirChunk(entry, fullpath,
                                                   excludes=excludes):
@@ -411,8 +588,16 @@ class TarWriter:
         @rtype: bytes
         """
         assert not self.dirs
-        self.tar.close()
-        return self.io.getvalue()
+        self.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+        remainder = self.offset % tarfile.RECORDSIZE
+        if remainder:
+            self.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+        if self.compressor is not None:
+            self.pending.append(self.compressor.flush())
+            self.pending.append(struct.pack("<L", self.crc & 0xffffffff))
+            self.pending.append(struct.pack("<L", self.offset & 0xffffffff))
+            self.compressor = None
+        return self.read()
 
 def findlastchange(changes):
     """
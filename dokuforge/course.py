@@ -12,9 +12,32 @@ from dokuforge.common import check_output
 from dokuforge.storagedir import StorageDir
 from dokuforge.view import LazyView, liftdecodeutf8
 from dokuforge.parser import dfLineGroupParser, dfTitleParser, dfCaptionParser
-from dokuforge.parser import Estimate, PHeading
+from dokuforge.parser import Budget, Estimate, PHeading
 import dokuforge.common as common
 
+def texpage(path, number):
+    """
+    Render a single page of a course as tex. This is a module level function
+    so that it can be handed to the worker processes of a parallel export.
+
+    @param path: the path of the course
+    @type path: bytes
+    @param number: the internal number of the page
+    @type number: int
+    @rtype: unicode
+    """
+    return Course(path).parsepage(number).toTex()
+
+def decodecommit(info):
+    """
+    @param info: as returned by Storage.commitstatus
+    @type info: {bytes: bytes or datetime}
+    @rtype: {unicode: unicode or datetime}
+    """
+    return dict((k.decode("ascii"), v) if k == b"date"
+                else (k.decode("ascii"), v.decode("utf8"))
+                for k, v in info.items())
+
 class Outline:
     def __init__(self, number):
         """
@@ -171,28 +194,46 @@ class Course(StorageDir):
         """
         pages = self.listpages()
         outlines = []
-        for p in pages:
-            outline = Outline(p)
-            outline.addcommitinfo(self.getcommit(p))
-            parsed = dfLineGroupParser(self.showpage(p))
-            headings =  [x for x in parsed.parts if isinstance(x, PHeading)]
-            outline.addParsed(headings)
-            theestimate = parsed.toEstimate()
-            theestimate += Estimate.fromBlobs(self.listblobs(p))
-            outline.addEstimate(theestimate)
+        for p, commit in zip(pages, self.getcommits(pages)):
+            outline = self.parseoutline(p)
+            outline.addcommitinfo(commit)
+            outline.addEstimate(outline.estimate +
+                                Estimate.fromBlobs(self.listblobs(p)))
             outlines.append(outline)
         return outlines
 
+    def parseoutline(self, page):
+        """
+        @type page: int
+        @returns: the outline of the given page with the headings and the
+            estimate of its text, but neither commit information nor blobs
+        @rtype: Outline
+        """
+        outline = Outline(page)
+        parsed = self.parsepage(page)
+        headings =  [x for x in parsed.parts if isinstance(x, PHeading)]
+        outline.addParsed(headings)
+        outline.addEstimate(parsed.toEstimate())
+        return outline
+
     def getcommit(self, page):
         """
         @type page: int
         @rtype: {unicode: unicode or datetime}
         """
         page = (u"page%d" % page).encode("ascii")
-        info = self.getstorage(page).commitstatus()
-        return dict((k.decode("ascii"), v) if k == b"date"
-                    else (k.decode("ascii"), v.decode("utf8"))
-                    for k, v in info.items())
+        return decodecommit(self.getstorage(page).commitstatus())
+
+    def getcommits(self, pages):
+        """
+        Batched variant of getcommit using a single rlog run.
+
+        @type pages: [int]
+        @rtype: [{unicode: unicode or datetime}]
+        """
+        infos = self.getcommitstatuses([(u"page%d" % page).encode("ascii")
+                                        for page in pages])
+        return [decodecommit(info) for info in infos]
 
     def _getnumandlinkedpages(self):
         """
@@ -229,14 +270,7 @@ class Course(StorageDir):
             in the index (shortened to headings).
         @rtype: [Outline]
         """
-        outlines = []
-        for p in self.listdeadpages():
-            outline = Outline(p)
-            parsed = dfLineGroupParser(self.showpage(p))
-            headings =  [x for x in parsed.parts if isinstance(x, PHeading)]
-            outline.addParsed(headings)
-            outlines.append(outline)
-        return outlines
+        return [self.parseoutline(p) for p in self.listdeadpages()]
 
     def _getnumandavailableblobs(self):
         """
@@ -283,6 +317,23 @@ class Course(StorageDir):
         page = (u"page%d" % number).encode("ascii")
         return self.getcontent(page).decode("utf8")
 
+    def parsepage(self, number, content=None):
+        """
+        Parse the contents of a page within the default parser budget, so
+        that a pathological page cannot stall the caller.
+
+        @type number: int
+        @param number: the internal number of that page
+        @param content: the contents of the page if already known
+        @type content: None or unicode
+        @rtype: PTree
+        """
+        if content is None:
+            content = self.showpage(number)
+        context = "page %d of %s" % (number,
+                                      self.path.decode("utf8", "replace"))
+        return dfLineGroupParser(content, budget=Budget(context=context))
+
     def getrcs(self, page):
         """
         @param page: the internal number of the page
@@ -622,7 +673,7 @@ class Course(StorageDir):
         blobname.store(filename, user=user)
 
     def lastchange(self):
-        return common.findlastchange([self.getcommit(p) for p in self.listpages()])
+        return common.findlastchange(self.getcommits(self.listpages()))
 
     def timestamp(self):
         return max([self.getstorage((u"page%d" % p).encode("ascii")).timestamp()
@@ -658,25 +709,63 @@ class Course(StorageDir):
             nameMangled = name[:-3] + name[-3:].lower()
         return nameMangled
 
-    def texExportIterator(self, tarwriter):
+    def submitTexExport(self, executor):
+        """
+        Start rendering the pages of this course within the given executor.
+        The result is meant to be passed to texExportIterator.
+
+        @type executor: concurrent.futures.Executor
+        @returns: futures of the tex of the pages keyed by page number
+        @rtype: {int: concurrent.futures.Future}
+        """
+        return dict((p, executor.submit(texpage, self.path, p))
+                    for p in self.listpages())
+
+    def texExportIterator(self, tarwriter, pagetexs=None):
         """
         yield the contents of the course as tex-export.
+
+        @param pagetexs: the pages already being rendered elsewhere as
+            obtained from submitTexExport; pages missing from it are rendered
+            in place
+        @type pagetexs: None or {int: concurrent.futures.Future}
         """
-        df2_input = u"title\n%s\n" % self.gettitle()
+        title = self.gettitle()
+        df2_input = u"title\n%s\n" % title
         tex = u"\\course{%02d}{%s}" % (self.number,
-                                       dfTitleParser(self.gettitle()).toTex().strip())
+                                       dfTitleParser(title).toTex().strip())
 
-        for p in self.listallpages():
-            df2_input += u"page%s\n%s\n" % (p, self.showpage(p))
-
-        for p in self.listpages():
+        # Gather everything up front, so that each page and blob is only
+        # retrieved once and all revision dates stem from a single rlog run.
+        index = []
+        for line in self.getcontent(b"Index").splitlines():
+            entries = line.split()
+            if entries:
+                index.append((int(entries[0]), [int(x) for x in entries[1:]]))
+        allpages = self.listallpages()
+        pagecontents = dict((p, self.showpage(p)) for p in allpages)
+        allblobs = self.listallblobs()
+        blobs = dict((b, self.viewblob(b)) for b in allblobs)
+        linkedblobs = [b for _, pageblobs in index for b in pageblobs]
+        infos = self.getcommitstatuses(
+            [(u"page%d" % p).encode("ascii") for p, _ in index] +
+            [(u"blob%d" % b).encode("ascii") for b in linkedblobs])
+        lastchange = common.findlastchange(
+            [decodecommit(info) for info in infos[:len(index)]])['date']
+        blobdates = dict((b, info[b'date']) for b, info in
+                         zip(linkedblobs, infos[len(index):]))
+
+        for p in allpages:
+            df2_input += u"page%s\n%s\n" % (p, pagecontents[p])
+
+        for p, pageblobs in index:
             tex += u"\n\n%%%%%% Part %d\n" % p
-            page = self.showpage(p)
-            tex += dfLineGroupParser(page).toTex()
-            for b in self.listblobs(p):
-                blob = self.viewblob(b)
-                blobbase = (u"blob%d" % b).encode("ascii")
-                blobdate = self.getstorage(blobbase).commitstatus()[b'date']
+            if pagetexs is not None and p in pagetexs:
+                tex += pagetexs[p].result()
+            else:
+                tex += self.parsepage(p, pagecontents[p]).toTex()
+            for b in pageblobs:
+                blob = blobs[b]
                 tex += u"\n\n%% blob %d\n" % b
                 tex += u"\\begin{figure*}\n\\centering\n"
                 fileName = self._mangleBlobName(blob['filename'])
@@ -701,11 +790,11 @@ class Course(StorageDir):
                                          (u"/blob_%d_" % b).encode("ascii") +
                                          self._mangleBlobName(blob['filename']).encode('utf8'),
                                          blob['data'],
-                                         blobdate)
+                                         blobdates[b])
         blob_filenames = u""
         blob_comments = u""
-        for b in self.listallblobs():
-            blob = self.viewblob(b)
+        for b in allblobs:
+            blob = blobs[b]
             blobbase = u"blob%d" % b
             blob_filenames += blobbase + u".filename\n"
             blob_filenames += blob['filename'] + u"\n"
@@ -715,8 +804,8 @@ class Course(StorageDir):
 
         yield tarwriter.addChunk(self.name + b"/input.df2",
                                  df2_input.encode("utf8"),
-                                 self.lastchange()['date'])
+                                 lastchange)
 
         yield tarwriter.addChunk(self.name + b"/chap.tex",
                                  tex.encode("utf8"),
-                                 self.lastchange()['date'])
+                                 lastchange)
@@ -1,45 +1,281 @@
 #!/usr/bin/env python
 """
-Usage: python -m dokuforge.export df2_academy_directory dokuforge-export-static_directory academy_name
+Usage: python -m dokuforge.export [-j WORKERS] [--jobs JOBS] [--outdir DIR] [--force] [--cachedir DIR] [--profile FILE] [-z] [--gzip-level LEVEL] [--gzip-threads THREADS] [--directory] df2_academy_directory dokuforge-export-static_directory (--all | academy_name ...)
+       python -m dokuforge.export [options] --course COURSE [--include-static] df2_academy_directory dokuforge-export-static_directory academy_name
+
+Write the tex exports of the given academies to texexport_<academy_name>.tar
+(or .tar.gz) in the output directory. Several academies are exported in
+parallel with --jobs. Next to each export the key of the state it was
+generated from is kept in .texexport_<academy_name>.tar.key, so academies
+whose export is up to date are skipped.
+
+With --course only the given course is exported to
+texexport_<academy_name>_<course>.tar in the layout of the academy export,
+so it can be unpacked over a full export. The static files are only
+included with --include-static.
+
+With --directory the export is written straight into the directory
+texexport_<academy_name> in the output directory instead of a tar archive.
+Only files whose content changed are rewritten and the static files are
+hardlinked where possible, so updating an existing LaTeX tree is cheap.
+The key is kept in .texexport_<academy_name>.key then and the list of the
+exported files in .texexport_<academy_name>.manifest. Files the previous
+export wrote but the current one does not are removed; other files, like
+the output of LaTeX, are kept. A course exported with --directory is
+written into the directory of its academy.
 """
 
-import os.path
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import os
 import sys
+import tempfile
+import time
+
+import werkzeug.exceptions
 
-from dokuforge.course  import Course
-from dokuforge.parser  import dfLineGroupParser
 from dokuforge.academy import Academy
-from dokuforge.common  import TarWriter
+from dokuforge.catalog import listAcademyNames
+from dokuforge.exportbuilder import exportkey
+from dokuforge.exportcache import ExportCache
+from dokuforge.exportdir import DirWriter
+from dokuforge.parserprofile import ParserProfile
 
-from tarfile import TarFile
+def writeatomically(filename, chunks):
+    """
+    Write the given chunks to a temporary file next to filename and rename
+    it to filename once complete.
 
-def process(academiesdir,staticexportdir,academyname):
-    academy = Academy ( os.path.join(academiesdir,academyname), [] )
+    @type filename: bytes
+    @type chunks: iter(bytes)
+    """
+    directory, basename = os.path.split(filename)
+    outfile = tempfile.NamedTemporaryFile(dir=directory or b".",
+                                          prefix=b"." + basename,
+                                          suffix=b".tmp", delete=False)
+    try:
+        with outfile:
+            for chunk in chunks:
+                outfile.write(chunk)
+        os.chmod(outfile.name, 0o644)
+        os.rename(outfile.name, filename)
+    finally:
+        if os.path.exists(outfile.name):
+            os.unlink(outfile.name)
 
-    # duplicate code from application.py
-    prefixdir = b"texexport_" + academyname
+def findcourse(academy, coursename):
+    """
+    @type academy: Academy
+    @type coursename: bytes
+    @returns: the course of the academy or None if there is no such course
+    @rtype: None or Course
+    """
+    try:
+        return academy.getCourse(coursename.decode("utf8"))
+    except werkzeug.exceptions.NotFound:
+        return None
 
-    def export_iterator(aca, staticexpdir, prefix):
-        tarwriter = TarWriter(gzip=False)
-        tarwriter.pushd(prefix)
-        for chunk in aca.texExportIterator(tarwriter,
-                                           static=staticexpdir):
-            yield chunk
-        tarwriter.popd()
-        yield tarwriter.close()
+def process(academiesdir, staticexportdir, academyname, workers=0,
+            cachedir=None, gzip=False, gziplevel=9, gzipthreads=0,
+            outdir=b".", force=False, coursename=None, directory=False):
+    """
+    Export a single academy unless its export in outdir is up to date.
 
-    tarGenerator = export_iterator(academy,staticexportdir,prefixdir)
+    @param coursename: if given, only this course is exported
+    @type coursename: None or bytes
+    @param directory: write the export into a directory using a DirWriter
+        instead of writing a tar archive; the gzip options are ignored
+    @type directory: bool
+    @returns: whether the academy was exported
+    @rtype: bool
+    """
+    academy = Academy(os.path.join(academiesdir, academyname), [])
+    cache = None if cachedir is None else ExportCache(cachedir)
+    basename = b"texexport_" + academyname
+    courses = None
+    if coursename is not None:
+        course = findcourse(academy, coursename)
+        if course is None:
+            raise ValueError("unknown course %s" % coursename.decode("utf8"))
+        courses = [course]
+        basename += b"_" + coursename
+    if directory:
+        filename = os.path.join(outdir, b"texexport_" + academyname)
+        gzipoptions = dict()
+    else:
+        basename += b".tar"
+        if gzip:
+            basename += b".gz"
+        filename = os.path.join(outdir, basename)
+        gzipoptions = dict(gzip=gzip, gziplevel=gziplevel,
+                           gzipthreads=gzipthreads)
+    keyfilename = os.path.join(outdir, b"." + basename + b".key")
+    key = exportkey(academy, "texexport", staticexportdir, gzipoptions,
+                    courses)
+    if not force and os.path.exists(filename):
+        try:
+            with open(keyfilename, "rb") as keyfile:
+                if keyfile.read() == key:
+                    return False
+        except IOError:
+            pass
+    if os.path.exists(keyfilename):
+        os.unlink(keyfilename)
+    if directory:
+        dirwriter = DirWriter(outdir, manifest=os.path.join(
+            outdir, b"." + basename + b".manifest"))
+        for _ in academy.texExport(static=staticexportdir, workers=workers,
+                                   cache=cache, tarwriter=dirwriter,
+                                   courses=courses):
+            pass
+    else:
+        writeatomically(filename, academy.texExport(
+            static=staticexportdir, gzip=gzip, workers=workers, cache=cache,
+            gziplevel=gziplevel, gzipthreads=gzipthreads, courses=courses))
+    # only record the key if the export really shows that state, otherwise
+    # the next run exports again
+    if exportkey(academy, "texexport", staticexportdir, gzipoptions,
+                 courses) == key:
+        writeatomically(keyfilename, [key])
+    return True
 
-    outputfile = open ( prefixdir.decode("utf8")+'.tar', 'wb' )
+def timedprocess(*args, **kwargs):
+    starttime = time.time()
+    exported = process(*args, **kwargs)
+    return exported, time.time() - starttime
 
-    for chunk in tarGenerator:
-        outputfile.write(chunk)
+def report(done, total, academyname, result):
+    """
+    Print the outcome of exporting an academy to stderr.
+
+    @type result: (bool, float) or Exception
+    """
+    if isinstance(result, Exception):
+        outcome = "failed: %s" % result
+    elif result[0]:
+        outcome = "exported in %.1f s" % result[1]
+    else:
+        outcome = "up to date"
+    width = len(str(total))
+    sys.stderr.write("[%*d/%d] %s: %s\n" % (width, done, total,
+                                           academyname.decode("utf8"), outcome))
+    sys.stderr.flush()
 
 def main():
-    academiesdir    = sys.argv[1].encode("utf8")
-    staticexportdir = sys.argv[2].encode("utf8")
-    academyname     = sys.argv[3].encode("utf8")
-    process(academiesdir,staticexportdir,academyname)
+    parser = argparse.ArgumentParser(
+        description="Write the tex exports of academies to "
+                    "texexport_<academy_name>.tar (or .tar.gz).")
+    parser.add_argument("academiesdir", metavar="df2_academy_directory")
+    parser.add_argument("staticexportdir",
+                        metavar="dokuforge-export-static_directory")
+    parser.add_argument("academynames", metavar="academy_name", nargs="*")
+    parser.add_argument("--all", action="store_true",
+                        help="export all academies in df2_academy_directory")
+    parser.add_argument("--course", metavar="COURSE",
+                        help="only export the given course of a single "
+                             "academy")
+    parser.add_argument("--include-static", action="store_true",
+                        help="add the static files to the export of a single "
+                             "course")
+    parser.add_argument("-j", "--workers", type=int, default=0,
+                        help="number of worker processes for parsing pages "
+                             "(default: 0, i.e. no extra processes)")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of academies exported in parallel "
+                             "(default: 1)")
+    parser.add_argument("--outdir", default=".", metavar="DIR",
+                        help="directory to write the exports to (default: "
+                             "the current directory)")
+    parser.add_argument("--force", action="store_true",
+                        help="export academies even if their export is up "
+                             "to date")
+    parser.add_argument("--cachedir", metavar="DIR",
+                        help="reuse the exports of unchanged courses stored "
+                             "in DIR and store new ones there")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write statistics about the time spent in the "
+                             "parser and the microtypography as json to "
+                             "FILE; implies -j 0 and --jobs 1")
+    parser.add_argument("-z", "--gzip", action="store_true",
+                        help="write a gzip compressed archive")
+    parser.add_argument("--gzip-level", type=int, default=9, metavar="LEVEL",
+                        help="compression level from 1 (fastest) to 9 "
+                             "(smallest, default)")
+    parser.add_argument("--gzip-threads", type=int, default=0,
+                        metavar="THREADS",
+                        help="number of threads compressing in parallel "
+                             "(default: 0, i.e. compress in the main thread)")
+    parser.add_argument("--directory", action="store_true",
+                        help="write the export into the directory "
+                             "texexport_<academy_name> instead of a tar "
+                             "archive, only rewriting changed files")
+    args = parser.parse_args()
+    if args.all == bool(args.academynames):
+        parser.error("give either --all or academy names")
+    if args.course is not None and (args.all or len(args.academynames) != 1):
+        parser.error("--course requires exactly one academy name")
+    if args.directory and args.gzip:
+        parser.error("--directory cannot be combined with --gzip")
+    academiesdir = args.academiesdir.encode("utf8")
+    if args.all:
+        academynames = listAcademyNames(academiesdir)
+    else:
+        academynames = [name.encode("utf8") for name in args.academynames]
+    options = dict(
+        cachedir=None if args.cachedir is None else args.cachedir.encode("utf8"),
+        gzip=args.gzip, gziplevel=args.gzip_level,
+        gzipthreads=args.gzip_threads, outdir=args.outdir.encode("utf8"),
+        force=args.force, directory=args.directory)
+    staticexportdir = args.staticexportdir.encode("utf8")
+    if args.course is not None:
+        options["coursename"] = args.course.encode("utf8")
+        academy = Academy(os.path.join(academiesdir, academynames[0]), [])
+        if findcourse(academy, options["coursename"]) is None:
+            parser.error("unknown course %s of academy %s" %
+                         (args.course, args.academynames[0]))
+        if not args.include_static:
+            staticexportdir = None
+    total = len(academynames)
+
+    if args.profile is not None:
+        with ParserProfile() as profile:
+            for done, academyname in enumerate(academynames, 1):
+                result = timedprocess(academiesdir, staticexportdir,
+                                      academyname, **options)
+                report(done, total, academyname, result)
+        with open(args.profile, "w") as profilefile:
+            json.dump(profile.report(), profilefile, indent=1,
+                      sort_keys=True)
+        return
+
+    failed = False
+    if args.jobs <= 1:
+        for done, academyname in enumerate(academynames, 1):
+            try:
+                result = timedprocess(academiesdir, staticexportdir,
+                                      academyname, workers=args.workers,
+                                      **options)
+            except Exception as error:
+                result = error
+                failed = True
+            report(done, total, academyname, result)
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = dict(
+                (executor.submit(timedprocess, academiesdir, staticexportdir,
+                                 academyname, workers=args.workers, **options),
+                 academyname)
+                for academyname in academynames)
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    result = future.result()
+                except Exception as error:
+                    result = error
+                    failed = True
+                report(done, total, futures[future], result)
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+"""
+Usage: python -m dokuforge.exportbuilder [-c CONFIG] [-j WORKERS] [academy_name ...]
+
+Keep prebuilt tex and raw exports of academies on disk, so that downloads
+can be served without generating them. Each prebuilt file is named by a key
+describing the state it was generated from; it is only served while the key
+matches the current state of the academy. The web application rebuilds the
+files of an academy some time after it was modified, while this script is
+meant to be run from cron to catch up on everything else. It only rebuilds
+exports that are out of date.
+"""
+
+import argparse
+import fcntl
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import threading
+
+from dokuforge.academy import Academy
+from dokuforge.catalog import listAcademyNames
+from dokuforge.common import TarWriter
+from dokuforge.exportcache import ExportCache, exporterversion, revisionvector
+from dokuforge.paths import PathConfig
+
+logger = logging.getLogger(__name__)
+
+kinds = ("texexport", "raw")
+
+def filesignature(path, excludes=()):
+    """
+    @param path: a directory
+    @type path: bytes
+    @param excludes: basenames to leave out
+    @returns: the names, sizes and modification times of all files below
+        the given directory
+    @rtype: [(bytes, int, float)]
+    """
+    signature = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(d for d in dirnames if d not in excludes)
+        for filename in sorted(filenames):
+            if filename in excludes:
+                continue
+            st = os.stat(os.path.join(dirpath, filename))
+            signature.append((os.path.join(dirpath, filename),
+                              st.st_size, st.st_mtime))
+    return signature
+
+def exportkey(academy, kind, staticexportdir=None, gzipoptions=dict(),
+              courses=None):
+    """
+    @type academy: Academy
+    @param kind: one of kinds
+    @type kind: str
+    @param staticexportdir: directory added to the tex export
+    @type staticexportdir: None or bytes
+    @param gzipoptions: the compression options passed to the TarWriter
+    @type gzipoptions: {str: object}
+    @param courses: the courses of a tex export restricted to them
+    @type courses: None or [Course]
+    @returns: a key describing the state the export is generated from and
+        the compression options. For the tex export the state consists of
+        the revision vectors of the academy and all its courses, the
+        exporter version and the static export directory. The raw export
+        copies the files of the academy, so their sizes and modification
+        times are used instead. Since exports are reproducible, the key
+        identifies the generated archive.
+    @rtype: bytes
+    """
+    digest = hashlib.sha1(kind.encode("ascii"))
+    digest.update(repr(sorted(gzipoptions.items())).encode("ascii"))
+    if kind != "texexport":
+        digest.update(repr(filesignature(academy.path)).encode("ascii"))
+        return digest.hexdigest().encode("ascii")
+    digest.update(b"\0" + exporterversion())
+    if staticexportdir is not None:
+        digest.update(repr(filesignature(staticexportdir,
+                                         (b".svn",))).encode("ascii"))
+    if courses is None:
+        directories = []
+        for dirpath, dirnames, _ in os.walk(academy.path):
+            dirnames.sort()
+            directories.append(dirpath)
+    else:
+        directories = [academy.path] + [course.path for course in courses]
+    for dirpath in directories:
+        for entry, revision in revisionvector(dirpath):
+            digest.update(b"\0%s\0%s\0%s" % (dirpath, entry,
+                                             revision or b"none"))
+    return digest.hexdigest().encode("ascii")
+
+class ExportBuilder(object):
+    def __init__(self, dfdir, cachedir, staticexportdir=None, delay=-1,
+                 workers=0, gziplevel=9, gzipthreads=0):
+        """
+        @param dfdir: directory containing the academies
+        @type dfdir: bytes
+        @param cachedir: the prebuilt files are placed in prebuilt within
+            this directory; the course cache in there is used as well
+        @type cachedir: bytes
+        @param staticexportdir: directory added to all tex exports
+        @type staticexportdir: None or bytes
+        @param delay: seconds to wait after the last modification of an
+            academy before rebuilding its exports; negative values disable
+            rebuilding after modifications
+        @type delay: float
+        @param workers: passed on to Academy.texExport
+        @type workers: int
+        @param gziplevel: passed on to TarWriter
+        @type gziplevel: int
+        @param gzipthreads: passed on to TarWriter
+        @type gzipthreads: int
+        """
+        self.dfdir = dfdir
+        self.path = os.path.join(cachedir, b"prebuilt")
+        self.cache = ExportCache(cachedir)
+        self.staticexportdir = staticexportdir
+        self.delay = delay
+        self.workers = workers
+        self.gzipoptions = dict(gziplevel=gziplevel, gzipthreads=gzipthreads)
+        self.timers = dict()
+        self.timerlock = threading.Lock()
+
+    def getAcademy(self, name):
+        """
+        @type name: bytes
+        @rtype: Academy
+        """
+        return Academy(os.path.join(self.dfdir, name), lambda: dict())
+
+    def key(self, academy, kind):
+        """
+        @type academy: Academy
+        @type kind: str
+        @returns: the exportkey of the academy with the settings of this
+            builder
+        @rtype: bytes
+        """
+        return exportkey(academy, kind, self.staticexportdir,
+                         self.gzipoptions)
+
+    def directory(self, academy):
+        """
+        @type academy: Academy
+        @rtype: bytes
+        """
+        return os.path.join(self.path, academy.name)
+
+    def filename(self, academy, kind, key):
+        """
+        @type academy: Academy
+        @type kind: str
+        @type key: bytes
+        @rtype: bytes
+        """
+        return os.path.join(self.directory(academy),
+                            b"%s-%s.tar.gz" % (kind.encode("ascii"), key))
+
+    def lookup(self, academy, kind, key=None):
+        """
+        @type academy: Academy
+        @type kind: str
+        @param key: the current key if already known
+        @type key: None or bytes
+        @returns: the file name and key of an up to date prebuilt export or
+            None if there is none
+        @rtype: None or (bytes, bytes)
+        """
+        if key is None:
+            key = self.key(academy, kind)
+        filename = self.filename(academy, kind, key)
+        if os.path.isfile(filename):
+            return filename, key
+        return None
+
+    def exportIterator(self, academy, kind):
+        """
+        @type academy: Academy
+        @type kind: str
+        @returns: the gzip compressed export
+        @rtype: iter(bytes)
+        """
+        if kind == "texexport":
+            return academy.texExport(static=self.staticexportdir, gzip=True,
+                                     workers=self.workers, cache=self.cache,
+                                     **self.gzipoptions)
+        def rawExportIterator():
+            tarwriter = TarWriter(gzip=True, **self.gzipoptions)
+            for chunk in academy.rawExportIterator(tarwriter):
+                yield chunk
+            yield tarwriter.close()
+        return rawExportIterator()
+
+    def build(self, academy, kind):
+        """
+        Build the given kind of export of the academy unless an up to date
+        one exists. Concurrent builders for the same academy (possibly in
+        other processes) are serialized.
+
+        @type academy: Academy
+        @type kind: str
+        @returns: whether a new export was installed
+        @rtype: bool
+        """
+        directory = self.directory(academy)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, b".lock"), "wb") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            key = self.key(academy, kind)
+            filename = self.filename(academy, kind, key)
+            if os.path.isfile(filename):
+                return False
+            logger.info("building %s of %r" % (kind, academy.path))
+            outfile = tempfile.NamedTemporaryFile(dir=directory, prefix=b".",
+                                                  suffix=b".tmp", delete=False)
+            try:
+                with outfile:
+                    for chunk in self.exportIterator(academy, kind):
+                        outfile.write(chunk)
+                if self.key(academy, kind) != key:
+                    logger.info("%r changed while building the %s, discarding"
+                                % (academy.path, kind))
+                    return False
+                os.chmod(outfile.name, 0o644)
+                os.rename(outfile.name, filename)
+            finally:
+                if os.path.exists(outfile.name):
+                    os.unlink(outfile.name)
+            prefix = kind.encode("ascii") + b"-"
+            for entry in os.listdir(directory):
+                if entry.startswith(prefix) and \
+                        os.path.join(directory, entry) != filename:
+                    os.unlink(os.path.join(directory, entry))
+            return True
+
+    def buildall(self, names=None):
+        """
+        Bring the exports of the given academies up to date. Failures are
+        logged and do not keep the remaining exports from being built.
+
+        @param names: names of the academies; all academies (skipping
+            entries that are not valid academy names) if None
+        @type names: None or [bytes]
+        @returns: whether all exports were built successfully
+        @rtype: bool
+        """
+        if names is None:
+            names = listAcademyNames(self.dfdir)
+        success = True
+        for name in names:
+            academy = self.getAcademy(name)
+            for kind in kinds:
+                try:
+                    self.build(academy, kind)
+                except Exception:
+                    logger.exception("building the %s of %r failed" %
+                                     (kind, academy.path))
+                    success = False
+        return success
+
+    def schedule(self, name):
+        """
+        Rebuild the exports of the given academy after the configured delay.
+        Scheduling again before the delay has passed restarts the delay, so
+        a series of modifications results in a single rebuild.
+
+        @type name: bytes
+        """
+        if self.delay < 0:
+            return
+        with self.timerlock:
+            timer = self.timers.pop(name, None)
+            if timer is not None:
+                timer.cancel()
+            timer = threading.Timer(self.delay, self.scheduled, (name,))
+            timer.daemon = True
+            self.timers[name] = timer
+            timer.start()
+
+    def scheduled(self, name):
+        with self.timerlock:
+            if self.timers.get(name) is threading.current_thread():
+                del self.timers[name]
+        self.buildall([name])
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rebuild the prebuilt exports of academies that are out "
+                    "of date.")
+    parser.add_argument("-c", "--config", default="./dokuforge.conf.sample",
+                        help="dokuforge configuration file")
+    parser.add_argument("-j", "--workers", type=int, default=0,
+                        help="number of worker processes for parsing pages")
+    parser.add_argument("academies", nargs="*", metavar="academy_name",
+                        help="academies to rebuild (default: all)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    pathconfig = PathConfig()
+    pathconfig.read(args.config)
+    builder = ExportBuilder(pathconfig.dfdir, pathconfig.cachedir,
+                            pathconfig.staticexportdir, workers=args.workers,
+                            gziplevel=pathconfig.exportgziplevel,
+                            gzipthreads=pathconfig.exportgzipthreads)
+    if not builder.buildall([name.encode("utf8") for name in args.academies]
+                            or None):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+On disk cache for the tex export of single courses.
+
+The files a course contributes to the tex export are stored as an
+uncompressed tar archive per course. An entry is valid for the revision
+vector of the course (i.e., the head revisions of all its rcs files) and the
+version of the exporter it was generated with. An academy export stitches
+together the cached courses and only regenerates the stale ones.
+"""
+
+from datetime import datetime, timezone
+import hashlib
+import logging
+import os
+import tarfile
+import tempfile
+
+from dokuforge.common import TarWriter
+from dokuforge.storage import rlogv
+try:
+    from dokuforge.versioninfo import commitid
+except ImportError:
+    commitid = u"unknown"
+
+logger = logging.getLogger(__name__)
+
+_sourcedigest = None
+
+def exporterversion():
+    """
+    Identify the version of the exporter. Without version information
+    (e.g., when running from a working copy) a digest of the sources of the
+    dokuforge package is used, so that changes of the code still invalidate
+    the cache.
+
+    @rtype: bytes
+    """
+    global _sourcedigest
+    if commitid != u"unknown":
+        return commitid.encode("ascii")
+    if _sourcedigest is None:
+        digest = hashlib.sha1()
+        packagedir = os.path.dirname(os.path.abspath(__file__))
+        for entry in sorted(os.listdir(packagedir)):
+            if entry.endswith(".py"):
+                digest.update(entry.encode("utf8") + b"\0")
+                with open(os.path.join(packagedir, entry), "rb") as source:
+                    digest.update(source.read())
+        _sourcedigest = digest.hexdigest().encode("ascii")
+    return _sourcedigest
+
+def revisionvector(path):
+    """
+    Reading a missing rcs file creates it with an empty initial revision
+    1.1, while storing content always checks in a later revision. So rcs
+    files still at revision 1.1 are left out, as they look the same as
+    missing ones. Otherwise an export would change the revision vector it
+    was generated for.
+
+    @param path: a directory containing rcs files
+    @type path: bytes
+    @returns: the head revisions of all rcs files in the directory beyond
+        the initial revision as pairs of file name and revision, sorted by
+        file name
+    @rtype: [(bytes, bytes or None)]
+    """
+    vector = []
+    for entry in sorted(os.listdir(path)):
+        if entry.endswith(b",v"):
+            revision = rlogv(os.path.join(path, entry))
+            if revision != b"1.1":
+                vector.append((entry, revision))
+    return vector
+
+class RecordingTarWriter(object):
+    """
+    Stand-in for a TarWriter passing on all added files to the given
+    TarWriter and additionally writing them as tar archive to the given
+    file.
+    """
+    def __init__(self, tarwriter, outfile):
+        """
+        @type tarwriter: TarWriter
+        @param outfile: a file opened for writing bytes
+        """
+        self.tarwriter = tarwriter
+        self.recorder = TarWriter()
+        self.outfile = outfile
+
+    def addChunk(self, name, content, lastchanged):
+        """
+        @type name: bytes
+        @type content: bytes
+        @type lastchanged: datetime
+        @rtype: bytes
+        """
+        self.outfile.write(self.recorder.addChunk(name, content, lastchanged))
+        return self.tarwriter.addChunk(name, content, lastchanged)
+
+    def close(self):
+        """
+        Finish the recorded archive. The wrapped TarWriter is not closed.
+        """
+        self.outfile.write(self.recorder.close())
+
+class ExportCache(object):
+    def __init__(self, cachedir):
+        """
+        @param cachedir: directory for the cache files, it is created when
+            needed
+        @type cachedir: bytes
+        """
+        assert isinstance(cachedir, bytes)
+        self.path = os.path.join(cachedir, b"texexport")
+
+    def key(self, course):
+        """
+        @type course: Course
+        @returns: a key for the current state of the course
+        @rtype: bytes
+        """
+        digest = hashlib.sha1(exporterversion())
+        for entry, revision in revisionvector(course.path):
+            digest.update(b"\0%s\0%s" % (entry, revision or b"none"))
+        return digest.hexdigest().encode("ascii")
+
+    def directory(self, course):
+        """
+        @type course: Course
+        @returns: the directory holding the cache files of the course
+        @rtype: bytes
+        """
+        academyname = os.path.basename(os.path.dirname(course.path))
+        return os.path.join(self.path, academyname, course.name)
+
+    def filename(self, course, key):
+        """
+        @type course: Course
+        @type key: bytes
+        @rtype: bytes
+        """
+        return os.path.join(self.directory(course), key + b".tar")
+
+    def iscached(self, course):
+        """
+        @type course: Course
+        @returns: whether an up to date cache entry exists for the course
+        @rtype: bool
+        """
+        return os.path.isfile(self.filename(course, self.key(course)))
+
+    def replay(self, cachefile, tarwriter):
+        """
+        Add the files recorded in a cache file to the given TarWriter.
+
+        @param cachefile: a cache file opened for reading bytes
+        @type tarwriter: TarWriter
+        @rtype: iter(bytes)
+        """
+        tar = tarfile.open(fileobj=cachefile, mode="r|", encoding="iso8859-1")
+        for info in tar:
+            content = tar.extractfile(info).read()
+            yield tarwriter.addChunk(
+                info.name.encode("iso8859-1"), content,
+                datetime.fromtimestamp(info.mtime, timezone.utc))
+        tar.close()
+
+    def texExportIterator(self, course, tarwriter, pagetexs=None):
+        """
+        yield the contents of the course as tex-export just like
+        Course.texExportIterator, but use the cache entry if it is up to
+        date. Otherwise the contents are generated and a new cache entry is
+        stored, unless the course changed in the meantime.
+
+        @type course: Course
+        @type tarwriter: TarWriter
+        @param pagetexs: passed on to Course.texExportIterator
+        @rtype: iter(bytes)
+        """
+        key = self.key(course)
+        filename = self.filename(course, key)
+        try:
+            cachefile = open(filename, "rb")
+        except IOError:
+            pass
+        else:
+            logger.debug("using cached tex export of %r" % course.path)
+            with cachefile:
+                for chunk in self.replay(cachefile, tarwriter):
+                    yield chunk
+            return
+
+        directory = self.directory(course)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        outfile = tempfile.NamedTemporaryFile(dir=directory, prefix=b".",
+                                              suffix=b".tmp", delete=False)
+        try:
+            with outfile:
+                recorder = RecordingTarWriter(tarwriter, outfile)
+                for chunk in course.texExportIterator(recorder, pagetexs):
+                    yield chunk
+                recorder.close()
+            if self.key(course) != key:
+                logger.info("course %r changed during the export, not caching"
+                            % course.path)
+                return
+            for entry in os.listdir(directory):
+                if entry.endswith(b".tar"):
+                    os.unlink(os.path.join(directory, entry))
+            os.rename(outfile.name, filename)
+        finally:
+            if os.path.exists(outfile.name):
+                os.unlink(outfile.name)
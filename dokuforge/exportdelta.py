@@ -0,0 +1,218 @@
+"""
+Incremental exports containing only the members that changed.
+
+Every export generated by a L{DeltaTarWriter} records a manifest mapping
+each member name to a fingerprint of its contents. The manifest is stored in
+a L{ManifestStore} and identified by a token which is included in the export
+as member TOKEN. A later export given this token only contains the members
+whose fingerprint differs; the names of members that no longer exist are
+listed in the member DELETED. Instead of a token, an export can also be
+restricted to the members modified after a unix timestamp, in which case no
+deletions can be reported. Clients start with since=0 to obtain a full
+export along with a first token.
+"""
+
+from datetime import datetime, timezone
+import calendar
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+
+from dokuforge.common import TarWriter
+
+logger = logging.getLogger(__name__)
+
+tokenpattern = re.compile(r"^[0-9a-f]{40}$")
+timestamppattern = re.compile(r"^[0-9]{1,12}$")
+
+class DeltaTarWriter(TarWriter):
+    """
+    TarWriter leaving out the members that did not change relative to a
+    previous export. The closing chunk contains the members DELETED and
+    TOKEN at the top level of the archive.
+    """
+    def __init__(self, savemanifest, previous=None, since=None, **kwargs):
+        """
+        @param savemanifest: function storing the manifest of this export and
+            returning its token
+        @type savemanifest: {unicode: unicode} -> unicode
+        @param previous: the manifest of the previous export; if given only
+            members with a different fingerprint are added
+        @type previous: None or {unicode: unicode}
+        @param since: if given (and previous is not), only members modified
+            after this unix timestamp are added
+        @type since: None or int
+        @param kwargs: passed on to TarWriter
+        """
+        TarWriter.__init__(self, **kwargs)
+        self.savemanifest = savemanifest
+        self.previous = previous
+        self.since = since
+        self.manifest = dict()
+
+    def changed(self, name, fingerprint, mtime):
+        """
+        Record a member in the manifest and decide whether to add it.
+
+        @type name: bytes
+        @type fingerprint: unicode
+        @type mtime: int or float
+        @rtype: bool
+        """
+        name = self.prefix + name.decode("iso8859-1")
+        self.manifest[name] = fingerprint
+        if self.previous is not None:
+            return self.previous.get(name) != fingerprint
+        if self.since is not None:
+            return mtime > self.since
+        return True
+
+    def addChunk(self, name, content, lastchanged):
+        if self.changed(name, hashlib.sha1(content).hexdigest(),
+                        calendar.timegm(lastchanged.utctimetuple())):
+            return TarWriter.addChunk(self, name, content, lastchanged)
+        return self.read()
+
+    def addFileIterator(self, name, filename):
+        # Reading large static files just to fingerprint them would defeat
+        # the purpose, so size and modification time have to do.
+        st = os.stat(filename)
+        if self.changed(name, u"%d:%r" % (st.st_size, st.st_mtime),
+                        st.st_mtime):
+            for chunk in TarWriter.addFileIterator(self, name, filename):
+                yield chunk
+
+    def deleted(self):
+        """
+        @returns: the members of the previous export missing in this one
+        @rtype: [unicode]
+        """
+        if self.previous is None:
+            return []
+        return sorted(set(self.previous) - set(self.manifest))
+
+    def close(self):
+        token = self.savemanifest(self.manifest)
+        now = datetime.now(timezone.utc)
+        deleted = u"".join(name + u"\n" for name in self.deleted())
+        return TarWriter.addChunk(self, b"DELETED",
+                                  deleted.encode("iso8859-1"), now) + \
+            TarWriter.addChunk(self, b"TOKEN", token.encode("ascii") + b"\n",
+                               now) + \
+            TarWriter.close(self)
+
+class ManifestStore(object):
+    """
+    Keep the manifests of recent delta exports below cachedir/manifests.
+    Only the most recent manifests of every academy and kind of export are
+    retained; older tokens become unknown.
+    """
+    keep = 32
+
+    def __init__(self, cachedir):
+        """
+        @type cachedir: bytes
+        """
+        assert isinstance(cachedir, bytes)
+        self.path = os.path.join(cachedir, b"manifests")
+
+    def directory(self, academyname, kind):
+        """
+        @type academyname: bytes
+        @param kind: name of the kind of export, e.g. texexport or raw
+        @type kind: str
+        @rtype: bytes
+        """
+        return os.path.join(self.path, academyname, kind.encode("ascii"))
+
+    def load(self, academyname, kind, token):
+        """
+        @type academyname: bytes
+        @type kind: str
+        @type token: unicode
+        @returns: the manifest of the given token or None if it is unknown
+        @rtype: None or {unicode: unicode}
+        """
+        if not tokenpattern.match(token):
+            return None
+        filename = os.path.join(self.directory(academyname, kind),
+                                token.encode("ascii") + b".json")
+        try:
+            with open(filename, "rb") as manifestfile:
+                return json.loads(manifestfile.read().decode("utf8"))
+        except IOError:
+            return None
+
+    def save(self, academyname, kind, manifest):
+        """
+        @type academyname: bytes
+        @type kind: str
+        @type manifest: {unicode: unicode}
+        @returns: the token identifying the manifest
+        @rtype: unicode
+        """
+        content = json.dumps(manifest, sort_keys=True).encode("utf8")
+        token = hashlib.sha1(content).hexdigest()
+        directory = self.directory(academyname, kind)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filename = os.path.join(directory, token.encode("ascii") + b".json")
+        if os.path.exists(filename):
+            os.utime(filename, None)
+        else:
+            outfile = tempfile.NamedTemporaryFile(dir=directory, prefix=b".",
+                                                  suffix=b".tmp", delete=False)
+            try:
+                with outfile:
+                    outfile.write(content)
+                os.rename(outfile.name, filename)
+            finally:
+                if os.path.exists(outfile.name):
+                    os.unlink(outfile.name)
+        self.prune(directory)
+        return token
+
+    def prune(self, directory):
+        """
+        Remove all but the most recently used manifests. Concurrent prunes
+        may remove the same files, so vanished files are ignored.
+        """
+        manifests = []
+        for entry in os.listdir(directory):
+            if entry.endswith(b".json"):
+                filename = os.path.join(directory, entry)
+                try:
+                    manifests.append((os.path.getmtime(filename), filename))
+                except OSError:
+                    pass
+        manifests.sort(reverse=True)
+        for _, filename in manifests[self.keep:]:
+            logger.debug("removing old manifest %r" % filename)
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
+    def tarwriter(self, academyname, kind, since, **kwargs):
+        """
+        Create a DeltaTarWriter for an export of the given academy.
+
+        @type academyname: bytes
+        @type kind: str
+        @param since: a token or a unix timestamp
+        @type since: unicode
+        @param kwargs: passed on to TarWriter
+        @returns: the TarWriter or None if since is neither a known token
+            nor a timestamp
+        @rtype: None or DeltaTarWriter
+        """
+        savemanifest = lambda manifest: self.save(academyname, kind, manifest)
+        if timestamppattern.match(since):
+            return DeltaTarWriter(savemanifest, since=int(since), **kwargs)
+        previous = self.load(academyname, kind, since)
+        if previous is None:
+            return None
+        return DeltaTarWriter(savemanifest, previous=previous, **kwargs)
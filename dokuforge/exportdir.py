@@ -0,0 +1,205 @@
+"""
+Write exports straight into a directory instead of a tar archive.
+
+A L{DirWriter} accepts the same calls as a TarWriter, so an export can be
+written to it unchanged. Files whose content did not change are left alone,
+keeping their modification time, so that rebuilding a LaTeX tree from an
+updated export only touches what actually changed. The files written are
+recorded in a manifest. Files listed in the manifest of the previous export
+but not written again, e.g. of a deleted blob, are removed when the writer
+is closed. Anything else in the directory, like the output of a LaTeX run,
+is left alone.
+"""
+
+import calendar
+import errno
+import logging
+import os
+import shutil
+import tempfile
+
+from dokuforge.common import TarWriter
+
+logger = logging.getLogger(__name__)
+
+class DirWriter(TarWriter):
+    """
+    TarWriter placing the members in a directory of the filesystem. All
+    methods generating archive content return or yield empty bytes. Files
+    added from the filesystem (e.g., the static export directory) are
+    hardlinked where possible, so they must not be edited in place in
+    either location.
+    """
+    def __init__(self, path, manifest=None):
+        """
+        @param path: the directory to write to; it is created if missing
+        @type path: bytes
+        @param manifest: file listing the members placed by the previous
+            export; it is replaced by the list of this one on close. Without
+            a manifest no files are removed.
+        @type manifest: None or bytes
+        """
+        assert isinstance(path, bytes)
+        assert manifest is None or isinstance(manifest, bytes)
+        TarWriter.__init__(self)
+        self.path = path
+        self.manifest = manifest
+        self.emitted = set()
+        self.written = 0
+        self.linked = 0
+        self.unchanged = 0
+        self.removed = 0
+
+    def target(self, name):
+        """
+        @type name: bytes
+        @returns: the path a member of the given name is placed at
+        @rtype: bytes
+        """
+        relname = os.path.normpath(self.prefix.encode(self.encoding) + name)
+        self.emitted.add(relname)
+        target = os.path.join(self.path, relname)
+        directory = os.path.dirname(target)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return target
+
+    def replace(self, target, create):
+        """
+        Atomically replace target by a file created at a temporary name.
+        Replacing instead of writing to the existing file also keeps
+        hardlinked files from being modified.
+
+        @type target: bytes
+        @param create: function creating the file at the given name
+        @type create: bytes -> None
+        """
+        directory, basename = os.path.split(target)
+        handle, tmpname = tempfile.mkstemp(dir=directory,
+                                           prefix=b"." + basename,
+                                           suffix=b".tmp")
+        os.close(handle)
+        try:
+            create(tmpname)
+            os.rename(tmpname, target)
+        finally:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+
+    def addChunk(self, name, content, lastchanged):
+        assert isinstance(content, bytes)
+        target = self.target(name)
+        try:
+            if os.path.getsize(target) == len(content):
+                with open(target, "rb") as existing:
+                    if existing.read() == content:
+                        self.unchanged += 1
+                        return b""
+        except OSError:
+            pass
+        mtime = calendar.timegm(lastchanged.utctimetuple())
+        def create(tmpname):
+            with open(tmpname, "wb") as outfile:
+                outfile.write(content)
+            os.chmod(tmpname, 0o644)
+            os.utime(tmpname, (mtime, mtime))
+        self.replace(target, create)
+        self.written += 1
+        return b""
+
+    def addFileIterator(self, name, filename):
+        self.addFile(name, filename)
+        return iter(())
+
+    def addFile(self, name, filename):
+        """
+        Hardlink the given file into the directory or copy it if linking is
+        not possible, e.g., across filesystems.
+
+        @type name: bytes
+        @type filename: bytes
+        """
+        target = self.target(name)
+        try:
+            if os.path.samefile(filename, target):
+                self.unchanged += 1
+                return
+        except OSError:
+            pass
+        def link(tmpname):
+            os.unlink(tmpname)
+            os.link(filename, tmpname)
+        try:
+            self.replace(target, link)
+            self.linked += 1
+            return
+        except OSError as error:
+            if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                                   errno.ENOTSUP):
+                raise
+        logger.debug("cannot hardlink %r, copying it" % filename)
+        st = os.stat(filename)
+        try:
+            if os.path.getsize(target) == st.st_size and \
+                    os.path.getmtime(target) == st.st_mtime:
+                self.unchanged += 1
+                return
+        except OSError:
+            pass
+        def copy(tmpname):
+            shutil.copyfile(filename, tmpname)
+            shutil.copystat(filename, tmpname)
+        self.replace(target, copy)
+        self.written += 1
+
+    def readmanifest(self):
+        """
+        @returns: the members listed in the manifest
+        @rtype: [bytes]
+        """
+        try:
+            with open(self.manifest, "rb") as manifest:
+                content = manifest.read()
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return []
+        return [name for name in content.split(b"\0") if name]
+
+    def removestale(self):
+        """
+        Remove the members of the previous export that were not placed by
+        this writer and the directories left empty by that.
+        """
+        for relname in self.readmanifest():
+            if relname in self.emitted:
+                continue
+            filename = os.path.join(self.path, relname)
+            try:
+                os.unlink(filename)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+                continue
+            self.removed += 1
+            directory = os.path.dirname(relname)
+            while directory:
+                try:
+                    os.rmdir(os.path.join(self.path, directory))
+                except OSError: # not empty
+                    break
+                directory = os.path.dirname(directory)
+
+    def close(self):
+        assert not self.dirs
+        if self.manifest is not None:
+            self.removestale()
+            def create(tmpname):
+                with open(tmpname, "wb") as manifest:
+                    for relname in sorted(self.emitted):
+                        manifest.write(relname + b"\0")
+            self.replace(self.manifest, create)
+        logger.debug("%r: %d files written, %d linked, %d unchanged, "
+                     "%d removed" % (self.path, self.written, self.linked,
+                                     self.unchanged, self.removed))
+        return b""
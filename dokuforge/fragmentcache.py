@@ -0,0 +1,104 @@
+"""
+In memory cache for rendered fragments of the HTML views.
+
+Rendering the body of a page or the outline of a course requires checking
+out and parsing the pages involved, while the result only changes when
+their rcs files do. The fragments are therefore kept in a L{FragmentCache}
+keyed by the state of these files as obtained from L{filestate}, which only
+needs a stat per file. The surrounding parts of a view depending on the user
+are rendered for every request.
+"""
+
+import collections
+import datetime
+import hashlib
+import os
+import threading
+
+def filestate(filenames):
+    """
+    @type filenames: [bytes]
+    @returns: a digest of the names, sizes and modification times of the
+        given files and the latest modification time. Missing files are
+        included in the digest as such.
+    @rtype: (str, datetime)
+    """
+    digest = hashlib.sha1()
+    lastmodified = datetime.datetime.fromtimestamp(0, datetime.timezone.utc)
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            digest.update(b"\0%s\0missing" % filename)
+            continue
+        digest.update(b"\0%s\0%d\0%d" % (filename, st.st_size,
+                                          st.st_mtime_ns))
+        lastmodified = max(lastmodified, datetime.datetime.fromtimestamp(
+            st.st_mtime, datetime.timezone.utc))
+    return digest.hexdigest(), lastmodified
+
+def directorystate(directories):
+    """
+    @type directories: [bytes]
+    @returns: the filestate of all rcs files in the given directories
+    @rtype: (str, datetime)
+    """
+    filenames = []
+    for directory in directories:
+        filenames.extend(os.path.join(directory, entry)
+                         for entry in sorted(os.listdir(directory))
+                         if entry.endswith(b",v"))
+    return filestate(filenames)
+
+class FragmentCache(object):
+    """
+    Least recently used cache of rendered fragments bounded by the total
+    size of the fragments. It may be shared between threads.
+    """
+    def __init__(self, maxsize):
+        """
+        @param maxsize: the maximum number of bytes of the utf8 encoded
+            fragments kept; 0 disables caching
+        @type maxsize: int
+        """
+        self.maxsize = maxsize
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, key, generate):
+        """
+        @param key: identifies the fragment and everything it depends on
+        @type key: hashable
+        @param generate: function rendering the fragment if it is not cached
+        @type generate: () -> unicode
+        @rtype: unicode
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry[0]
+        fragment = generate()
+        self.store(key, fragment)
+        return fragment
+
+    def store(self, key, fragment):
+        """
+        Add a fragment evicting the least recently used ones as needed.
+
+        @type key: hashable
+        @type fragment: unicode
+        """
+        size = len(fragment.encode("utf8"))
+        if size > self.maxsize:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self.entries[key] = (fragment, size)
+            self.size += size
+            while self.size > self.maxsize:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
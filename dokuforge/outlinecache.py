@@ -0,0 +1,148 @@
+"""
+On disk record of the outlines of courses.
+
+Showing a course requires the headings and estimates of all its pages and
+the last commit of each of them, i.e., parsing every page and running rlog
+for it. The L{OutlineCache} keeps this information per course in a small
+json file below the cache directory. Each entry is stored along with the
+filestate of the rcs file it was derived from, so after a modification only
+the affected pages are parsed again and a course that did not change is
+outlined without running rcs at all.
+"""
+
+import calendar
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import tempfile
+
+from dokuforge.course import Outline
+from dokuforge.exportcache import exporterversion
+from dokuforge.fragmentcache import filestate
+from dokuforge.parser import Estimate
+
+logger = logging.getLogger(__name__)
+
+class OutlineCache(object):
+    def __init__(self, cachedir):
+        """
+        @param cachedir: directory for the cache files, it is created when
+            needed
+        @type cachedir: bytes
+        """
+        assert isinstance(cachedir, bytes)
+        self.path = os.path.join(cachedir, b"outline")
+
+    def filename(self, course):
+        """
+        @type course: Course
+        @returns: the file holding the record of the course
+        @rtype: bytes
+        """
+        academyname = os.path.basename(os.path.dirname(course.path))
+        return os.path.join(self.path, academyname, course.name + b".json")
+
+    def load(self, course):
+        """
+        @type course: Course
+        @returns: the record of the course or None if there is no usable one
+        @rtype: None or dict
+        """
+        try:
+            with open(self.filename(course), "rb") as recordfile:
+                record = json.loads(recordfile.read().decode("utf8"))
+        except (IOError, ValueError):
+            return None
+        if record.get("version") != exporterversion().decode("ascii"):
+            return None
+        return record
+
+    def save(self, course, record):
+        """
+        @type course: Course
+        @type record: dict
+        """
+        filename = self.filename(course)
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        outfile = tempfile.NamedTemporaryFile(dir=directory, prefix=b".",
+                                              suffix=b".tmp", delete=False)
+        try:
+            with outfile:
+                outfile.write(json.dumps(record, sort_keys=True).encode("utf8"))
+            os.rename(outfile.name, filename)
+        finally:
+            if os.path.exists(outfile.name):
+                os.unlink(outfile.name)
+
+    def update(self, course):
+        """
+        Bring the record of the course up to date. Only the pages whose rcs
+        files changed since they were recorded are parsed again.
+
+        @type course: Course
+        @returns: the record of the course
+        @rtype: dict
+        """
+        record = self.load(course)
+        if record is None:
+            record = dict(version=exporterversion().decode("ascii"),
+                          index=dict(state=None, pages=[]), pages=dict())
+        modified = False
+        # The states are obtained before reading the files, so that a
+        # concurrent modification is detected by the next update.
+        indexstate = filestate([course.getstorage(b"Index").fullpath(
+            postfix=b",v")])[0]
+        if record["index"]["state"] != indexstate:
+            pages = []
+            for line in course.getcontent(b"Index").splitlines():
+                entries = line.split()
+                if entries:
+                    pages.append([int(x) for x in entries])
+            record["index"] = dict(state=indexstate, pages=pages)
+            modified = True
+        states = dict()
+        for entry in record["index"]["pages"]:
+            pagefile = course.getstorage((u"page%d" % entry[0]).encode("ascii"))
+            states[u"%d" % entry[0]] = filestate([pagefile.fullpath(
+                postfix=b",v")])[0]
+        stale = [int(p) for p, state in states.items()
+                 if record["pages"].get(p, dict()).get("state") != state]
+        if stale:
+            logger.debug("outlining %d pages of %r" % (len(stale), course.path))
+            for p, commit in zip(stale, course.getcommits(stale)):
+                outline = course.parseoutline(p)
+                commit["date"] = calendar.timegm(commit["date"].utctimetuple())
+                record["pages"][u"%d" % p] = dict(
+                    state=states[u"%d" % p], headings=outline.items(),
+                    estimate=list(outline.estimate), commit=commit)
+            modified = True
+        if set(record["pages"]) != set(states):
+            record["pages"] = dict((p, record["pages"][p]) for p in states)
+            modified = True
+        if modified:
+            self.save(course, record)
+        return record
+
+    def outlines(self, course):
+        """
+        @type course: Course
+        @returns: the same as Course.outlinepages
+        @rtype: [Outline]
+        """
+        record = self.update(course)
+        outlines = []
+        for entry in record["index"]["pages"]:
+            page = record["pages"][u"%d" % entry[0]]
+            outline = Outline(entry[0])
+            outline.content = [tuple(heading) for heading in page["headings"]]
+            outline.addEstimate(Estimate(*page["estimate"]) +
+                                Estimate.fromBlobs(entry[1:]))
+            commit = dict(page["commit"])
+            commit["date"] = datetime.fromtimestamp(commit["date"],
+                                                    timezone.utc)
+            outline.addcommitinfo(commit)
+            outlines.append(outline)
+        return outlines
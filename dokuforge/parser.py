@@ -1,17 +1,27 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import collections
-import functools
 import itertools
-import textwrap
+import logging
 import math
 import re
+import sys
+import time
 
 try:
     unicode
 except NameError:
     unicode = str
 
+try:
+    intern = sys.intern
+except AttributeError:
+    def intern(s):
+        # the python2 builtin intern only accepts byte strings
+        return s
+
+logger = logging.getLogger(__name__)
+
 ## How To Read This File?
 ##
 ## Everything is sorted in dependency order, but the
@@ -100,16 +110,105 @@ class Estimate(collections.namedtuple("Estimate",
                 * self.charsperline
         return Estimate(self.chars, self.ednotechars, weightedchars, self.blobs)
 
+    @classmethod
+    def sum(cls, estimates):
+        """
+        Add up the given estimates without creating intermediate tuples.
+
+        @type estimates: iter(Estimate)
+        @rtype: Estimate
+        """
+        chars = ednotechars = weightedchars = blobs = 0
+        for c, e, w, b in estimates:
+            chars += c
+            ednotechars += e
+            weightedchars += w
+            blobs += b
+        return tuple.__new__(cls, (chars, ednotechars, weightedchars, blobs))
+
     def __add__(self, other):
-        return Estimate(*[a + b for a, b in zip(self, other)])
+        return tuple.__new__(Estimate, (self[0] + other[0],
+                                        self[1] + other[1],
+                                        self[2] + other[2],
+                                        self[3] + other[3]))
 
     def __mul__(self, num):
-        return Estimate(*[num * field for field in self])
+        return tuple.__new__(Estimate, (num * self[0], num * self[1],
+                                        num * self[2], num * self[3]))
 
     __rmul__ = __mul__
 
+class Budget(object):
+    """
+    Limits on the work spent on parsing and typesetting a single text.
+    Parts of the text exceeding the budget are not parsed, but escaped
+    as plain text instead. This way a single pathological input (e.g.,
+    a huge line pasted into a page) cannot stall the parser. Limits
+    set to None are not enforced.
+
+    @ivar maxgroupchars: maximal length of a single line group that is
+        still processed normally
+    @type maxgroupchars: None or int
+    @ivar maxchars: maximal number of characters processed normally in total
+    @type maxchars: None or int
+    @ivar deadline: point in time (as returned by time.time) after which
+        nothing more is processed normally
+    @type deadline: None or float
+    @ivar used: number of characters processed normally so far
+    @type used: int
+    @ivar hits: the texts that exceeded the budget as pairs of the reason
+        and the length of the text
+    @type hits: [(str, int)]
+    """
+    __slots__ = ("maxgroupchars", "maxchars", "deadline", "context", "used",
+                 "hits")
+
+    def __init__(self, maxgroupchars=50000, maxchars=500000, timeout=None,
+                 context=None):
+        """
+        @param timeout: number of seconds, counted from now, after which
+            nothing more is processed normally
+        @type timeout: None or float
+        @param context: description of the processed text used in log
+            messages about exceeding the budget
+        @type context: None or str
+        """
+        self.maxgroupchars = maxgroupchars
+        self.maxchars = maxchars
+        self.deadline = None if timeout is None else time.time() + timeout
+        self.context = context
+        self.used = 0
+        self.hits = []
+
+    def charge(self, text):
+        """
+        Account for processing the given text normally, if the budget
+        allows for it.
+
+        @type text: unicode
+        @returns: whether the text may be processed normally; if not, the
+            hit is recorded and logged
+        @rtype: bool
+        """
+        n = len(text)
+        if self.maxgroupchars is not None and n > self.maxgroupchars:
+            reason = "group too long"
+        elif self.maxchars is not None and self.used + n > self.maxchars:
+            reason = "total size exceeded"
+        elif self.deadline is not None and time.time() > self.deadline:
+            reason = "time exceeded"
+        else:
+            self.used += n
+            return True
+        self.hits.append((reason, n))
+        logger.warning("parser budget hit (%s) for %d characters of %s",
+                       reason, n, self.context or "unknown text")
+        return False
+
 # class for strings that shall not be modified further
 class TerminalString(object):
+    __slots__ = ("theString",)
+
     def __init__(self, s):
         self.theString = s
     def getString(self):
@@ -518,6 +617,10 @@ class ReplaceSuspiciousCharacter:
         self.badSigns = badSigns
         self.replacement = replacement
 
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__.__name__, self.badSigns,
+                               self.replacement)
+
     def __call__(self, word):
         if word in self.badSigns:
            yield TerminalString(u'\\@\\@' + self.replacement)
@@ -532,6 +635,9 @@ class PunctuationQuotationMark:
     def __init__(self, punctuation):
         self.punctuation = punctuation
 
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.punctuation)
+
     def __call__(self, word):
         quotes = [u'"'] + list(unicodeQuotationMarks)
         if (   len(word) == 2 ) and ( word[0] in self.punctuation ) and ( word[1] in quotes ):
@@ -730,6 +836,9 @@ class SplitSeparators:
     def __init__(self, separators, regex='([%s])'):
         self.splitre = re.compile( regex % re.escape(separators))
 
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.splitre.pattern)
+
     def __call__(self, word):
         return self.splitre.split(word)
 
@@ -776,6 +885,31 @@ def applyMicrotypefeatures(wordlist, featurelist):
             finallist.append(word)
     return ''.join(finallist)
 
+_plaintexescapes = {
+    ord(u'\\'): u'\\@\\backslash{}',
+    ord(u'$'): u'\\$',
+    ord(u'_'): u'\\_',
+    ord(u'%'): u'\\%',
+    ord(u'&'): u'\\@\\&',
+    ord(u'#'): u'\\@\\#',
+    ord(u'{'): u'\\@\\{',
+    ord(u'}'): u'\\@\\}',
+    ord(u'^'): u'\\@\\caret{}',
+    ord(u'~'): u'\\@~',
+    ord(u'"'): u"\\@''",
+    ord(u"'"): u"\\@'",
+}
+
+def escapePlainTex(text):
+    """
+    Escape text for TeX without applying any microtypography. This is
+    the fast path for texts exceeding the parser budget.
+
+    @type text: unicode
+    @rtype: unicode
+    """
+    return text.translate(_plaintexescapes)
+
 def defaultMicrotype(text):
     """
     @type text: unicode
@@ -828,23 +962,100 @@ def ednoteMicrotype(text):
 def isemptyline(line):
     return re.match('^\\s*$', line)
 
+_wrapwidth = 70
+_wrapmarker = u'\\@\\@\\@'
+_wrapwhitespace = dict((ord(c), u' ') for c in u'\t\n\x0b\x0c\r')
+_wrapnonspace = re.compile(u'[^ ]')
+
+def _wrapchunkend(text, start):
+    """
+    Return the end of the run of spaces or of non-spaces at start.
+    """
+    if text[start] == u' ':
+        match = _wrapnonspace.search(text, start)
+        return len(text) if match is None else match.start()
+    end = text.find(u' ', start)
+    return len(text) if end < 0 else end
+
 def wrap(text, subsequent_indent=''):
     """
     Wraps text to width 70.
+
+    The result is the same as the one of textwrap.fill with
+    break_long_words and break_on_hyphens disabled, i.e., whitespace is
+    dropped at line boundaries and words are never split. However, the
+    text is scanned only once, looking up the last possible break of every
+    line directly instead of splitting the text into words first.
     """
     # triple \@ to label linebreaks where we suspect the author forgot a double line break to indicate a new paragraph
-    text = re.sub(r'([^\n]{160})\n', r'\1\\@\\@\\@\n', text)
-    text = re.sub(r'\n([^\n]{160})', r'\\@\\@\\@\n\1', text)
-    text = re.sub(r'\\@\\@\\@\\@\\@\\@', r'\\@\\@\\@', text)
-    result = textwrap.fill(text, width=70, subsequent_indent=subsequent_indent,
-                           drop_whitespace = True, replace_whitespace = True,
-                           break_long_words = False, break_on_hyphens = False)
-    return result
+    if len(text) > 160:
+        rawlines = text.split(u'\n')
+        islong = [len(line) >= 160 for line in rawlines]
+        if len(rawlines) > 1 and any(islong):
+            pieces = [rawlines[0]]
+            for i in range(1, len(rawlines)):
+                pieces.append(_wrapmarker * (islong[i - 1] + islong[i]))
+                pieces.append(u'\n')
+                pieces.append(rawlines[i])
+            text = u''.join(pieces)
+    if u'\\@\\@\\@\\@\\@\\@' in text:
+        text = text.replace(u'\\@\\@\\@\\@\\@\\@', _wrapmarker)
+
+    if u'\t' in text:
+        text = text.expandtabs()
+    text = text.translate(_wrapwhitespace)
+    # The text consists of chunks, i.e., maximal runs of spaces or of other
+    # characters. Lines are filled greedily with whole chunks.
+    length = len(text)
+    lines = []
+    start = 0
+    while start < length:
+        if lines:
+            indent = subsequent_indent
+            # drop whitespace at the beginning of all but the first line
+            if text[start].isspace():
+                end = _wrapchunkend(text, start)
+                if not text[start:end].strip():
+                    start = end
+                    if start == length:
+                        break
+        else:
+            indent = u''
+        # find the last chunk boundary within the line width
+        limit = start + _wrapwidth - len(indent)
+        if limit >= length:
+            end = length
+        elif text[limit] != u' ':
+            end = text.rfind(u' ', start, limit) + 1
+        elif text[limit - 1] != u' ':
+            end = limit
+        else:
+            end = start + len(text[start:limit].rstrip(u' '))
+        if end <= start:
+            # a word longer than the line, which we must not break
+            end = _wrapchunkend(text, start)
+        # drop whitespace at the end of the line
+        if text[end - 1] == u' ':
+            line = text[start:end].rstrip(u' ')
+        elif text[end - 1].isspace():
+            wordstart = max(text.rfind(u' ', start, end) + 1, start)
+            if text[wordstart:end].strip():
+                line = text[start:end]
+            else:
+                line = text[start:wordstart]
+        else:
+            line = text[start:end]
+        if line:
+            lines.append(indent + line)
+        start = end
+    return u'\n'.join(lines)
 
-class PTree:
+class PTree(object):
     """
     Abstract class where all parsed objects inherit from.
     """
+    __slots__ = ()
+
     def debug(self):
         return None
 
@@ -888,6 +1099,8 @@ class PSequence(PTree):
     A piece of text formed by juxtaposition of several
     Parse Trees (usually paragraphs).
     """
+    __slots__ = ("parts",)
+
     def __init__(self, parts):
         self.parts = parts
 
@@ -919,16 +1132,21 @@ class PSequence(PTree):
         return result
 
     def toEstimate(self):
-        return functools.reduce(lambda a, b: a + b,
-                      (part.toEstimate() for part in self.parts),
-                      Estimate.fromNothing())
+        return Estimate.sum(part.toEstimate() for part in self.parts)
 
 class PLeaf(PTree):
     """
     A piece of text that contains no further substructure.
     """
+    __slots__ = ("text",)
+
     def __init__(self, text):
         assert isinstance(text, unicode)
+        # leaves frequently repeat short texts like spaces and newlines;
+        # long texts are kept as they are, as interned strings may never
+        # be freed
+        if len(text) <= 16:
+            text = intern(text)
         self.text = text
 
     def debug(self):
@@ -959,6 +1177,8 @@ class PUrl(PTree):
     """
     A uniform resource locator.
     """
+    __slots__ = ("text",)
+
     def __init__(self, text):
         self.text = PLeaf(text)
 
@@ -1000,6 +1220,8 @@ class PEmph(PTree):
     """
     An emphasized piece of text.
     """
+    __slots__ = ("text",)
+
     def __init__(self, text):
         self.text = PLeaf(text)
 
@@ -1022,6 +1244,8 @@ class PMath(PTree):
     """
     An non-display math area.
     """
+    __slots__ = ("text",)
+
     def __init__(self, text):
         self.text = PLeaf(text)
 
@@ -1044,6 +1268,8 @@ class PDisplayMath(PTree):
     """
     An display math area.
     """
+    __slots__ = ("text",)
+
     def __init__(self, text):
         self.text = PLeaf(text)
 
@@ -1098,6 +1324,8 @@ class PEdnote(PTree):
     """
     An Ednote; contents are compeletly unchanged.
     """
+    __slots__ = ("text",)
+
     def __init__(self, text):
         self.text = PLeaf(text)
 
@@ -1128,6 +1356,8 @@ class PEdnote(PTree):
         return Estimate.fromEdnote(self.text.text)
 
 class PParagraph(PTree):
+    __slots__ = ("it",)
+
     def __init__(self, subtree):
         self.it = subtree
 
@@ -1161,6 +1391,8 @@ class PParagraph(PTree):
         return self.it.toEstimate().fullline()
 
 class PHeading(PTree):
+    __slots__ = ("subtree", "level")
+
     def __init__(self, subtree, level):
         self.subtree = subtree
         self.level = level
@@ -1189,6 +1421,8 @@ class PHeading(PTree):
         return Estimate.fromTitle(self.subtree.toDF())
 
 class PAuthor(PTree):
+    __slots__ = ("author",)
+
     def __init__(self, author):
         self.author = PLeaf(author)
 
@@ -1211,6 +1445,8 @@ class PAuthor(PTree):
         return Estimate.fromParagraph(self.getAuthor())
 
 class PDescription(PTree):
+    __slots__ = ("key", "value")
+
     def __init__(self, key, value):
         self.key = key
         self.value = value
@@ -1231,6 +1467,8 @@ class PDescription(PTree):
         return self.key.toEstimate() + self.value.toEstimate()
 
 class PItemize(PTree):
+    __slots__ = ("items", "isEnum")
+
     def __init__(self, items):
         self.items = items
         self.isEnum = False
@@ -1262,12 +1500,12 @@ class PItemize(PTree):
         return u"\n" + u"".join(item.toDF() for item in self.items)
 
     def toEstimate(self):
-        return functools.reduce(lambda a, b: a + b + Estimate.emptyLines(0.5),
-                      [item.toEstimate() for item in self.items],
-                      Estimate.fromNothing()) + \
-                Estimate.emptyLines(2)
+        return Estimate.sum(item.toEstimate() for item in self.items) + \
+                Estimate.emptyLines(0.5 * len(self.items) + 2)
 
 class PItem(PTree):
+    __slots__ = ("it", "number")
+
     def __init__(self, subtree, number=None):
         self.it = subtree
         self.number=number
@@ -1297,7 +1535,37 @@ class PItem(PTree):
     def toEstimate(self):
         return self.it.toEstimate()
 
-class Chargroup:
+class PUnparsed(PTree):
+    """
+    A piece of text that was not parsed because it exceeded the parser
+    budget. It is exported as escaped plain text.
+    """
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        assert isinstance(text, unicode)
+        self.text = text
+
+    def debug(self):
+        return ('Unparsed', self.text)
+
+    def isEmpty(self):
+        return isemptyline(self.text)
+
+    def toTex(self):
+        return u'\n%% text too large, exported without markup\n%s\n' % \
+                wrap(escapePlainTex(self.text))
+
+    def toHtml(self):
+        return u'\n<p>\n%s\n</p>\n' % PLeaf(self.text).toHtml()
+
+    def toDF(self):
+        return u'\n\n%s\n' % self.text
+
+    def toEstimate(self):
+        return Estimate.fromText(self.text).fullline()
+
+class Chargroup(object):
     """
     Abstract class where all char-groups inherit from.
 
@@ -1305,6 +1573,8 @@ class Chargroup:
     a line group, forming a logical unit within that line
     group, like an emphasis, or a math environment.
     """
+    __slots__ = ("text",)
+
     def __init__(self, initial=None):
         self.text = u''
         if initial is not None:
@@ -1350,6 +1620,8 @@ class Simplegroup(Chargroup):
     """
     The default char group, without any special markup.
     """
+    __slots__ = ()
+
     def __init__(self, initial=None):
         Chargroup.__init__(self, initial=initial)
 
@@ -1358,6 +1630,8 @@ class Urlgroup(Chargroup):
     The group for uniform resource locators starting with 'http://',
     'https://' or 'www.'.
     """
+    __slots__ = ()
+
     def __init__(self, initial=None):
         Chargroup.__init__(self, initial=initial)
 
@@ -1388,6 +1662,8 @@ class Emphgroup(Chargroup):
     """
     The group for _emphasized text_.
     """
+    __slots__ = ()
+
     def __init__(self, initial=None):
         Chargroup.__init__(self, initial=initial)
 
@@ -1418,6 +1694,8 @@ class Mathgroup(Chargroup):
     The group for simple (non dislay) math,
     like $a^2 + b^2$.
     """
+    __slots__ = ("trailingbackslashs", "done", "count")
+
     def __init__(self, initial=None):
         self.trailingbackslashs = 0
         self.done = False
@@ -1461,6 +1739,8 @@ class DisplayMathGroup(Chargroup):
     The group for display math
     like $$ a^2 + b^2 = c^2$$
     """
+    __slots__ = ("done", "trailingbackslashs", "trailingdollar", "count")
+
     def __init__(self, initial=None):
         self.done = False
         self.trailingbackslashs = 0
@@ -1560,7 +1840,7 @@ def headingParse(line):
     return defaultInnerParse([line], features=(Simplegroup, Emphgroup))
 
 
-class Linegroup:
+class Linegroup(object):
     """
     Abstract class where all line-groups inherit from.
 
@@ -1574,6 +1854,8 @@ class Linegroup:
     item-entries cann be grouped to an itemization environment, thus
     yielding a parse tree of the whole dokument.
     """
+    __slots__ = ("lines",)
+
     def __init__(self):
         self.lines = []
 
@@ -1619,6 +1901,8 @@ class Paragraph(Linegroup):
     A standard paragraph. This hopefully should be the most common
     line group in a document.
     """
+    __slots__ = ()
+
     def __init__(self):
         Linegroup.__init__(self)
 
@@ -1693,6 +1977,8 @@ class Ednote(Linegroup):
     Notes to the editor; also used to enter text without any changes or
     further parsing. May contain empty lines.
     """
+    __slots__ = ()
+
     def __init__(self):
         Linegroup.__init__(self)
 
@@ -1735,6 +2021,8 @@ class Heading(Linegroup):
     """
     Headings, marked [As such] in dokuforge
     """
+    __slots__ = ()
+
     def __init__(self):
         Linegroup.__init__(self)
 
@@ -1766,6 +2054,8 @@ class Subheading(Heading):
     """
     Subheadings, markes [[as such]] in dokuforge
     """
+    __slots__ = ()
+
     def __init__(self):
         Heading.__init__(self)
 
@@ -1780,6 +2070,8 @@ class Author(Linegroup):
     """
     List of authors, marked (Some Author) in dokuforge
     """
+    __slots__ = ()
+
     def __init__(self):
         Linegroup.__init__(self)
 
@@ -1812,6 +2104,8 @@ class Item(Linegroup):
     - third
     in DokuForge.
     """
+    __slots__ = ()
+
     def __init__(self):
         Linegroup.__init__(self)
 
@@ -1837,6 +2131,8 @@ class EnumerateItem(Linegroup):
     3. and so on
     in DokuForge
     """
+    __slots__ = ()
+
     def __init__(self):
         Linegroup.__init__(self)
 
@@ -1860,6 +2156,8 @@ class Description(Linegroup):
     """
     *Description* explain a word in a gloassary
     """
+    __slots__ = ()
+
     def __init__(self):
         Linegroup.__init__(self)
 
@@ -1952,6 +2250,8 @@ dffeatures =  [Paragraph, Heading, Author, Subheading, Item, EnumerateItem, Desc
 
 
 class PSequenceWithAuthorPostprocessing(PSequence):
+    __slots__ = ()
+
     def __init__(self, parts):
         PSequence.__init__(self, parts)
 
@@ -1966,12 +2266,31 @@ class PSequenceWithAuthorPostprocessing(PSequence):
         return result
 
 
-def dfLineGroupParser(text):
+def budgetedParse(linegroup, budget):
+    """
+    Parse the given line group, unless it exceeds the budget.
+
+    @type linegroup: Linegroup
+    @type budget: None or Budget
+    @rtype: PTree
+    """
+    if budget is None:
+        return linegroup.parse()
+    text = u'\n'.join(linegroup.lines)
+    if budget.charge(text):
+        return linegroup.parse()
+    return PUnparsed(text)
+
+def dfLineGroupParser(text, budget=None):
     """
     @type text: unicode
+    @param budget: limits the line groups that are parsed; those exceeding
+        it are kept as plain text. As the parsed line groups are
+        bounded, so is the work needed for typesetting the result.
+    @type budget: None or Budget
     """
     groups = grouplines(text.splitlines(), dffeatures)
-    ptrees = [g.parse() for g in groups]
+    ptrees = [budgetedParse(g, budget) for g in groups]
     ptrees = groupItems(ptrees)
     ptrees = removeEmpty(ptrees)
     return PSequenceWithAuthorPostprocessing(ptrees)
@@ -1989,6 +2308,8 @@ captionfeatures =  [Paragraph, Item, EnumerateItem, Description, Ednote]
 
 
 class PSequenceWithCaptionPostprocessing(PSequence):
+    __slots__ = ()
+
     def __init__(self, parts):
         PSequence.__init__(self, parts)
 
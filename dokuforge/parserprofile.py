@@ -0,0 +1,213 @@
+"""
+Opt-in instrumentation of the parser and the microtypography.
+
+While a L{ParserProfile} is enabled, the relevant functions and methods of
+dokuforge.parser are replaced by instrumented versions recording call counts
+and cumulative times. Disabling the profile restores the original functions,
+so there is no overhead at all when not profiling. Profiling is per process,
+so parallel exports have to be profiled with a serial run.
+
+Usage::
+
+    with ParserProfile() as profile:
+        dfLineGroupParser(text).toTex()
+    profile.report()
+"""
+
+import functools
+import time
+
+import dokuforge.parser as parser
+from dokuforge.parser import TerminalString
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
+groupmethods = ("startshere", "enforcecontinuation", "rejectcontinuation",
+                "append", "appendline", "parse")
+predicates = ("startshere", "enforcecontinuation", "rejectcontinuation")
+
+class ParserProfile(object):
+    """
+    Collect statistics about the parser. The statistics are grouped into
+    sections:
+     - features: the microtype features used in applyMicrotypefeatures;
+       tokens counts the produced tokens
+     - chargroups, linegroups: the methods of the Chargroup and Linegroup
+       classes used in groupchars and grouplines, keyed by the class of
+       the object actually used; hits counts the true results of the
+       predicates like startshere
+     - totex: toTex keyed by the PTree class; times include the children
+     - functions: the entry points groupchars and grouplines
+
+    Every entry records calls and time (in seconds). Recursive calls with
+    the same key are counted, but their time is only accounted once.
+    """
+    active = None
+
+    def __init__(self):
+        self.stats = dict((section, {}) for section in
+                          ("features", "chargroups", "linegroups", "totex",
+                           "functions"))
+        self.originals = []
+        self.running = set()
+        self.featurenames = {}
+
+    def entry(self, section, key):
+        try:
+            return self.stats[section][key]
+        except KeyError:
+            entry = self.stats[section][key] = dict(calls=0, time=0.)
+            return entry
+
+    def featurename(self, feature):
+        """
+        @returns: a name for a microtype feature; global features are named
+            like the variable holding them
+        @rtype: str
+        """
+        try:
+            return self.featurenames[id(feature)]
+        except KeyError:
+            pass
+        if hasattr(feature, "__name__"):
+            return feature.__name__
+        return repr(feature)
+
+    def timed(self, section, key, function, *args, **kwargs):
+        entry = self.entry(section, key)
+        entry["calls"] += 1
+        if (section, key) in self.running:
+            return function(*args, **kwargs)
+        self.running.add((section, key))
+        start = timer()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            entry["time"] += timer() - start
+            self.running.discard((section, key))
+
+    def applyMicrotypefeatures(self, wordlist, featurelist):
+        """
+        Instrumented version of parser.applyMicrotypefeatures. The results
+        of every feature are materialized, so that its time is measured.
+        """
+        for feature in featurelist:
+            entry = self.entry("features", self.featurename(feature))
+            entry.setdefault("tokens", 0)
+            result = []
+            for word in wordlist:
+                if isinstance(word, TerminalString):
+                    result.append(word)
+                    continue
+                assert isinstance(word, unicode)
+                start = timer()
+                tokens = list(feature(word))
+                entry["time"] += timer() - start
+                entry["calls"] += 1
+                entry["tokens"] += len(tokens)
+                result.extend(tokens)
+            wordlist = result
+        return ''.join(word.getString() if isinstance(word, TerminalString)
+                       else word for word in wordlist)
+
+    def wrapmethod(self, section, name, function, isclassmethod):
+        profile = self
+        if name in predicates:
+            def wrapper(first, *args, **kwargs):
+                cls = first if isclassmethod else first.__class__
+                key = "%s.%s" % (cls.__name__, name)
+                result = profile.timed(section, key, function, first, *args,
+                                       **kwargs)
+                if result:
+                    entry = profile.entry(section, key)
+                    entry["hits"] = entry.get("hits", 0) + 1
+                return result
+        else:
+            def wrapper(first, *args, **kwargs):
+                cls = first if isclassmethod else first.__class__
+                if section == "totex":
+                    key = cls.__name__
+                else:
+                    key = "%s.%s" % (cls.__name__, name)
+                return profile.timed(section, key, function, first, *args,
+                                     **kwargs)
+        functools.update_wrapper(wrapper, function)
+        return wrapper
+
+    def patch(self, owner, name, replacement):
+        """
+        Replace an attribute of a class or module until disable is called.
+        """
+        self.originals.append((owner, name, owner.__dict__[name]))
+        setattr(owner, name, replacement)
+
+    def patchmethods(self, cls, section, names):
+        for name in names:
+            if name not in cls.__dict__:
+                continue
+            method = cls.__dict__[name]
+            if isinstance(method, classmethod):
+                wrapper = self.wrapmethod(section, name, method.__func__, True)
+                self.patch(cls, name, classmethod(wrapper))
+            else:
+                self.patch(cls, name,
+                           self.wrapmethod(section, name, method, False))
+
+    def enable(self):
+        """
+        Install the instrumentation. Only one profile can be enabled at a
+        time.
+        """
+        assert ParserProfile.active is None
+        ParserProfile.active = self
+        self.featurenames = dict((id(value), name) for name, value
+                                 in vars(parser).items() if callable(value))
+        self.patch(parser, "applyMicrotypefeatures",
+                   self.applyMicrotypefeatures)
+        for name in ("groupchars", "grouplines"):
+            self.patch(parser, name, functools.partial(
+                self.timed, "functions", name, getattr(parser, name)))
+        for value in list(vars(parser).values()):
+            if not isinstance(value, type):
+                continue
+            if issubclass(value, parser.Chargroup):
+                self.patchmethods(value, "chargroups", groupmethods)
+            elif issubclass(value, parser.Linegroup):
+                self.patchmethods(value, "linegroups", groupmethods)
+            elif issubclass(value, parser.PTree):
+                self.patchmethods(value, "totex", ("toTex",))
+
+    def disable(self):
+        """
+        Remove the instrumentation and restore the original functions.
+        """
+        assert ParserProfile.active is self
+        while self.originals:
+            owner, name, original = self.originals.pop()
+            setattr(owner, name, original)
+        ParserProfile.active = None
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disable()
+
+    def report(self):
+        """
+        @returns: the collected statistics as section -> key -> entry, where
+            an entry maps calls, time and possibly tokens or hits to numbers
+        @rtype: {str: {str: {str: int or float}}}
+        """
+        return dict((section, dict((key, dict(entry))
+                                   for key, entry in entries.items()))
+                    for section, entries in self.stats.items())
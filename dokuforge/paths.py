@@ -3,6 +3,7 @@ try:
 except ImportError:
     from configparser import ConfigParser
 import io
+import os.path
 
 from dokuforge.storage import CachingStorage
 from dokuforge.user import UserDB
@@ -20,6 +21,12 @@ staticexportdir = %(rootdir)s/exportstatic
 sessiondbpath = :memory:
 staticservepath = static/
 mathjaxuri = %(staticservepath)s/mathjax/
+exportworkers = 0
+cachedir = %(rootdir)s/cache
+exportrebuilddelay = -1
+exportgziplevel = 9
+exportgzipthreads = 0
+fragmentcachesize = 16777216
 """.decode(config_encoding)
 
 class PathConfig(object):
@@ -62,6 +69,14 @@ class PathConfig(object):
         return self.cp.get(self.section, u"staticexportdir").encode(
                 config_encoding)
 
+    @property
+    def cachedir(self):
+        """path to a directory for data that can be regenerated at any time,
+        like the tex exports of courses. Defaults to cache within rootdir."""
+        if not self.cp.has_option(self.section, u"cachedir"):
+            return os.path.join(self.rootdir, b"cache")
+        return self.cp.get(self.section, u"cachedir").encode(config_encoding)
+
     @property
     def sessiondbpath(self):
         """path to a sqlite3 database dedicated to storing session
@@ -73,6 +88,31 @@ class PathConfig(object):
     def sessiondbpath(self, value):
         self.cp.set(self.section, u"sessiondbpath", value)
 
+    @property
+    def sessionbackend(self):
+        """either "sqlite" for keeping the sessions in the sessiondbpath
+        database or "signed" for signed cookies. Unicode property!"""
+        return self.cp.get(self.section, u"sessionbackend", fallback=u"sqlite")
+
+    @property
+    def sessionsecret(self):
+        """key for signing the session cookies of the signed session backend
+        or None if it is not configured."""
+        if not self.cp.get(self.section, u"sessionsecret", fallback=u""):
+            return None
+        return self.cp.get(self.section, u"sessionsecret").encode(
+                config_encoding)
+
+    @property
+    def sessionrevocationpath(self):
+        """path to a file recording the revoked sessions of the signed
+        session backend, shared by all processes. If it is not configured,
+        each process only knows the revocations it performed itself."""
+        if not self.cp.has_option(self.section, u"sessionrevocationpath"):
+            return None
+        return self.cp.get(self.section, u"sessionrevocationpath").encode(
+                config_encoding)
+
     @property
     def staticservepath(self):
         """Unicode property!"""
@@ -83,6 +123,71 @@ class PathConfig(object):
         """Unicode property!"""
         return self.cp.get(self.section, u"mathjaxuri")
 
+    @property
+    def exportworkers(self):
+        """number of worker processes used for parsing the pages of a tex
+        export; 0 means that no extra processes are spawned. Unlike most other
+        properties, this is an int property."""
+        return self.cp.getint(self.section, u"exportworkers", fallback=0)
+
+    @property
+    def exportgziplevel(self):
+        """gzip compression level of exports from 1 (fastest) to 9 (best).
+        Unlike most other properties, this is an int property."""
+        return self.cp.getint(self.section, u"exportgziplevel", fallback=9)
+
+    @property
+    def exportgzipthreads(self):
+        """number of threads compressing exports in parallel; 0 compresses
+        in the thread serving the request. Unlike most other properties,
+        this is an int property."""
+        return self.cp.getint(self.section, u"exportgzipthreads", fallback=0)
+
+    @property
+    def exportrebuilddelay(self):
+        """seconds to wait after a modification of an academy before
+        rebuilding its prebuilt exports; a negative value disables the
+        rebuilds by the web application. Unlike most other properties, this
+        is an int property."""
+        return self.cp.getint(self.section, u"exportrebuilddelay",
+                              fallback=-1)
+
+    @property
+    def fragmentcachesize(self):
+        """number of bytes of rendered fragments of pages, courses and
+        academies kept in memory; 0 disables the cache. Unlike most other
+        properties, this is an int property."""
+        return self.cp.getint(self.section, u"fragmentcachesize",
+                              fallback=16777216)
+
+    @property
+    def templatecachedir(self):
+        """directory for the compiled templates, shared by all processes.
+        Defaults to templates within cachedir; an empty value disables the
+        cache."""
+        if not self.cp.has_option(self.section, u"templatecachedir"):
+            return os.path.join(self.cachedir, b"templates")
+        value = self.cp.get(self.section, u"templatecachedir")
+        if not value:
+            return None
+        return value.encode(config_encoding)
+
+    @property
+    def templateautoreload(self):
+        """whether templates modified on disk are reloaded; checking this
+        costs a stat per template and request. Unlike most other properties,
+        this is a bool property."""
+        return self.cp.getboolean(self.section, u"templateautoreload",
+                                  fallback=True)
+
+    @property
+    def templateprecompile(self):
+        """whether all templates are compiled when the application is
+        created, e.g., before a forking server starts its workers. Unlike
+        most other properties, this is a bool property."""
+        return self.cp.getboolean(self.section, u"templateprecompile",
+                                  fallback=False)
+
     @property
     def userdb(self):
         return UserDB(self.userdbstore)
@@ -7,12 +7,14 @@ worker model. The port to listen will be taken from the configuration file
 from wsgitools.scgi.forkpool import SCGIServer
 
 from dokuforge import buildapp
+from dokuforge.application import Application
 from dokuforge.paths import PathConfig, config_encoding
 
 try:
     from ConfigParser import SafeConfigParser as ConfigParser
 except ImportError:
     from configparser import ConfigParser
+import gc
 import io
 import sys
 import syslog
@@ -46,6 +48,31 @@ def parsesize(s):
         f = 1024*1024
     return int(float(s) * f)
 
+def warmup(application, config):
+    """Fill the caches of the application before the workers are forked,
+    so that all of them share these caches copy-on-write.
+
+    The academies to load are given by the space separated warmupacademies
+    option of the scgi section ("*" for all, empty for none), the number of
+    pages rendered per course by warmuppages and the SCRIPT_NAME the
+    application is served under by warmupscriptname.
+
+    @type application: Application
+    """
+    academies = config.get(u'scgi', u'warmupacademies', fallback=u'').split()
+    if academies:
+        if academies == [u'*']:
+            academies = None
+        application.warmup(
+            academies,
+            pages=config.getint(u'scgi', u'warmuppages', fallback=0),
+            scriptname=config.get(u'scgi', u'warmupscriptname', fallback=u''))
+    ## Objects that survived a collection are never written to by the
+    ## collector of the workers anymore, keeping their pages shared.
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+
 def main(configfile):
     config = ConfigParser()
     with io.open(configfile, encoding=config_encoding) as openconfig:
@@ -61,8 +88,9 @@ def main(configfile):
     resource.setrlimit(resource.RLIMIT_DATA, (limitdata, limitdata))
     resource.setrlimit(resource.RLIMIT_NPROC, (limitnproc, limitnproc))
     pc = PathConfig(config)
-    app = buildapp(pc)
-    app = ExceptionsToSyslog(app)
+    application = Application(pc)
+    warmup(application, config)
+    app = ExceptionsToSyslog(buildapp(pc, application))
     SCGIServer(app, port).enable_sighandler().run()
 
 if __name__ == '__main__':
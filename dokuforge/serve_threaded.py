@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Threaded server listening on http://localhost:8800/ serving the requests
+from a pool of threads. Host, port and number of threads are taken from the
+threaded section of the configuration file. As most of the time of a request
+is spent waiting for rcs and the disk, a few threads within one process go
+a long way.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import sys
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from dokuforge import buildapp
+from dokuforge.paths import PathConfig
+
+class ThreadPoolWSGIServer(WSGIServer):
+    def __init__(self, address, threads):
+        """
+        @type address: (str, int)
+        @param threads: maximum number of requests served concurrently
+        @type threads: int
+        """
+        WSGIServer.__init__(self, address, WSGIRequestHandler)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        self.pool.shutdown()
+
+def main():
+    configfile = "./dokuforge.conf.sample"
+    if len(sys.argv) > 1:
+        configfile = sys.argv[1]
+    pc = PathConfig()
+    pc.read(configfile)
+    host = pc.cp.get(u"threaded", u"host", fallback=u"localhost")
+    port = pc.cp.getint(u"threaded", u"port", fallback=8800)
+    threads = pc.cp.getint(u"threaded", u"threads", fallback=16)
+    app = buildapp(pc)
+    server = ThreadPoolWSGIServer((host, port), threads)
+    server.set_app(app)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,555 @@
+"""
+Backends associating the requests with the users logged in.
+
+Both backends provide get, set, delete and expire. The L{SessionHandler}
+keeps the sessions in a sqlite database. The L{SignedSessionHandler} keeps
+nothing on the server: the cookie itself names the user and is signed with
+a secret, so validating it needs no I/O at all.
+"""
+
+import base64
+import errno
+import fcntl
+import hashlib
+import hmac
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+try:
+    unicode
+except NameError:
+    unicode = str
+
+sysrand = random.SystemRandom()
+
+logger = logging.getLogger(__name__)
+
+def gensid(bits=64):
+    """
+    @type bits: int
+    @param bits: randomness in bits of the resulting string
+    @rtype: unicode
+    @returns: a random string
+    """
+    return u"%x" % sysrand.getrandbits(bits)
+
+def connectsessiondb(path, timeout=5.0):
+    """Connect to a sqlite session database and create missing tables.
+
+    A database on disk is switched to write ahead logging, so that the
+    readers of all worker processes proceed while one of them writes, and
+    writers wait up to timeout seconds for each other instead of failing.
+
+    @type path: unicode
+    @param path: file name or ":memory:"
+    @type timeout: float
+    @rtype: sqlite3.Connection
+    """
+    ## a database in memory only exists within its connection, so all
+    ## threads have to share it (see ThreadLocalDB)
+    sessiondb = sqlite3.connect(path, timeout=timeout,
+                                check_same_thread=path != u":memory:")
+    cur = sessiondb.cursor()
+    cur.execute("PRAGMA busy_timeout = %d;" % int(timeout * 1000))
+    if path != u":memory:":
+        cur.execute("PRAGMA journal_mode = WAL;")
+    # Disable safety -- this increases performance (in a relevant way);
+    # if the sessiondb should be lost at some point it's not uber-tragic
+    cur.execute("PRAGMA synchronous = OFF;")
+    cur.execute(SessionHandler.create_table)
+    sessiondb.commit()
+    cur.close()
+    return sessiondb
+
+class ThreadLocalDB(object):
+    """Behaves like a DBAPI2 connection to the session database, but opens
+    a connection for each thread on its first use. A database in memory
+    only exists within its connection, so this one connection is shared by
+    all threads. Like a sqlite3 connection it can be used as a context
+    manager committing the transaction on success. For the shared connection
+    this also serializes the access, so it should be used this way."""
+    def __init__(self, path):
+        """
+        @type path: unicode
+        @param path: file name or ":memory:"
+        """
+        self.path = path
+        self.local = threading.local()
+        self.shared = None
+        self.lock = threading.RLock()
+
+    def connection(self):
+        """
+        @rtype: sqlite3.Connection
+        """
+        if self.path == u":memory:":
+            with self.lock:
+                if self.shared is None:
+                    self.shared = connectsessiondb(self.path)
+            return self.shared
+        ## a connection must not be used by a forked child process
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.local.db = connectsessiondb(self.path)
+            self.local.pid = os.getpid()
+        return self.local.db
+
+    def cursor(self):
+        """dbapi2"""
+        return self.connection().cursor()
+
+    def commit(self):
+        """dbapi2"""
+        return self.connection().commit()
+
+    def rollback(self):
+        """dbapi2"""
+        return self.connection().rollback()
+
+    def close(self):
+        """dbapi2"""
+        return self.connection().close()
+
+    def __enter__(self):
+        """
+        @returns: the connection of this thread
+        @rtype: sqlite3.Connection
+        """
+        if self.path != u":memory:":
+            return self.connection()
+        self.lock.acquire()
+        try:
+            return self.connection()
+        except:
+            self.lock.release()
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return self.connection().__exit__(exc_type, exc_value, traceback)
+        finally:
+            if self.path == u":memory:":
+                self.lock.release()
+
+class SessionHandler:
+    """Associate users with session ids in a DBAPI2 database. The database
+    may be optimized for performance -- that is we accept an unlikely loss
+    of the session database for performance reasons since the information
+    therein is ephemeral by nature and loss has little impact.
+
+    Looking up a session only reads from the database. Refreshing the
+    updated column of the sessions seen is deferred and done for all of
+    them in one transaction once flush_interval seconds passed or
+    flush_size sessions are pending. Losing pending refreshes only makes
+    the sessions expire up to flush_interval seconds earlier.
+
+    The handler may be shared between threads, if the database allows it
+    (see ThreadLocalDB). Its lock only guards the pending refreshes and the
+    times of the last flush and expiry; the queries are run outside of it,
+    each using the database as a context manager."""
+    create_table = "CREATE TABLE IF NOT EXISTS sessions " + \
+                   "(sid TEXT, user TEXT, updated INTEGER, UNIQUE(sid));"
+    ## the statements are kept constant, so that sqlite3 reuses their
+    ## compiled form from the statement cache of the connection
+    select_session = "SELECT user, updated FROM sessions WHERE sid = ?;"
+    update_session = "UPDATE sessions SET updated = ? WHERE sid = ?;"
+    insert_session = "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?);"
+    delete_session = "DELETE FROM sessions WHERE sid = ?;"
+    expire_sessions = "DELETE FROM sessions WHERE updated < ?;"
+    cookie_name = "sid"
+    hit_interval = 60
+    flush_interval = 60
+    flush_size = 64
+    expire_interval = 60 * 60
+    expire_after = 60 * 60 * 24 * 7 # a week
+
+    def __init__(self, db, connect=None):
+        """
+        @param db: a sqlite3 connection or ThreadLocalDB with a sessions
+                table as described in the create_table class variable
+        @param connect: function opening another connection to the same
+                database; if given, old sessions are deleted by a
+                background thread of each process using such a connection,
+                otherwise along with flushing the refreshes
+        @type connect: None or (() -> DBAPI2 connection)
+        """
+        self.db = db
+        self.connect = connect
+        self.lastexpire = time.time()
+        self.lastflush = time.time()
+        self.touched = dict() # sid -> time of the last request
+        self.expirerpid = None
+        self.lock = threading.Lock()
+
+    def get(self, request):
+        """Find a user session.
+        @type request: werkzeug.wrappers.Request
+        @rtype: (unicode or None, unicode or None)
+        @returns: a pair (sid, username). sid is None if the cookie is missing
+                and username is None if sid cannot be found in the database
+        """
+        now = time.time()
+        sid = request.cookies.get(self.cookie_name)
+        if self.connect is not None and self.expirerpid != os.getpid():
+            with self.lock:
+                if self.expirerpid != os.getpid():
+                    self.startexpirer()
+        if sid is None:
+            logger.debug("SessionHandler.get: no cookie found")
+            self.flush(now)
+            return (None, None)
+        with self.db as db:
+            cur = db.cursor()
+            cur.execute(self.select_session, (sid,))
+            results = cur.fetchall()
+            cur.close()
+        if len(results) != 1:
+            logger.debug("SessionHandler.get: cookie %r not found", sid)
+            self.flush(now)
+            return (sid, None)
+        username, updated = results[0]
+        assert isinstance(username, unicode)
+        if updated + self.hit_interval < now:
+            with self.lock:
+                self.touched.setdefault(sid, now)
+        logger.debug("SessionHandler.get: cookie %r matches user %r", sid,
+                username)
+        self.flush(now)
+        return (sid, username)
+
+    def flush(self, now=None, force=False):
+        """Write the deferred refreshes of the sessions if they are due.
+        @type now: None or float
+        @param now: time.time() result if already present
+        @type force: bool
+        @param force: write pending refreshes regardless of their age
+        """
+        if now is None:
+            now = time.time()
+        expire = False
+        with self.lock:
+            if self.connect is None and \
+                    self.lastexpire + self.expire_interval < now:
+                ## claim the expiry, so that other threads skip it
+                self.lastexpire = now
+                expire = True
+            if not self.touched:
+                touched = None
+            elif not force and len(self.touched) < self.flush_size and \
+                    self.lastflush + self.flush_interval > now:
+                touched = None
+            else:
+                touched, self.touched = self.touched, dict()
+                self.lastflush = now
+        if expire:
+            self.expire(now)
+        if touched is None:
+            return
+        logger.debug("SessionHandler.flush: refreshing %d sessions",
+                     len(touched))
+        with self.db as db:
+            cur = db.cursor()
+            cur.executemany(self.update_session,
+                            [(updated, sid) for sid, updated in touched.items()])
+            cur.close()
+
+    def set(self, response, username, sid=None):
+        """Initiate a user session.
+        @type response: werkzeug.wrappers.Response
+        @type username: unicode
+        @type sid: unicode or None
+        @rtype: unicode
+        @returns: sid
+        """
+        action = "reusing"
+        if sid is None:
+            sid = gensid()
+            response.set_cookie(self.cookie_name, sid)
+            action = "generating new"
+        logger.debug("SessionHandler.set: %s cookie %r for user %r", action,
+                    sid, username)
+        with self.lock:
+            self.touched.pop(sid, None)
+        with self.db as db:
+            cur = db.cursor()
+            cur.execute(self.insert_session, (sid, username, time.time()))
+            cur.close()
+        return sid
+
+    def delete(self, response, sid):
+        """Delete a user session.
+        @type response: werkzeug.wrappers.Response
+        @type sid: str
+        """
+        if sid is not None:
+            logger.debug("SessionHandler.delete: deleting cookie %r", sid)
+            with self.lock:
+                self.touched.pop(sid, None)
+            with self.db as db:
+                cur = db.cursor()
+                cur.execute(self.delete_session, (sid,))
+                cur.close()
+            response.delete_cookie(self.cookie_name)
+        else:
+            logger.debug("SessionHandler.delete: no cookie to delete")
+
+    def expire(self, now=None, db=None):
+        """Delete the sessions not used within expire_after seconds.
+        @type now: None or float
+        @param now: time.time() result if already present
+        @param db: connection to use instead of the one of the handler
+        """
+        if now is None:
+            now = time.time()
+        if db is None:
+            db = self.db
+        logger.debug("SessionHandler.expire: taking action")
+        with db as conn:
+            cur = conn.cursor()
+            cur.execute(self.expire_sessions, (now - self.expire_after,))
+            cur.close()
+        with self.lock:
+            self.lastexpire = now
+
+    def startexpirer(self):
+        """Start the thread periodically deleting old sessions in this
+        process. It uses its own connection to the database."""
+        self.expirerpid = os.getpid()
+        def expireperiodically():
+            db = self.connect()
+            while True:
+                time.sleep(self.expire_interval)
+                try:
+                    self.expire(db=db)
+                except sqlite3.Error as error:
+                    logger.warning("SessionHandler.expire failed: %s" % error)
+        expirer = threading.Thread(target=expireperiodically,
+                                   name="session expirer")
+        expirer.daemon = True
+        expirer.start()
+
+class SignedSessionHandler(object):
+    """Associate users with HMAC signed cookies. A cookie consists of a
+    random id, its expiry time and the user name followed by the signature
+    of these. A session cannot be extended, it ends expire_after seconds
+    after the login.
+
+    Logging out revokes the id of the session. The revoked ids are kept in
+    memory until the session would have expired. If a revocation file is
+    given, revocations are appended to it and other processes pick them up
+    at most sync_interval seconds later by reading what was appended since
+    their last look. Compacting the file starts it with a line naming a new
+    generation, so that the other processes notice the replacement and read
+    it from the start."""
+    cookie_name = "sid"
+    expire_after = 60 * 60 * 24 * 7 # a week
+    sync_interval = 10
+    compact_threshold = 65536 # bytes
+
+    def __init__(self, secret, revocationpath=None):
+        """
+        @param secret: key of the signatures; all processes serving the same
+            users must share it
+        @type secret: bytes
+        @param revocationpath: file shared by all processes for recording the
+            revoked sessions; None keeps them in this process only
+        @type revocationpath: None or bytes
+        """
+        assert isinstance(secret, bytes)
+        assert revocationpath is None or isinstance(revocationpath, bytes)
+        self.secret = secret
+        self.revocationpath = revocationpath
+        self.revoked = dict() # id -> expiry time
+        self.lock = threading.Lock()
+        self.lastsync = 0
+        self.generation = None
+        self.offset = 0
+
+    def sign(self, payload):
+        """
+        @type payload: unicode
+        @rtype: unicode
+        """
+        return hmac.new(self.secret, payload.encode("utf8"),
+                        hashlib.sha256).hexdigest()
+
+    def issue(self, username, now):
+        """
+        @type username: unicode
+        @type now: float
+        @returns: a new signed cookie value for the user
+        @rtype: unicode
+        """
+        assert isinstance(username, unicode)
+        name = base64.urlsafe_b64encode(username.encode("utf8"))
+        payload = u"%s.%x.%s" % (gensid(), int(now) + self.expire_after,
+                                 name.decode("ascii").rstrip(u"="))
+        return u"%s.%s" % (payload, self.sign(payload))
+
+    def verify(self, sid, now):
+        """
+        @type sid: unicode
+        @type now: float
+        @returns: the id, the expiry time and the user of a validly signed
+            and unexpired cookie value or None
+        @rtype: None or (unicode, int, unicode)
+        """
+        try:
+            payload, signature = sid.rsplit(u".", 1)
+            sessionid, expires, name = payload.split(u".")
+            expires = int(expires, 16)
+        except ValueError:
+            return None
+        if not hmac.compare_digest(signature.encode("utf8"),
+                                   self.sign(payload).encode("ascii")):
+            return None
+        if expires < now:
+            return None
+        try:
+            name = name.encode("ascii")
+            username = base64.urlsafe_b64decode(name + b"=" * (-len(name) % 4))
+            return (sessionid, expires, username.decode("utf8"))
+        except (ValueError, UnicodeError):
+            return None
+
+    def get(self, request):
+        """Find a user session.
+        @type request: werkzeug.wrappers.Request
+        @rtype: (unicode or None, unicode or None)
+        @returns: a pair (sid, username). sid is None if the cookie is missing
+                and username is None if the cookie is not valid
+        """
+        sid = request.cookies.get(self.cookie_name)
+        if sid is None:
+            logger.debug("SignedSessionHandler.get: no cookie found")
+            return (None, None)
+        now = time.time()
+        session = self.verify(sid, now)
+        if session is None:
+            logger.debug("SignedSessionHandler.get: cookie %r invalid", sid)
+            return (sid, None)
+        self.sync(now)
+        if session[0] in self.revoked:
+            logger.debug("SignedSessionHandler.get: cookie %r revoked", sid)
+            return (sid, None)
+        return (sid, session[2])
+
+    def set(self, response, username, sid=None):
+        """Initiate a user session. A new cookie is issued in any case.
+        @type response: werkzeug.wrappers.Response
+        @type username: unicode
+        @type sid: unicode or None
+        @rtype: unicode
+        @returns: sid
+        """
+        sid = self.issue(username, time.time())
+        logger.debug("SignedSessionHandler.set: new cookie for user %r",
+                     username)
+        response.set_cookie(self.cookie_name, sid,
+                            max_age=self.expire_after, httponly=True)
+        return sid
+
+    def delete(self, response, sid):
+        """Delete a user session by revoking it.
+        @type response: werkzeug.wrappers.Response
+        @type sid: unicode or None
+        """
+        if sid is None:
+            logger.debug("SignedSessionHandler.delete: no cookie to delete")
+            return
+        session = self.verify(sid, time.time())
+        if session is not None:
+            logger.debug("SignedSessionHandler.delete: revoking cookie %r",
+                         sid)
+            self.revoke(session[0], session[1])
+        response.delete_cookie(self.cookie_name)
+
+    def revoke(self, sessionid, expires):
+        """
+        @type sessionid: unicode
+        @type expires: int
+        """
+        with self.lock:
+            self.revoked[sessionid] = expires
+        if self.revocationpath is None:
+            return
+        with open(self.revocationpath + b".lock", "ab") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            with open(self.revocationpath, "ab") as revocations:
+                revocations.write((u"%s %d\n" % (sessionid, expires)).encode(
+                    "ascii"))
+                size = revocations.tell()
+            ## an entry takes less than 32 bytes, so compact once more than
+            ## half of the file is expired entries
+            with self.lock:
+                live = len(self.revoked)
+            if size > self.compact_threshold and size > 64 * live:
+                self.compact()
+
+    def compact(self):
+        """Rewrite the revocation file without the expired entries. The
+        caller must hold the lock of the file."""
+        self.sync(force=True)
+        with self.lock:
+            entries = sorted(self.revoked.items())
+        tmpname = self.revocationpath + b".tmp"
+        with open(tmpname, "wb") as revocations:
+            revocations.write((u"# generation %s\n" % gensid()).encode("ascii"))
+            revocations.write(b"".join((u"%s %d\n" % entry).encode("ascii")
+                                       for entry in entries))
+        os.rename(tmpname, self.revocationpath)
+
+    def sync(self, now=None, force=False):
+        """Forget expired revocations and read the ones other processes
+        appended to the revocation file. Unless forced, the file is only
+        looked at every sync_interval seconds.
+        @type now: None or float
+        @type force: bool
+        """
+        if now is None:
+            now = time.time()
+        if not force and self.lastsync + self.sync_interval > now:
+            return
+        with self.lock:
+            self.lastsync = now
+            self.revoked = dict((sessionid, expires) for sessionid, expires
+                                in self.revoked.items() if expires >= now)
+            if self.revocationpath is None:
+                return
+            try:
+                revocations = open(self.revocationpath, "rb")
+            except IOError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+                return
+            with revocations:
+                ## a compacted file starts with its generation; inode
+                ## numbers are no help here, as they are reused
+                header = revocations.readline()
+                generation = header if header.startswith(b"# ") else None
+                size = os.fstat(revocations.fileno()).st_size
+                if generation != self.generation or size < self.offset:
+                    ## the file was compacted, read it from the start
+                    self.generation = generation
+                    self.offset = 0
+                revocations.seek(self.offset)
+                data = revocations.read()
+            ## only consume complete lines
+            data = data[:data.rfind(b"\n") + 1]
+            self.offset += len(data)
+            for line in data.decode("ascii", "replace").splitlines():
+                try:
+                    sessionid, expires = line.split()
+                    expires = int(expires)
+                except ValueError:
+                    continue
+                if expires >= now:
+                    self.revoked[sessionid] = expires
+
+    def expire(self, now=None):
+        """Forget expired revocations.
+        @type now: None or float
+        """
+        self.sync(now, force=True)
@@ -6,6 +6,7 @@ import shutil
 import time
 import subprocess
 import re
+import threading
 try:
     unicode
 except NameError:
@@ -41,6 +42,7 @@ def rlogv(filename):
         return None
 
 rcsseparator = b'----------------------------'
+rcsterminator = b'=' * 77
 
 def rloghead(filename):
     """
@@ -66,7 +68,18 @@ def rloghead(filename):
     answer[b'revision'] = revision
     rlog = check_output(["rlog","-q","-r%s" % revision.decode("ascii"),
                          filename], env=RCSENV)
-    lines = rlog.splitlines()
+    parserlogentry(rlog.splitlines(), answer)
+    return answer
+
+def parserlogentry(lines, answer):
+    """
+    Extract the information about the single revision contained in the
+    output of rlog for one file.
+
+    @type lines: [bytes]
+    @param answer: the dict to add the information to
+    @type answer: {bytes: bytes or datetime}
+    """
     while lines[0] != rcsseparator or lines[1].split()[0] != b'revision':
         lines.pop(0)
     lines.pop(0)
@@ -81,7 +94,38 @@ def rloghead(filename):
     date = datetime.strptime(answer[b"date"].decode("ascii"),
                              "%Y/%m/%d %H:%M:%S")
     answer[b"date"] = date.replace(tzinfo=timezone.utc)
-    return answer
+
+def rlogheads(filenames):
+    """
+    Get the information of rloghead for many rcs files from a single rlog
+    run.
+
+    @type filenames: [bytes]
+    @returns: the results of rloghead in the order of filenames
+    @rtype: [{bytes: bytes or datetime}]
+    """
+    if not filenames:
+        return []
+    logger.debug("rlogheads: looking up head revision info for %d files" %
+                 len(filenames))
+    # Without a revision -r selects the latest revision on the default
+    # branch, which is the head revision for all files of dokuforge.
+    rlog = check_output(["rlog", "-q", "-r"] + list(filenames), env=RCSENV)
+    entries = []
+    lines = []
+    for line in rlog.splitlines():
+        if line == rcsterminator:
+            entries.append(lines)
+            lines = []
+        else:
+            lines.append(line)
+    assert len(entries) == len(filenames)
+    answers = []
+    for filename, lines in zip(filenames, entries):
+        answer = {b'revision': rlogv(filename)}
+        parserlogentry(lines, answer)
+        answers.append(answer)
+    return answers
 
 class LockDir:
     def __init__(self, path):
@@ -91,6 +135,8 @@ class LockDir:
         assert isinstance(path, bytes)
         self.path = path
         self.lockcount = 0
+        self.owner = None
+        self.mutex = threading.Lock()
 
     def __enter__(self):
         """
@@ -100,28 +146,36 @@ class LockDir:
         out. Note that locks have to be obtained in lexicographic order by native
         byte order (in particular captital letter before lower case letters).
 
-        Acquiring this object multiple times will succeed, but you have to
-        release it multiple times, too.
+        Acquiring this object multiple times from the same thread will
+        succeed, but you have to release it multiple times, too. Other
+        threads wait just like other processes do.
         """
-        if self.lockcount != 0:
-            self.lockcount += 1
-            return self
+        with self.mutex:
+            if self.lockcount != 0 and self.owner == threading.get_ident():
+                self.lockcount += 1
+                return self
         while True:
             try:
                 os.mkdir(self.path)
-                self.lockcount = 1
-                return self
             except OSError as e:
                 if e.errno == errno.EEXIST:
                     logger.debug("lock %r is busy" % self.path)
                     time.sleep(0.2) # evertthing OK, someone else has the lock
                 else:
                     raise # something else went wrong
+            else:
+                with self.mutex:
+                    self.owner = threading.get_ident()
+                    self.lockcount = 1
+                return self
 
     def __exit__(self, _1, _2, _3):
-        self.lockcount -= 1
-        if self.lockcount == 0:
-            os.rmdir(self.path)
+        with self.mutex:
+            assert self.owner == threading.get_ident()
+            self.lockcount -= 1
+            if self.lockcount == 0:
+                self.owner = None
+                os.rmdir(self.path)
 
 
 class Storage(object):
@@ -224,6 +278,7 @@ class Storage(object):
         self.ensureexistence(havelock=havelock)
         return rloghead(self.fullpath(postfix=b",v"))
 
+
     def content(self, havelock=None):
         self.ensureexistence(havelock = havelock)
         logger.debug("retrieving content for %r" % self.fullpath())
@@ -328,19 +383,26 @@ class Storage(object):
 class CachingStorage(Storage):
     """
     A storage Object that caches the contents; useful if a lot
-    of read is attemted
+    of read is attemted. It may be shared between threads.
     """
 
     def __init__(self, path, filename):
         Storage.__init__(self, path, filename)
         self.cachedtime = epoch # Jan 1, 1970 -- way before the first dokuforge2 installation
         self.cachedvalue = ""
+        self.cachelock = threading.Lock()
+
+    def cachedcontent(self):
+        """
+        @returns: the content and the modification time it was read at
+        @rtype: (bytes, datetime)
+        """
+        with self.cachelock:
+            mtime = self.timestamp()
+            if mtime != self.cachedtime:
+                self.cachedvalue = Storage.content(self)
+                self.cachedtime = mtime
+            return self.cachedvalue, self.cachedtime
 
     def content(self, havelock=None):
-        mtime = self.timestamp()
-        if mtime == self.cachedtime:
-            pass # content already up to date
-        else:
-            self.cachedtime = mtime
-            self.cachedvalue = Storage.content(self)
-        return self.cachedvalue
+        return self.cachedcontent()[0]
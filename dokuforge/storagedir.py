@@ -6,7 +6,7 @@ try:
 except NameError:
     unicode = str
 
-from dokuforge.storage import Storage
+from dokuforge.storage import Storage, rlogheads
 from dokuforge.view import LazyView
 import dokuforge.common as common
 
@@ -43,6 +43,22 @@ class StorageDir:
         """
         return self.getstorage(filename).content(havelock)
 
+    def getcommitstatuses(self, filenames):
+        """
+        Obtain the commitstatus of many Storages with a single rlog run.
+
+        @type filenames: [bytes]
+        @param filenames: each passed to Storage as second param
+        @rtype: [{bytes: bytes or datetime}]
+        @returns: the commitstatus of each Storage in the order of filenames
+        """
+        rcsfiles = []
+        for filename in filenames:
+            storage = self.getstorage(filename)
+            storage.ensureexistence()
+            rcsfiles.append(storage.fullpath(postfix=b",v"))
+        return rlogheads(rcsfiles)
+
     @property
     def name(self):
         """
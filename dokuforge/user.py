@@ -4,6 +4,7 @@ try:
 except ImportError:
     from configparser import ConfigParser
 import io
+import threading
 
 try:
     unicode
@@ -26,6 +27,30 @@ def randpasswordstring(n=6):
     chars = 'ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz123456789'
     return ''.join(sysrand.choice(chars) for x in range(n))
 
+def resolveAcademy(aca):
+    """
+    @type aca: Academy or LazyView
+    @returns: the groups and the name of the academy
+    @rtype: ([unicode], unicode)
+    """
+    ## a bit care has to be taken since we need the groups too
+    if isinstance(aca, LazyView):
+        return aca["groups"], aca["name"].decode("ascii")
+    assert isinstance(aca, Academy)
+    return aca.getgroups(), aca.name.decode("ascii")
+
+def resolveCourse(course):
+    """
+    @type course: None or Course or LazyView
+    @returns: the name of the course
+    @rtype: None or unicode
+    """
+    if course is None:
+        return None
+    if isinstance(course, LazyView):
+        return course["name"].decode("ascii")
+    assert isinstance(course, Course)
+    return course.name.decode("ascii")
 
 class User:
     """
@@ -116,6 +141,39 @@ class User:
             password = randpasswordstring(6).decode("utf8")
         self.password = password
         self.permissions = permissions
+        self.compilePermissions()
+
+    def compilePermissions(self):
+        """
+        Precompute the sets the permission checks are answered from. The
+        sets are immutable, so a User may be shared between requests as long
+        as the permissions dictionary is not modified afterwards.
+
+        The sets granted and revoked hold the names of the granted and the
+        explicitly revoked permissions. Furthermore globalgrants holds x
+        for every granted df_x, groupgrants (x, y) for every granted
+        gruppe_x_y, academygrants and academyrevokes (x, y) for every
+        granted or revoked akademie_x_y and coursegrants and courserevokes
+        (x, y, z) for every granted or revoked kurs_x_y_z.
+        """
+        self.granted = frozenset(perm for perm, state
+                                 in self.permissions.items() if state)
+        self.revoked = frozenset(perm for perm, state
+                                 in self.permissions.items()
+                                 if state is not None and not state)
+        def split(perms, prefix, parts):
+            return frozenset(tuple(perm.split(u"_", parts)[1:])
+                             for perm in perms
+                             if perm.startswith(prefix) and
+                             perm.count(u"_") >= parts)
+        self.globalgrants = frozenset(entry[0] for entry
+                                      in split(self.granted, u"df_", 1))
+        self.groupgrants = split(self.granted, u"gruppe_", 2)
+        self.academygrants = split(self.granted, u"akademie_", 2)
+        self.academyrevokes = split(self.revoked, u"akademie_", 2)
+        self.coursegrants = split(self.granted, u"kurs_", 3)
+        self.courserevokes = split(self.revoked, u"kurs_", 3)
+        self.superadmin = u"superadmin" in self.globalgrants
 
     def hasPermission(self, perm):
         """
@@ -124,8 +182,7 @@ class User:
         @rtype: bool
         """
         assert isinstance(perm, unicode)
-        ## cast None to False
-        return bool(self.permissions.get(perm))
+        return perm in self.granted
 
     def revokedPermission(self, perm):
         """
@@ -134,11 +191,7 @@ class User:
         @rtype: bool
         """
         assert isinstance(perm, unicode)
-        state = self.permissions.get(perm)
-        if state is not None and state == False:
-            return True
-        else:
-            return False
+        return perm in self.revoked
 
     def allowedRead(self, aca, course = None, recursive = False):
         """
@@ -150,42 +203,41 @@ class User:
         @rtype: bool
         """
         ## first check global priveleges
-        if self.hasPermission(u"df_read") or self.isSuperAdmin():
+        if self.superadmin or u"read" in self.globalgrants:
             return True
-        ## now we need to resolve aca and course
-        ## a bit care has to be taken since we need the groups too
-        if isinstance(aca, LazyView):
-            groups = aca["groups"]
-            aca = aca["name"].decode("ascii")
-        else:
-            assert isinstance(aca, Academy)
-            groups = aca.getgroups()
-            aca = aca.name.decode("ascii")
-        if course is None:
-            pass
-        elif isinstance(course, LazyView):
-            course = course["name"].decode("ascii")
-        else:
-            assert isinstance(course, Course)
-            course = course.name.decode("ascii")
+        groups, aca = resolveAcademy(aca)
+        return self.allowedReadResolved(groups, aca, resolveCourse(course),
+                                        recursive)
+
+    def allowedReadResolved(self, groups, aca, course, recursive=False):
+        """
+        The part of allowedRead following the check of the global
+        priveleges.
+
+        @type groups: [unicode]
+        @type aca: unicode
+        @type course: None or unicode
+        @type recursive: bool
+        @rtype: bool
+        """
         ## second check for explicitly revoked privilege
         if course is None:
-            if self.revokedPermission(u"akademie_read_%s" % aca) or \
-                self.revokedPermission(u"akademie_view_%s" % aca):
+            if (u"read", aca) in self.academyrevokes or \
+                (u"view", aca) in self.academyrevokes:
                 return False
         else:
-            if self.revokedPermission(u"kurs_read_%s_%s" % (aca, course)):
+            if (u"read", aca, course) in self.courserevokes:
                 return False
-            if self.revokedPermission(u"akademie_read_%s" % aca) and \
-                not self.hasPermission(u"kurs_read_%s_%s" % (aca, course)):
+            if (u"read", aca) in self.academyrevokes and \
+                (u"read", aca, course) not in self.coursegrants:
                 return False
         ## now we are done with revoked permissions and can continue
         ## third check group level privileges
         for g in groups:
-            if self.hasPermission(u"gruppe_read_%s" % g):
+            if (u"read", g) in self.groupgrants:
                 return True
         ## fourth check the academy level priveleges
-        if self.hasPermission(u"akademie_read_%s" % aca):
+        if (u"read", aca) in self.academygrants:
             return True
         if course is None:
             ## we only want to read an academy entry
@@ -194,9 +246,31 @@ class User:
             if recursive:
                 return False
             ## in non-recursive case we check akademie_view_*
-            return self.hasPermission(u"akademie_view_%s" % aca)
+            return (u"view", aca) in self.academygrants
         ## at this point we ask for a read privelege of a specific course
-        return self.hasPermission(u"kurs_read_%s_%s" % (aca, course))
+        return (u"read", aca, course) in self.coursegrants
+
+    def filterReadable(self, items, aca=None):
+        """
+        Bulk version of allowedRead for listing academies or the courses of
+        an academy.
+
+        @param items: academies or, if aca is given, courses of aca
+        @type items: [Academy or LazyView] or [Course or LazyView]
+        @type aca: None or Academy or LazyView
+        @returns: the items the user may read in their original order
+        @rtype: [Academy or LazyView] or [Course or LazyView]
+        """
+        items = list(items)
+        if self.superadmin or u"read" in self.globalgrants:
+            return items
+        if aca is None:
+            return [item for item in items
+                    if self.allowedReadResolved(*resolveAcademy(item),
+                                                course=None)]
+        groups, aca = resolveAcademy(aca)
+        return [item for item in items
+                if self.allowedReadResolved(groups, aca, resolveCourse(item))]
 
     def allowedWrite(self, aca, course = None):
         """
@@ -205,47 +279,33 @@ class User:
         @rtype: bool
         """
         ## first check global priveleges
-        if self.hasPermission(u"df_write") or self.isSuperAdmin():
+        if self.superadmin or u"write" in self.globalgrants:
             return True
-        ## now we need to resolve aca and course
-        ## a bit care has to be taken since we need the groups too
-        if isinstance(aca, LazyView):
-            groups = aca["groups"]
-            aca = aca["name"].decode("ascii")
-        else:
-            assert isinstance(aca, Academy)
-            groups = aca.getgroups()
-            aca = aca.name.decode("ascii")
-        if course is None:
-            pass
-        elif isinstance(course, LazyView):
-            course = course["name"].decode("ascii")
-        else:
-            assert isinstance(course, Course)
-            course = course.name.decode("ascii")
+        groups, aca = resolveAcademy(aca)
+        course = resolveCourse(course)
         ## second check for explicitly revoked privilege
         if course is None:
-            if self.revokedPermission(u"akademie_write_%s" % aca):
+            if (u"write", aca) in self.academyrevokes:
                 return False
         else:
-            if self.revokedPermission(u"kurs_write_%s_%s" % (aca, course)):
+            if (u"write", aca, course) in self.courserevokes:
                 return False
-            if self.revokedPermission(u"akademie_write_%s" % aca) and \
-                not self.hasPermission(u"kurs_write_%s_%s" % (aca, course)):
+            if (u"write", aca) in self.academyrevokes and \
+                (u"write", aca, course) not in self.coursegrants:
                 return False
         ## now we are done with revoked permissions and can continue
         ## third check group level privileges
         for g in groups:
-            if self.hasPermission(u"gruppe_write_%s" % g):
+            if (u"write", g) in self.groupgrants:
                 return True
         ## fourth check the academy level priveleges
-        if self.hasPermission(u"akademie_write_%s" % aca):
+        if (u"write", aca) in self.academygrants:
             return True
         if course is None:
             ## no write access to the academy
             return False
         ## at this point we ask for a write privelege of a specific course
-        return self.hasPermission(u"kurs_write_%s_%s" % (aca, course))
+        return (u"write", aca, course) in self.coursegrants
 
     def allowedMeta(self, aca):
         """
@@ -253,27 +313,19 @@ class User:
         @rtype: bool
         """
         ## first check global priveleges
-        if self.hasPermission(u"df_meta") or self.isSuperAdmin():
+        if self.superadmin or u"meta" in self.globalgrants:
             return True
-        ## now we need to resolve aca
-        ## a bit care has to be taken since we need the groups too
-        if isinstance(aca, LazyView):
-            groups = aca["groups"]
-            aca = aca["name"].decode("ascii")
-        else:
-            assert isinstance(aca, Academy)
-            groups = aca.getgroups()
-            aca = aca.name.decode("ascii")
+        groups, aca = resolveAcademy(aca)
         ## second check for explicitly revoked privilege
-        if self.revokedPermission(u"akademie_meta_%s" % aca):
+        if (u"meta", aca) in self.academyrevokes:
             return False
         ## now we are done with revoked permissions and can continue
         ## third check group level privileges
         for g in groups:
-            if self.hasPermission(u"gruppe_meta_%s" % g):
+            if (u"meta", g) in self.groupgrants:
                 return True
         ## fourth check the academy level priveleges
-        return self.hasPermission(u"akademie_meta_%s" % aca)
+        return (u"meta", aca) in self.academygrants
 
     def mayExport(self, aca):
         """
@@ -316,7 +368,7 @@ class User:
         """
         @rtype: bool
         """
-        return self.hasPermission(u"df_superadmin")
+        return self.superadmin
 
     def defaultGroup(self):
         """Return the default group of a user. This is the first part (separated by
@@ -339,11 +391,12 @@ class UserDB:
     """
     def __init__(self, storage):
         """
-        @type storage: storage.Storage
+        @type storage: storage.CachingStorage
         """
         self.db = dict()
         self.storage = storage
         self.timestamp = epoch
+        self.loadlock = threading.Lock()
 
     def addUser(self, name, status, password, permissions):
         """
@@ -382,21 +435,26 @@ class UserDB:
         """
         Load the user database from disk.
 
-        This erases all in-memory changes.
+        This erases all in-memory changes. Threads looking up users while
+        another one loads see either the old or the new database.
         """
         ## if nothing is changed return
         if self.storage.timestamp() <= self.timestamp:
             return
-        config = ConfigParser()
-        content = io.StringIO(self.storage.content().decode("utf8"))
-        ## update time, since we read the new content
-        self.timestamp = self.storage.cachedtime
-        config.read_file(content)
-        ## clear after we read the new config, better safe than sorry
-        self.db.clear()
-        for name in config.sections():
-            permissions = dict((perm.strip().split(u' ')[0],
-                                strtobool(perm.strip().split(u' ')[1]))
-                for perm in config.get(name, u'permissions').split(u','))
-            self.addUser(name, config.get(name, u'status'),
-                         config.get(name, u'password'), permissions)
+        with self.loadlock:
+            content, timestamp = self.storage.cachedcontent()
+            if timestamp <= self.timestamp:
+                return # another thread was faster
+            config = ConfigParser()
+            config.read_file(io.StringIO(content.decode("utf8")))
+            db = dict()
+            for name in config.sections():
+                permissions = dict((perm.strip().split(u' ')[0],
+                                    strtobool(perm.strip().split(u' ')[1]))
+                    for perm in config.get(name, u'permissions').split(u','))
+                db[name] = User(name, config.get(name, u'status'),
+                                config.get(name, u'password'), permissions)
+            ## replace the database only after reading the new config,
+            ## better safe than sorry
+            self.db = db
+            self.timestamp = timestamp
@@ -19,7 +19,6 @@ DFWORKDIR=work/example/df
 DFACADIR=$DFWORKDIR/$ACANAME
 EXPORTSTATICDIR=$2
 EXPORTSTATICCLEANDIR=`mktemp -d`
-EXPORTEDACAFILENAME=texexport_$ACANAME.tar
 EXPORTEDACADIR=$EXPORTDIR/texexport_$ACANAME
 CURRENTDIR=`pwd`
 
@@ -33,16 +32,6 @@ if [ -d $DFACADIR ]; then
     exit 1
 fi
 
-if [ -e $EXPORTEDACAFILENAME ]; then
-    echo $EXPORTEDACAFILENAME " exists, please remove and retry."
-    exit 1
-fi
-
-if [ -d $EXPORTEDACADIR ]; then
-    echo $EXPORTEDACADIR "exists, please remove and retry."
-    exit 1
-fi
-
 # unpack raw export so that local df2 finds it
 mkdir -p work/example/df
 tar -C $DFWORKDIR -xvf $RAWEXPORT
@@ -51,16 +40,16 @@ tar -C $DFWORKDIR -xvf $RAWEXPORT
 rmdir $EXPORTSTATICCLEANDIR
 svn export $EXPORTSTATICDIR $EXPORTSTATICCLEANDIR
 
-# perform actual export, this can take a few seconds without output
+# perform actual export, this can take a few seconds without output; the
+# export is written straight into $EXPORTEDACADIR, where an existing export
+# is updated in place, only rewriting the files that changed
 echo "Exporting ..."
 printf 'commitid = "%s"' `git show -s --format=%H` > dokuforge/versioninfo.py \
     || rm dokuforge/versioninfo.py
-$PYTHON3 -m dokuforge.export $DFWORKDIR $EXPORTSTATICCLEANDIR $ACANAME
+$PYTHON3 -m dokuforge.export --directory --force --outdir $EXPORTDIR \
+    $DFWORKDIR $EXPORTSTATICCLEANDIR $ACANAME
 echo "Done."
 rm dokuforge/versioninfo.py
 
-# unpack export
-tar -C $EXPORTDIR -xvf $EXPORTEDACAFILENAME
-
 # clean up files created during exporting
-rm -rf $DFACADIR $EXPORTEDACAFILENAME $EXPORTSTATICCLEANDIR
+rm -rf $DFACADIR $EXPORTDIR/.texexport_$ACANAME.key $EXPORTSTATICCLEANDIR
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Usage: python parserbenchmark.py [-n COPIES] [raw export .tar.gz file]
+
+Parse all pages of a raw academy export and report the memory held by the
+resulting parse trees. To mimic a large academy every page is parsed COPIES
+times and all trees are kept alive until the measurement is taken.
+"""
+
+import argparse
+import gc
+import re
+import tarfile
+import time
+import tracemalloc
+
+from dokuforge.parser import dfLineGroupParser, PTree
+
+def headrevision(rcsfile):
+    """
+    Extract the text of the head revision from the contents of an RCS file.
+    The head revision is the first deltatext and is stored in full.
+
+    @type rcsfile: bytes
+    @rtype: unicode
+    """
+    match = re.search(br"\ntext\n@((?:[^@]|@@)*)@", rcsfile)
+    return match.group(1).replace(b"@@", b"@").decode("utf8")
+
+def readpages(filename):
+    """
+    @param filename: raw academy export as produced by the df2 raw export
+    @rtype: [unicode]
+    """
+    pages = []
+    with tarfile.open(filename) as tar:
+        for member in tar.getmembers():
+            if re.search(r"/course[^/]*/page\d+,v$", member.name):
+                pages.append(headrevision(tar.extractfile(member).read()))
+    return pages
+
+def countnodes(ptree):
+    seen = 0
+    todo = [ptree]
+    while todo:
+        node = todo.pop()
+        seen += 1
+        values = list(getattr(node, "__dict__", {}).values())
+        for cls in type(node).__mro__:
+            values.extend(getattr(node, name, None)
+                          for name in cls.__dict__.get("__slots__", ()))
+        for value in values:
+            if isinstance(value, PTree):
+                todo.append(value)
+            elif isinstance(value, list):
+                todo.extend(v for v in value if isinstance(v, PTree))
+    return seen
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure memory usage of dokuforge parse trees.")
+    parser.add_argument("rawexport", nargs="?",
+                        default="testData/txa2011-1.tar.gz")
+    parser.add_argument("-n", "--copies", type=int, default=200,
+                        help="how often every page is parsed (default: 200)")
+    args = parser.parse_args()
+
+    pages = readpages(args.rawexport)
+    gc.collect()
+    tracemalloc.start()
+    starttime = time.time()
+    trees = [dfLineGroupParser(page) for _ in range(args.copies)
+             for page in pages]
+    elapsed = time.time() - starttime
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    nodes = sum(countnodes(tree) for tree in trees)
+    print("pages parsed:      %d" % len(trees))
+    print("parse tree nodes:  %d" % nodes)
+    print("memory held:       %d KiB" % (current // 1024))
+    print("peak memory:       %d KiB" % (peak // 1024))
+    print("bytes per node:    %.1f" % (current / float(max(nodes, 1))))
+    print("parse time:        %.2f s" % elapsed)
+
+if __name__ == "__main__":
+    main()
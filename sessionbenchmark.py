@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Usage: python sessionbenchmark.py [-w WORKERS] [-n REQUESTS] [-s SESSIONS]
+
+Measure the overhead of looking up sessions in a sqlite session database
+shared by concurrent worker processes, as with the forking scgi server. Each
+worker looks up random sessions as fast as it can. All sessions start out
+old enough to need a refresh, so the workers also compete for writing.
+
+The "legacy" mode reproduces the previous behaviour (rollback journal, a
+commit and an immediate refresh per request, expiring on the request path),
+the "tuned" mode uses the current SessionHandler.
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from dokuforge.session import SessionHandler, connectsessiondb
+
+class LegacySessionHandler(SessionHandler):
+    def get(self, request):
+        now = time.time()
+        if self.lastexpire + self.hit_interval < now:
+            self.expire(now)
+        sid = request.cookies.get(self.cookie_name)
+        if sid is None:
+            return (None, None)
+        cur = self.db.cursor()
+        cur.execute(self.select_session, (sid,))
+        results = cur.fetchall()
+        if len(results) != 1:
+            self.db.commit()
+            cur.close()
+            return (sid, None)
+        username, updated = results[0]
+        if updated + self.hit_interval < now:
+            cur.execute(self.update_session, (now, sid))
+            self.db.commit()
+        self.db.commit()
+        cur.close()
+        return (sid, username)
+
+def legacyconnect(path):
+    sessiondb = sqlite3.connect(path)
+    cur = sessiondb.cursor()
+    cur.execute("PRAGMA synchronous = OFF;")
+    cur.execute(SessionHandler.create_table)
+    sessiondb.commit()
+    return sessiondb
+
+def worker(args):
+    mode, path, sids, requests, seed = args
+    if mode == "legacy":
+        handler = LegacySessionHandler(legacyconnect(path))
+        handler.lastexpire = 0
+    else:
+        handler = SessionHandler(connectsessiondb(path))
+    ## the sessions of the database must not expire during the run
+    handler.expire_after = int(time.time()) + 3600
+    rng = random.Random(seed)
+    environs = [EnvironBuilder(headers={"Cookie": "sid=" + sid}).get_environ()
+                for sid in sids]
+    found = 0
+    starttime = time.time()
+    for _ in range(requests):
+        if handler.get(Request(rng.choice(environs)))[1] is not None:
+            found += 1
+    handler.flush(force=True)
+    return time.time() - starttime, found
+
+def run(mode, workers, requests, sessions):
+    tmpdir = tempfile.mkdtemp(prefix="sessionbenchmark")
+    try:
+        path = os.path.join(tmpdir, "sessiondb.sqlite3")
+        db = connectsessiondb(path) if mode == "tuned" else legacyconnect(path)
+        sids = [u"%x" % i for i in range(sessions)]
+        db.executemany(SessionHandler.insert_session,
+                       [(sid, u"user%s" % sid, 0) for sid in sids])
+        db.commit()
+        db.close()
+        pool = multiprocessing.Pool(workers)
+        starttime = time.time()
+        results = pool.map(worker, [(mode, path, sids, requests, seed)
+                                    for seed in range(workers)])
+        elapsed = time.time() - starttime
+        pool.close()
+        pool.join()
+    finally:
+        shutil.rmtree(tmpdir, True)
+    busy = sum(result[0] for result in results)
+    total = workers * requests
+    assert sum(result[1] for result in results) == total
+    print("%-7s %6d requests in %6.2f s, %8.0f requests/s, %7.1f us/request"
+          % (mode, total, elapsed, total / elapsed, 1e6 * busy / total))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the session overhead with concurrent workers.")
+    parser.add_argument("-w", "--workers", type=int, default=32,
+                        help="number of worker processes (default: 32)")
+    parser.add_argument("-n", "--requests", type=int, default=2000,
+                        help="requests per worker (default: 2000)")
+    parser.add_argument("-s", "--sessions", type=int, default=1000,
+                        help="number of sessions (default: 1000)")
+    args = parser.parse_args()
+    for mode in ("legacy", "tuned"):
+        run(mode, args.workers, args.requests, args.sessions)
+
+if __name__ == "__main__":
+    main()
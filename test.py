@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import calendar
 import gzip
 import io
 import os
@@ -11,19 +12,38 @@ import tempfile
 import unittest
 from wsgiref.validate import validator
 import webtest
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request, Response
 from datetime import datetime, timezone
 import tarfile
+import textwrap
+import threading
+import time
 import subprocess
 
 import createexample
 from dokuforge import buildapp
+from dokuforge.application import Application
 from dokuforge.paths import PathConfig
-from dokuforge.parser import dfLineGroupParser, dfTitleParser, dfCaptionParser, Estimate, allowedMathSymbolCommands
+from dokuforge.parser import dfLineGroupParser, dfTitleParser, dfCaptionParser, Estimate, allowedMathSymbolCommands, wrap, Budget, escapePlainTex
 from dokuforge.common import TarWriter
+from dokuforge.catalog import Catalog, listAcademyNames
+from dokuforge.exportbuilder import ExportBuilder
+from dokuforge.exportcache import ExportCache, RecordingTarWriter, \
+    revisionvector
+from dokuforge.exportdelta import ManifestStore
+from dokuforge.exportdir import DirWriter
+from dokuforge.fragmentcache import FragmentCache, filestate
+from dokuforge.outlinecache import OutlineCache
+from dokuforge.session import SessionHandler, SignedSessionHandler, \
+    ThreadLocalDB, connectsessiondb
 from dokuforge.course import Course
 from dokuforge.academy import Academy
+import dokuforge.export
+import dokuforge.parser
+from dokuforge.parserprofile import ParserProfile
 from dokuforge.user import UserDB
-from dokuforge.storage import CachingStorage
+from dokuforge.storage import CachingStorage, LockDir
 
 try:
     Upload = webtest.Upload
@@ -87,6 +107,498 @@ class TarWriterTests(DfTestCase):
         tar = tar + tarwriter.close()
         self.assertIsTarGz(tar)
 
+    def testSameAsTarfile(self):
+        tmpdir = tempfile.mkdtemp(prefix="dokuforge").encode("ascii")
+        try:
+            filename = os.path.join(tmpdir, b"large.pdf")
+            with open(filename, "wb") as outfile:
+                outfile.write(os.urandom(3 * TarWriter.blocksize + 17))
+            timeStamp = datetime(2011, 8, 3, 12, 30, tzinfo=timezone.utc)
+            name = u'x' * 120 + u'\xe4'
+
+            expected = io.BytesIO()
+            tar = tarfile.open(mode="w|", fileobj=expected,
+                               encoding="iso8859-1")
+            info = tarfile.TarInfo(u"prefix/" + name)
+            info.size = 3
+            info.mtime = calendar.timegm(timeStamp.utctimetuple())
+            tar.addfile(info, io.BytesIO(b"abc"))
+            info = tarfile.TarInfo(u"prefix/large.pdf")
+            info.size = os.path.getsize(filename)
+            info.mtime = os.path.getmtime(filename)
+            with open(filename, "rb") as infile:
+                tar.addfile(info, infile)
+            tar.close()
+
+            for compressed in (False, True):
+                tarwriter = TarWriter(gzip=compressed)
+                tarwriter.pushd(b"prefix")
+                chunks = [tarwriter.addChunk(name.encode("iso8859-1"), b"abc",
+                                             timeStamp)]
+                chunks.extend(tarwriter.addFileIterator(b"large.pdf",
+                                                        filename))
+                tarwriter.popd()
+                chunks.append(tarwriter.close())
+                tar = b"".join(chunks)
+                if not compressed:
+                    self.assertTrue(all(len(chunk) <= TarWriter.blocksize
+                                        for chunk in chunks))
+                else:
+                    self.assertIsTarGz(tar)
+                    tar = gzip.decompress(tar)
+                self.assertEqual(tar, expected.getvalue())
+        finally:
+            shutil.rmtree(tmpdir, True)
+
+    def testReproducible(self):
+        tmpdir = tempfile.mkdtemp(prefix="dokuforge").encode("ascii")
+        try:
+            for name in (b"b", b"a", b"c"):
+                os.makedirs(os.path.join(tmpdir, name))
+                with open(os.path.join(tmpdir, name, name), "wb") as f:
+                    f.write(name)
+            def export():
+                tarwriter = TarWriter(gzip=True)
+                return b''.join(list(tarwriter.addDirChunk(b'x', tmpdir)) +
+                                [tarwriter.close()])
+            tar = export()
+            time.sleep(1.1)
+            self.assertEqual(export(), tar)
+            tarFile = tarfile.open(mode='r', fileobj=io.BytesIO(tar))
+            self.assertEqual(tarFile.getnames(), ['x/a/a', 'x/b/b', 'x/c/c'])
+        finally:
+            shutil.rmtree(tmpdir, True)
+
+    def testParallelGzip(self):
+        timeStamp = datetime(2011, 8, 3, 12, 30, tzinfo=timezone.utc)
+        files = [(b'file%d' % i, os.urandom(i * 1000) + b'text' * i * 1000,
+                  timeStamp) for i in range(10)]
+        expected = TarWriter()
+        expected = b''.join([expected.addChunk(*f) for f in files] +
+                            [expected.close()])
+        for level in (1, 9):
+            tarwriter = TarWriter(gzip=True, gziplevel=level, gzipthreads=3)
+            tarwriter.compressor.blocksize = 10000
+            tar = b''.join([tarwriter.addChunk(*f) for f in files] +
+                           [tarwriter.close()])
+            self.assertIsTarGz(tar)
+            self.assertEqual(gzip.decompress(tar), expected)
+
+    def testRecordAndReplay(self):
+        timeStamp = datetime(2011, 8, 3, 12, 30, tzinfo=timezone.utc)
+        files = [(b'course01/chap.tex', b'contents', timeStamp),
+                 (b'course01/' + b'x' * 120 + u'\xe4'.encode('utf8'),
+                  b'\0' * 1000, datetime.fromtimestamp(0, timezone.utc))]
+        direct = TarWriter()
+        direct.pushd(b'prefix')
+        record = io.BytesIO()
+        recorder = RecordingTarWriter(direct, record)
+        tar = b''.join(recorder.addChunk(*f) for f in files)
+        recorder.close()
+        direct.popd()
+        tar += direct.close()
+
+        replayed = TarWriter()
+        replayed.pushd(b'prefix')
+        record.seek(0)
+        replayedtar = b''.join(ExportCache(b'/nonexistent').replay(record,
+                                                                   replayed))
+        replayed.popd()
+        replayedtar += replayed.close()
+        self.assertEqual(tar, replayedtar)
+
+    def testRevisionVector(self):
+        tmpdir = tempfile.mkdtemp(prefix="dokuforge").encode("ascii")
+        try:
+            for name, head in ((b"title,v", b"1.3"), (b"page0,v", b"1.2"),
+                               (b"isDeleted,v", b"1.1")):
+                with open(os.path.join(tmpdir, name), "wb") as rcsfile:
+                    rcsfile.write(b"head\t%s;\naccess;\n" % head)
+            with open(os.path.join(tmpdir, b"page0"), "wb") as f:
+                f.write(b"checked out")
+            ## the implicitly created isDeleted,v counts as missing
+            self.assertEqual(revisionvector(tmpdir),
+                             [(b"page0,v", b"1.2"), (b"title,v", b"1.3")])
+        finally:
+            shutil.rmtree(tmpdir, True)
+
+    def testBuildAllSkipsInvalidNames(self):
+        tmpdir = tempfile.mkdtemp(prefix="dokuforge").encode("ascii")
+        try:
+            dfdir = os.path.join(tmpdir, b"df")
+            for name in (b"lost+found", b".git"):
+                os.makedirs(os.path.join(dfdir, name))
+            with open(os.path.join(dfdir, b"notes"), "wb") as f:
+                f.write(b"not an academy")
+            builder = ExportBuilder(dfdir, os.path.join(tmpdir, b"cache"))
+            self.assertTrue(builder.buildall())
+            self.assertFalse(os.path.exists(builder.path))
+        finally:
+            shutil.rmtree(tmpdir, True)
+
+    def testExportUnknownCourse(self):
+        tmpdir = tempfile.mkdtemp(prefix="dokuforge").encode("ascii")
+        try:
+            os.makedirs(os.path.join(tmpdir, b"df", b"xa2011-1"))
+            with self.assertRaisesRegex(ValueError, "unknown course nope"):
+                dokuforge.export.process(os.path.join(tmpdir, b"df"), None,
+                                         b"xa2011-1", coursename=b"nope",
+                                         outdir=tmpdir)
+        finally:
+            shutil.rmtree(tmpdir, True)
+
+class DeltaExportTests(DfTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="dokuforge").encode("ascii")
+        self.store = ManifestStore(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, True)
+
+    def export(self, since, files):
+        tarwriter = self.store.tarwriter(b'aca', 'texexport', since)
+        if tarwriter is None:
+            return None
+        tarwriter.pushd(b'aca')
+        tar = b''.join(tarwriter.addChunk(*f) for f in files)
+        tarwriter.popd()
+        tar += tarwriter.close()
+        self.assertIsTar(tar)
+        tarFile = tarfile.open(mode='r', fileobj=io.BytesIO(tar))
+        return dict((m.name, tarFile.extractfile(m).read())
+                    for m in tarFile.getmembers())
+
+    def testDelta(self):
+        old = datetime(2011, 8, 3, 12, 30, tzinfo=timezone.utc)
+        new = datetime(2011, 8, 4, 12, 30, tzinfo=timezone.utc)
+        files = [(b'a.tex', b'a', old), (b'b.tex', b'b', old),
+                 (b'c.tex', b'c', old)]
+        full = self.export(u'0', files)
+        self.assertEqual(sorted(full), ['DELETED', 'TOKEN', 'aca/a.tex',
+                                        'aca/b.tex', 'aca/c.tex'])
+        token = full['TOKEN'].strip().decode('ascii')
+        unchanged = self.export(token, files)
+        self.assertEqual(sorted(unchanged), ['DELETED', 'TOKEN'])
+        self.assertEqual(unchanged['TOKEN'], full['TOKEN'])
+
+        files = [(b'a.tex', b'a', old), (b'b.tex', b'B', new),
+                 (b'd.tex', b'd', new)]
+        delta = self.export(token, files)
+        self.assertEqual(sorted(delta), ['DELETED', 'TOKEN', 'aca/b.tex',
+                                         'aca/d.tex'])
+        self.assertEqual(delta['DELETED'], b'aca/c.tex\n')
+        self.assertNotEqual(delta['TOKEN'], full['TOKEN'])
+
+        bytime = self.export(str(calendar.timegm(old.utctimetuple())), files)
+        self.assertEqual(sorted(bytime), ['DELETED', 'TOKEN', 'aca/b.tex',
+                                          'aca/d.tex'])
+        self.assertEqual(bytime['DELETED'], b'')
+
+    def testUnknownToken(self):
+        self.assertIsNone(self.export(u'0' * 40, []))
+        self.assertIsNone(self.export(u'../../etc/passwd', []))
+
+class DirWriterTests(DfTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="dokuforge").encode("ascii")
+        self.static = os.path.join(self.tmpdir, b'static')
+        os.makedirs(os.path.join(self.static, b'sub'))
+        with open(os.path.join(self.static, b'sub', b'style.sty'), 'wb') as f:
+            f.write(b'\\relax\n')
+        self.out = os.path.join(self.tmpdir, b'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, True)
+
+    def export(self, files):
+        dirwriter = DirWriter(self.out, os.path.join(self.tmpdir,
+                                                     b'.aca.manifest'))
+        dirwriter.pushd(b'aca')
+        for f in files:
+            dirwriter.addChunk(*f)
+        for _ in dirwriter.addDirChunk(b'', self.static):
+            pass
+        dirwriter.popd()
+        self.assertEqual(dirwriter.close(), b'')
+        return dirwriter
+
+    def testSameAsTar(self):
+        date = datetime(2011, 8, 3, 12, 30, tzinfo=timezone.utc)
+        files = [(b'a.tex', b'a', date), (b'course01/chap.tex', b'chap', date)]
+        self.export(files)
+        tarwriter = TarWriter()
+        tarwriter.pushd(b'aca')
+        tar = b''.join(tarwriter.addChunk(*f) for f in files)
+        tar += b''.join(tarwriter.addDirChunk(b'', self.static))
+        tarwriter.popd()
+        tar += tarwriter.close()
+        tarFile = tarfile.open(mode='r', fileobj=io.BytesIO(tar))
+        for member in tarFile.getmembers():
+            filename = os.path.join(self.out, member.name.encode('ascii'))
+            with open(filename, 'rb') as f:
+                self.assertEqual(f.read(), tarFile.extractfile(member).read())
+            self.assertEqual(os.path.getmtime(filename), member.mtime)
+        linked = os.path.join(self.out, b'aca', b'sub', b'style.sty')
+        self.assertTrue(os.path.samefile(linked, os.path.join(
+            self.static, b'sub', b'style.sty')))
+
+    def testOnlyChangesWritten(self):
+        old = datetime(2011, 8, 3, 12, 30, tzinfo=timezone.utc)
+        new = datetime(2011, 8, 4, 12, 30, tzinfo=timezone.utc)
+        self.export([(b'a.tex', b'a', old), (b'b.tex', b'b', old)])
+        dirwriter = self.export([(b'a.tex', b'a', new), (b'b.tex', b'B', new)])
+        self.assertEqual((dirwriter.written, dirwriter.linked,
+                          dirwriter.unchanged), (1, 0, 2))
+        afile = os.path.join(self.out, b'aca', b'a.tex')
+        self.assertEqual(os.path.getmtime(afile),
+                         calendar.timegm(old.utctimetuple()))
+        with open(os.path.join(self.out, b'aca', b'b.tex'), 'rb') as f:
+            self.assertEqual(f.read(), b'B')
+
+    def testStaleFilesRemoved(self):
+        date = datetime(2011, 8, 3, 12, 30, tzinfo=timezone.utc)
+        self.export([(b'a.tex', b'a', date),
+                     (b'course01/chap.tex', b'chap', date),
+                     (b'course01/blob_1_bild.png', b'png', date),
+                     (b'course02/chap.tex', b'chap', date)])
+        ## output of LaTeX and files added by hand
+        for name in (b'a.aux', b'a.pdf', b'course01/notes.txt'):
+            with open(os.path.join(self.out, b'aca', name), 'wb') as f:
+                f.write(b'keep')
+        dirwriter = self.export([(b'a.tex', b'a', date),
+                                 (b'course01/chap.tex', b'chap', date)])
+        self.assertEqual(dirwriter.removed, 2)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.out, b'aca', b'course01', b'blob_1_bild.png')))
+        self.assertFalse(os.path.exists(os.path.join(self.out, b'aca',
+                                                     b'course02')))
+        for name in (b'a.aux', b'a.pdf', b'course01/notes.txt',
+                     b'sub/style.sty'):
+            self.assertTrue(os.path.exists(os.path.join(self.out, b'aca',
+                                                        name)))
+        self.assertEqual(sorted(dirwriter.readmanifest()),
+                         [b'aca/a.tex', b'aca/course01/chap.tex',
+                          b'aca/sub/style.sty'])
+
+    def testNothingRemovedWithoutManifest(self):
+        date = datetime(2011, 8, 3, 12, 30, tzinfo=timezone.utc)
+        self.export([(b'a.tex', b'a', date), (b'b.tex', b'b', date)])
+        dirwriter = DirWriter(self.out)
+        dirwriter.pushd(b'aca')
+        dirwriter.addChunk(b'a.tex', b'a', date)
+        dirwriter.popd()
+        dirwriter.close()
+        self.assertEqual(dirwriter.removed, 0)
+        self.assertTrue(os.path.exists(os.path.join(self.out, b'aca',
+                                                    b'b.tex')))
+
+class FragmentCacheTests(DfTestCase):
+    def testEviction(self):
+        cache = FragmentCache(10)
+        generated = []
+        def generate(fragment):
+            def generator():
+                generated.append(fragment)
+                return fragment
+            return generator
+        self.assertEqual(cache.lookup(1, generate(u"aaaa")), u"aaaa")
+        self.assertEqual(cache.lookup(2, generate(u"bbbb")), u"bbbb")
+        self.assertEqual(cache.lookup(1, generate(u"xxxx")), u"aaaa")
+        # evicts the least recently used fragment 2
+        self.assertEqual(cache.lookup(3, generate(u"cccc")), u"cccc")
+        self.assertEqual(cache.lookup(1, generate(u"xxxx")), u"aaaa")
+        self.assertEqual(cache.lookup(2, generate(u"BBBB")), u"BBBB")
+        self.assertEqual(generated, [u"aaaa", u"bbbb", u"cccc", u"BBBB"])
+        self.assertTrue(cache.size <= 10)
+        # fragments exceeding the whole cache are not stored
+        cache.lookup(4, generate(u"\xe4" * 6))
+        cache.lookup(4, generate(u"\xe4" * 6))
+        self.assertEqual(generated[-2:], [u"\xe4" * 6] * 2)
+
+    def testFileState(self):
+        tmpdir = tempfile.mkdtemp(prefix="dokuforge").encode("ascii")
+        try:
+            filename = os.path.join(tmpdir, b"page0,v")
+            missing = filestate([filename])
+            with open(filename, "wb") as f:
+                f.write(b"head 1.1;")
+            state = filestate([filename])
+            self.assertNotEqual(state, missing)
+            self.assertEqual(filestate([filename]), state)
+            with open(filename, "wb") as f:
+                f.write(b"head 1.10;")
+            self.assertNotEqual(filestate([filename])[0], state[0])
+        finally:
+            shutil.rmtree(tmpdir, True)
+
+class SessionHandlerTests(DfTestCase):
+    def setUp(self):
+        self.db = connectsessiondb(u":memory:")
+        self.handler = SessionHandler(self.db)
+
+    def request(self, sid):
+        return Request(EnvironBuilder(headers={"Cookie": "sid=" + sid})
+                       .get_environ())
+
+    def updated(self, sid):
+        return self.db.execute("SELECT updated FROM sessions WHERE sid = ?;",
+                               (sid,)).fetchone()[0]
+
+    def testDeferredRefresh(self):
+        sid = self.handler.set(Response(), u"bob")
+        self.db.execute("UPDATE sessions SET updated = 0 WHERE sid = ?;",
+                        (sid,))
+        self.db.commit()
+        self.assertEqual(self.handler.get(self.request(sid)), (sid, u"bob"))
+        self.assertFalse(self.db.in_transaction)
+        self.assertEqual(self.updated(sid), 0)
+        self.handler.flush(force=True)
+        self.assertGreater(self.updated(sid), 0)
+        self.handler.delete(Response(), sid)
+        self.assertEqual(self.handler.get(self.request(sid)), (sid, None))
+
+    def testExpire(self):
+        sid = self.handler.set(Response(), u"bob")
+        self.handler.expire(time.time() + self.handler.expire_after + 1)
+        self.assertEqual(self.handler.get(self.request(sid)), (sid, None))
+
+    def testQueriesOutsideLock(self):
+        handler = self.handler
+        class CheckingDB(object):
+            def __init__(self, db):
+                self.db = db
+                self.entered = 0
+            def __enter__(self):
+                self.entered += 1
+                assert not handler.lock.locked()
+                return self.db.__enter__()
+            def __exit__(self, *args):
+                return self.db.__exit__(*args)
+        handler.db = CheckingDB(self.db)
+        sid = handler.set(Response(), u"bob")
+        self.db.execute("UPDATE sessions SET updated = 0 WHERE sid = ?;",
+                        (sid,))
+        self.db.commit()
+        self.assertEqual(handler.get(self.request(sid)), (sid, u"bob"))
+        handler.lastexpire = 0
+        handler.flush(force=True)
+        handler.delete(Response(), sid)
+        self.assertEqual(handler.db.entered, 5)
+
+class ThreadSafetyTests(DfTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="dokuforge").encode("ascii")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, True)
+
+    def testLockDirPerThread(self):
+        lock = LockDir(os.path.join(self.tmpdir, b"#lock.test"))
+        events = []
+        def other():
+            with lock:
+                events.append("other")
+        with lock:
+            with lock:
+                thread = threading.Thread(target=other)
+                thread.start()
+                time.sleep(0.3)
+                events.append("main")
+        thread.join()
+        self.assertEqual(events, ["main", "other"])
+        self.assertFalse(os.path.exists(lock.path))
+
+    def checkSessionsFromThreads(self, db):
+        handler = SessionHandler(db)
+        sids = [handler.set(Response(), u"user%d" % i) for i in range(8)]
+        results = []
+        def lookup(sid):
+            request = Request(EnvironBuilder(
+                headers={"Cookie": "sid=" + sid}).get_environ())
+            for _ in range(50):
+                results.append(handler.get(request))
+        threads = [threading.Thread(target=lookup, args=(sid,))
+                   for sid in sids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(set(results)),
+                         sorted((sid, u"user%d" % i)
+                                for i, sid in enumerate(sids)))
+        self.assertEqual(len(results), 400)
+
+    def testSessionsFromThreads(self):
+        self.checkSessionsFromThreads(ThreadLocalDB(
+            os.path.join(self.tmpdir, b"sessions").decode()))
+
+    def testSessionsFromThreadsInMemory(self):
+        self.checkSessionsFromThreads(ThreadLocalDB(u":memory:"))
+
+class SignedSessionTests(DfTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="dokuforge").encode("ascii")
+        revocations = os.path.join(self.tmpdir, b"revoked")
+        self.handler = SignedSessionHandler(b"secret", revocations)
+        self.other = SignedSessionHandler(b"secret", revocations)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, True)
+
+    def request(self, sid):
+        return Request(EnvironBuilder(headers={"Cookie": "sid=" + sid})
+                       .get_environ())
+
+    def testRoundTrip(self):
+        sid = self.handler.set(Response(), u"bj\xf6rn")
+        self.assertEqual(self.other.get(self.request(sid)), (sid, u"bj\xf6rn"))
+        self.assertEqual(self.handler.get(Request(EnvironBuilder()
+                                                  .get_environ())),
+                         (None, None))
+
+    def testTampered(self):
+        sid = self.handler.set(Response(), u"bob")
+        forged = sid.replace(sid.split(u".")[2], u"YWRtaW4")
+        self.assertEqual(self.handler.get(self.request(forged)),
+                         (forged, None))
+        foreign = SignedSessionHandler(b"other")
+        self.assertEqual(foreign.get(self.request(sid)), (sid, None))
+
+    def testExpired(self):
+        sid = self.handler.issue(u"bob", time.time() -
+                                 self.handler.expire_after - 1)
+        self.assertEqual(self.handler.get(self.request(sid)), (sid, None))
+
+    def testRevocation(self):
+        sid = self.handler.set(Response(), u"bob")
+        self.assertEqual(self.other.get(self.request(sid)), (sid, u"bob"))
+        self.handler.delete(Response(), sid)
+        self.assertEqual(self.handler.get(self.request(sid)), (sid, None))
+        self.other.sync(force=True)
+        self.assertEqual(self.other.get(self.request(sid)), (sid, None))
+        self.handler.compact()
+        fresh = SignedSessionHandler(b"secret", self.handler.revocationpath)
+        self.assertEqual(fresh.get(self.request(sid)), (sid, None))
+
+    def testRevocationAfterCompaction(self):
+        sids = [self.handler.set(Response(), u"user%d" % i) for i in range(3)]
+        for sid in sids[:2]:
+            self.handler.delete(Response(), sid)
+        self.other.sync(force=True)
+        ## the compacted file is shorter than what other has read so far
+        self.handler.compact()
+        self.handler.delete(Response(), sids[2])
+        self.other.sync(force=True)
+        self.assertEqual(self.other.get(self.request(sids[2])),
+                         (sids[2], None))
+        ## and the same with a compacted file growing beyond that again
+        self.handler.compact()
+        for i in range(5):
+            sid = self.handler.set(Response(), u"more%d" % i)
+            self.handler.delete(Response(), sid)
+        self.other.sync(force=True)
+        self.assertEqual(self.other.get(self.request(sid)), (sid, None))
+
 class UserDBTests(DfTestCase):
     def setUp(self):
         self.tmpdir = tempfile.mkdtemp(prefix="dokuforge").encode("ascii")
@@ -236,6 +748,21 @@ permissions = df_meta True,akademie_meta_aca123 False
         user = self.getUser("userfoo")
         self.assertTrue(user.allowedMeta(self.academy))
 
+    def testFilterReadable(self):
+        self.writeUserDbFile(b"""
+[userfoo]
+status = cde_dokubeauftragter
+password = abc
+permissions = akademie_read_aca123 True,kurs_read_aca123_course42 False
+""")
+        user = self.getUser("userfoo")
+        courses = self.academy.listCourses()
+        self.assertEqual([c.name for c in user.filterReadable(courses,
+                                                              self.academy)],
+                         [b'course4711'])
+        self.assertEqual(user.filterReadable([self.academy]), [self.academy])
+        self.assertIs(self.getUser("userfoo"), user)
+
 class DokuforgeWebTests(DfTestCase):
     url = "http://www.dokuforge.de"
     size = None  # will be set in derived classes
@@ -351,6 +878,42 @@ class DokuforgeSmallWebTests(DokuforgeWebTests):
             self.res.mustcontain(outputstr)
         self.is_loggedin()
 
+    def testConditionalGet(self):
+        self.do_login()
+        self.res = self.res.click(description="X-Akademie")
+        academyurl = self.res.request.url
+        self.res = self.res.click(href="course01/$")
+        self.res = self.res.click(href="course01/0/$", index=0)
+        pageurl = self.res.request.url
+        etag = self.res.headers["ETag"]
+        self.assertIn("Last-Modified", self.res.headers)
+        self.assertIn("Cookie", self.res.headers["Vary"])
+        self.app.get(pageurl, headers={"If-None-Match": etag}, status=304)
+        academyetag = self.app.get(academyurl).headers["ETag"]
+        self.res = self.res.click(description="Editieren", index=0)
+        form = self.res.forms[1]
+        form["content"] = "neuer Inhalt"
+        self.res = form.submit(name="saveshow")
+        self.res = self.app.get(pageurl, headers={"If-None-Match": etag})
+        self.assertEqual(self.res.status_int, 200)
+        self.res.mustcontain("neuer Inhalt")
+        self.app.get(academyurl, headers={"If-None-Match": academyetag},
+                     status=200)
+
+    def testWarmup(self):
+        self.pathconfig.sessiondbpath = os.path.join(
+            self.tmpdir, b"sessions.sqlite3").decode("ascii")
+        app = Application(self.pathconfig)
+        app.warmup(pages=1)
+        ## the session expirer thread must only be started after forking
+        self.assertIsNone(app.sessionhandler.expirerpid)
+        self.assertGreater(len(app.fragmentcache.entries), 0)
+        self.assertGreater(len(app.catalog.entries), 0)
+        ## the outlines are cached with and without the write buttons
+        self.assertEqual(set(key[5] for key in app.fragmentcache.entries
+                             if key[0] == "course.html"),
+                         set([True, False]))
+
     def testMarkup(self):
         self.do_login()
         self.res = self.res.click(description="X-Akademie")
@@ -924,6 +1487,149 @@ class DokuforgeExporterTests(DokuforgeWebTests):
         fortschrittCourselistText = tarFile.extractfile("texexport_xa2011-1/fortschritt-courselist.txt").read().decode()
         self.assertIn("[ ] Redaktion: NN", fortschrittCourselistText)
 
+    def testParallelExportIdentical(self):
+        academy = Academy(os.path.join(self.pathconfig.dfdir, b"xa2011-1"),
+                          lambda: [])
+        def members(workers):
+            octets = b"".join(academy.texExport(workers=workers))
+            tarFile = tarfile.open(mode='r', fileobj=io.BytesIO(octets))
+            return [(m.name, tarFile.extractfile(m).read())
+                    for m in tarFile.getmembers()]
+        self.assertEqual(members(0), members(2))
+
+    def testCachedExportIdentical(self):
+        academy = Academy(os.path.join(self.pathconfig.dfdir, b"xa2011-1"),
+                          lambda: [])
+        cache = ExportCache(self.pathconfig.cachedir)
+        def members(cache):
+            octets = b"".join(academy.texExport(cache=cache))
+            tarFile = tarfile.open(mode='r', fileobj=io.BytesIO(octets))
+            return [(m.name, m.mtime, tarFile.extractfile(m).read())
+                    for m in tarFile.getmembers()
+                    if not m.name.endswith("/WARNING")]
+        uncached = members(None)
+        self.assertEqual(members(cache), uncached)
+        for course in academy.listCourses():
+            self.assertTrue(cache.iscached(course))
+        self.assertEqual(members(cache), uncached)
+
+        course = academy.getCourse(u"course01")
+        version, content = course.editpage(0)
+        course.savepage(0, version, u"[Neu]\nfrisch gespeichert", u"bob")
+        self.assertFalse(cache.iscached(course))
+        chap = dict((name, data) for name, _, data in members(cache))
+        self.assertIn(b"frisch gespeichert",
+                      chap["texexport_xa2011-1/course01/chap.tex"])
+        self.assertTrue(cache.iscached(course))
+
+    def testPrebuiltExport(self):
+        builder = ExportBuilder(self.pathconfig.dfdir, self.pathconfig.cachedir,
+                                self.pathconfig.staticexportdir)
+        builder.buildall()
+        academy = builder.getAcademy(b"xa2011-1")
+        filename, key = builder.lookup(academy, "texexport")
+        with open(filename, "rb") as prebuilt:
+            content = prebuilt.read()
+        self.assertIsTarGz(content)
+        self.assertFalse(builder.build(academy, "texexport"))
+        self.do_login()
+        self.res = self.res.click(description="X-Akademie")
+        self.res = self.res.click(description="Export")
+        self.assertEqual(self.res.body, content)
+        self.assertEqual(self.res.headers["ETag"], '"%s"' % key.decode())
+        self.assertIn("Last-Modified", self.res.headers)
+        self.app.get(self.res.request.url,
+                     headers={"If-None-Match": '"%s"' % key.decode()},
+                     status=304)
+
+        course = academy.getCourse(u"course01")
+        version, _ = course.editpage(0)
+        course.savepage(0, version, u"[Neu]\nfrisch gespeichert", u"bob")
+        self.assertIsNone(builder.lookup(academy, "texexport"))
+        self.assertIsNone(builder.lookup(academy, "raw"))
+        self.assertTrue(builder.build(academy, "texexport"))
+        self.assertNotEqual(builder.lookup(academy, "texexport")[1], key)
+        self.assertEqual(len(os.listdir(builder.directory(academy))), 3)
+
+    def testReproducibleExport(self):
+        self.do_login()
+        url = "/docs/xa2011-1/!export"
+        self.res = self.app.get(url)
+        etag = self.res.headers["ETag"]
+        self.assertIsTarGz(self.res.body)
+        ## generating the export must not change the state it is tagged with
+        builder = ExportBuilder(self.pathconfig.dfdir, self.pathconfig.cachedir,
+                                self.pathconfig.staticexportdir)
+        key = builder.key(builder.getAcademy(b"xa2011-1"), "texexport")
+        self.assertEqual(etag, '"%s"' % key.decode())
+        self.assertEqual(self.app.get(url).body, self.res.body)
+        self.app.get(url, headers={"If-None-Match": etag}, status=304)
+        course = Academy(os.path.join(self.pathconfig.dfdir, b"xa2011-1"),
+                         lambda: []).getCourse(u"course01")
+        version, _ = course.editpage(0)
+        course.savepage(0, version, u"[Neu]\nfrisch gespeichert", u"bob")
+        self.res = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertNotEqual(self.res.headers["ETag"], etag)
+
+    def testCommandLineExportSkipsUpToDate(self):
+        outdir = os.path.join(self.tmpdir, b"out")
+        os.mkdir(outdir)
+        arguments = (self.pathconfig.dfdir, self.pathconfig.staticexportdir,
+                     b"xa2011-1")
+        self.assertTrue(dokuforge.export.process(*arguments, outdir=outdir))
+        filename = os.path.join(outdir, b"texexport_xa2011-1.tar")
+        with open(filename, "rb") as exported:
+            self.assertIsTar(exported.read())
+        self.assertFalse(dokuforge.export.process(*arguments, outdir=outdir))
+        self.assertTrue(dokuforge.export.process(*arguments, outdir=outdir,
+                                                 force=True))
+        course = Academy(os.path.join(self.pathconfig.dfdir, b"xa2011-1"),
+                         lambda: []).getCourse(u"course01")
+        version, _ = course.editpage(0)
+        course.savepage(0, version, u"[Neu]\nfrisch gespeichert", u"bob")
+        self.assertTrue(dokuforge.export.process(*arguments, outdir=outdir))
+        self.assertEqual(sorted(os.listdir(outdir)),
+                         [b".texexport_xa2011-1.tar.key",
+                          b"texexport_xa2011-1.tar"])
+
+    def testCourseExport(self):
+        self.do_login()
+        self.res = self.res.click(description="X-Akademie")
+        self.res = self.res.click(href="course01/$")
+        self.res = self.res.click(description="^Export$")
+        self.assertIsTarGz(self.res.body)
+        tarFile = tarfile.open(mode='r', fileobj=io.BytesIO(self.res.body))
+        memberNames = tarFile.getnames()
+        self.assertIn('texexport_xa2011-1/course01/chap.tex', memberNames)
+        self.assertIn('texexport_xa2011-1/WARNING', memberNames)
+        self.assertNotIn('texexport_xa2011-1/course02/chap.tex', memberNames)
+        self.assertNotIn('texexport_xa2011-1/contents.tex', memberNames)
+
+    def testDeltaExport(self):
+        self.do_login()
+        def members(since, status=200):
+            self.res = self.app.get("/docs/xa2011-1/!export",
+                                    params=dict(since=since), status=status)
+            if status != 200:
+                return None
+            tarFile = tarfile.open(mode='r', fileobj=io.BytesIO(self.res.body))
+            return dict((m.name, tarFile.extractfile(m).read())
+                        for m in tarFile.getmembers())
+        full = members("0")
+        self.assertIn("texexport_xa2011-1/course01/chap.tex", full)
+        token = full["TOKEN"].strip().decode("ascii")
+        self.assertEqual(sorted(members(token)), ["DELETED", "TOKEN"])
+
+        course = Academy(os.path.join(self.pathconfig.dfdir, b"xa2011-1"),
+                         lambda: []).getCourse(u"course01")
+        version, _ = course.editpage(0)
+        course.savepage(0, version, u"[Neu]\nfrisch gespeichert", u"bob")
+        delta = members(token)
+        self.assertIn(b"frisch gespeichert",
+                      delta["texexport_xa2011-1/course01/chap.tex"])
+        self.assertNotIn("texexport_xa2011-1/course02/chap.tex", delta)
+        members("nonsense", status=400)
+
     def testAddDifferentImageBlobs(self):
         imageFilenamesUnchanged = ['fig_platzhalter.jpg',
                                    'fig_platzhalter.png',
@@ -1098,6 +1804,34 @@ class CourseTests(DfTestCase):
         self.course.undelete()
         self.assertFalse(self.course.isDeleted)
 
+    def testBatchedCommits(self):
+        for _ in range(3):
+            self.course.newpage(user=u"bob")
+        self.course.getstorage(b"page1").store(b"changed", user=b"alice")
+        pages = self.course.listpages()
+        self.assertEqual(self.course.getcommits(pages),
+                         [self.course.getcommit(p) for p in pages])
+        self.assertEqual(self.course.getcommits(pages)[1]["author"], u"alice")
+
+    def testOutlineCache(self):
+        cache = OutlineCache(os.path.join(self.tmpdir, b'cache'))
+        def summary(outlines):
+            return [(o.number, o.items(), o.estimate, o.versionstring)
+                    for o in outlines]
+        for _ in range(3):
+            self.course.newpage(user=u"bob")
+        version, _ = self.course.editpage(1)
+        self.course.savepage(1, version, u"[Eins]\n\nText", u"bob")
+        self.assertEqual(summary(cache.outlines(self.course)),
+                         summary(self.course.outlinepages()))
+        self.assertTrue(os.path.isfile(cache.filename(self.course)))
+        version, _ = self.course.editpage(1)
+        self.course.savepage(1, version, u"[Zwei]\n\n{{Zwei}}", u"alice")
+        self.course.delpage(2, user=u"bob")
+        outlines = cache.outlines(self.course)
+        self.assertEqual(summary(outlines), summary(self.course.outlinepages()))
+        self.assertEqual(outlines[1].items(), [("heading", u"Zwei")])
+
 class AcademyTest(DfTestCase):
     def setUp(self):
         self.tmpdir = tempfile.mkdtemp(prefix='dokuforge').encode("ascii")
@@ -1138,6 +1872,32 @@ class AcademyTest(DfTestCase):
         self.assertCourses([b'legacy', b'new01', b'new02'])
         self.assertDeadCourses([])
 
+    def testCatalog(self):
+        catalog = Catalog(self.tmpdir, lambda: dict())
+        self.assertEqual([a.name for a in catalog.listAcademies()],
+                         [b'example'])
+        self.assertEqual([c.name for c in catalog.listCourses(self.academy)],
+                         [b'legacy', b'new01', b'new02'])
+        self.academy.getCourse('new01').delete()
+        self.academy.getCourse('new02').settitle(u'umbenannt')
+        self.academy.createCourse('new03', 'dritter neuer Kurs')
+        self.assertEqual([c.name for c in catalog.listCourses(self.academy)],
+                         [b'legacy', b'new02', b'new03'])
+        self.assertEqual([c.name for c in
+                          catalog.listCourses(self.academy, deleted=True)],
+                         [b'new01'])
+        view = catalog.viewAcademy(self.academy)
+        self.assertEqual([c["title"] for c in view["courses"]][1:],
+                         [u'umbenannt', u'dritter neuer Kurs'])
+
+    def testListAcademyNames(self):
+        for name in (b"lost+found", b".git", b"zz2011-1"):
+            os.mkdir(os.path.join(self.tmpdir, name))
+        with open(os.path.join(self.tmpdir, b"notes"), "wb") as f:
+            f.write(b"not an academy")
+        self.assertEqual(listAcademyNames(self.tmpdir),
+                         [b"example", b"zz2011-1"])
+
 class EstimatorTests(DfTestCase):
     def test_estimates(self):
         lipsum = "Lorem ipsum dolor sit amet. "
@@ -1162,6 +1922,16 @@ class EstimatorTests(DfTestCase):
         self.assertAlmostEqual(estimate.ednotepages, 0.0)
         self.assertAlmostEqual(estimate.blobpages,   0.6666666666)
 
+    def test_estimate_arithmetic(self):
+        a = Estimate(1, 2, 3.5, 4)
+        b = Estimate(10, 20, 30, 40)
+        self.assertEqual(a + b, Estimate(11, 22, 33.5, 44))
+        self.assertIsInstance(a + b, Estimate)
+        self.assertEqual(2 * a, Estimate(2, 4, 7.0, 8))
+        self.assertEqual(Estimate.sum([a, b, a]), a + b + a)
+        self.assertIsInstance(Estimate.sum([]), Estimate)
+        self.assertEqual(Estimate.sum([]), Estimate.fromNothing())
+
 class DokuforgeMockTests(DfTestCase):
     def verify_idempotency(self, inp):
         inp2 = dfLineGroupParser(inp).toDF()
@@ -1178,6 +1948,32 @@ class DokuforgeMockTests(DfTestCase):
     def testParserIdempotency1(self):
         self.verify_idempotency('_a\n[[[\n\n"')
 
+    def testParseTreeHasNoInstanceDicts(self):
+        def walk(ptree):
+            yield ptree
+            for cls in type(ptree).__mro__:
+                for name in cls.__dict__.get("__slots__", ()):
+                    value = getattr(ptree, name)
+                    if isinstance(value, list):
+                        for v in value:
+                            for node in walk(v):
+                                yield node
+                    elif hasattr(value, "toDF"):
+                        for node in walk(value):
+                            yield node
+        inp = u"[A]\n(B)\n\n_c_ $d$ $$e$$ {f} <g>\n- h\n1. i\n*j* k"
+        nodes = list(walk(dfLineGroupParser(inp)))
+        self.assertGreater(len(nodes), 10)
+        for node in nodes:
+            self.assertFalse(hasattr(node, "__dict__"), repr(node))
+
+    def testOnlyShortLeavesInterned(self):
+        short = u"".join([u" ", u" "])
+        self.assertIs(dokuforge.parser.PLeaf(short).text,
+                      dokuforge.parser.intern(u"  "))
+        text = u"".join([u"long text "] * 10)
+        self.assertIs(dokuforge.parser.PLeaf(text).text, text)
+
     def testHeadingHtmlEscape(self):
         out = dfLineGroupParser("[bad < html chars >]").toHtml().strip()
         self.assertEqual(out, "<h1>bad &lt; html chars &gt;</h1>")
@@ -1694,6 +2490,97 @@ class DokuforgeMicrotypeUnitTests(DfTestCase):
         [ [self.verifyExportsTo(s[0],s[1]) for s in t] for t in ExporterTestCases.lineGroupTests ]
 
 
+class WrapTests(DfTestCase):
+    @staticmethod
+    def textwrapWrap(text, subsequent_indent=''):
+        """the textwrap based implementation wrap used to be"""
+        text = re.sub(r'([^\n]{160})\n', r'\1\\@\\@\\@\n', text)
+        text = re.sub(r'\n([^\n]{160})', r'\\@\\@\\@\n\1', text)
+        text = re.sub(r'\\@\\@\\@\\@\\@\\@', r'\\@\\@\\@', text)
+        return textwrap.fill(text, width=70,
+                             subsequent_indent=subsequent_indent,
+                             drop_whitespace=True, replace_whitespace=True,
+                             break_long_words=False, break_on_hyphens=False)
+
+    def verifyWrap(self, text, subsequent_indent=''):
+        self.assertEqual(wrap(text, subsequent_indent),
+                         self.textwrapWrap(text, subsequent_indent),
+                         "input was %r" % text)
+
+    def testExamples(self):
+        for text in [u"", u" ", u"\n", u"  a  ", u"a" * 100, u" " + u"a" * 100,
+                     u"a\tb \t c", u"\\@" * 7 + u"\n" + u"b" * 170,
+                     u"x" * 160 + u"\n" + u"y" * 160 + u"\n" + u"z" * 159,
+                     u"word " * 40, u" \n lead\r\nx\x0b\x0cy \xa0 z"]:
+            self.verifyWrap(text)
+            self.verifyWrap(text, u"  ")
+
+    def testRandom(self, rounds=300):
+        words = [u"a", u"bb", u"ccc", u"d" * 20, u"e" * 69, u"f" * 70,
+                 u"g" * 71, u"h" * 150, u"\\@", u"\u00e4\u00f6\u00fc",
+                 u"\u00a0", u"\u3000i"]
+        separators = [u" ", u"  ", u"\n", u"\t", u" \n ", u"\r\n", u"\n\n",
+                      u"\x0c"]
+        for _ in range(rounds):
+            text = u"".join(random.choice(words) + random.choice(separators)
+                            for _ in range(random.randint(0, 60)))
+            text = text[random.randint(0, 3):]
+            self.verifyWrap(text)
+            self.verifyWrap(text, u"  ")
+
+class ParserBudgetTests(DfTestCase):
+    def testLongGroupIsNotParsed(self):
+        budget = Budget(maxgroupchars=100)
+        text = u"[Title]\n\n_short_\n\n" + u"_long_ $x$ {y} \\z " * 20
+        parsed = dfLineGroupParser(text, budget=budget)
+        self.assertEqual(parsed.parts[-1].debug(),
+                         ('Unparsed', u"_long_ $x$ {y} \\z " * 20))
+        self.assertEqual(budget.hits, [("group too long", 360)])
+        tex = parsed.toTex()
+        self.assertIn(u"\\emph{short}", tex)
+        self.assertIn(u"\\_long\\_ \\$x\\$ \\@\\{y\\@\\}", tex)
+        self.assertIn(u"\\@\\backslash{}z", tex)
+        self.assertNotIn(u"\\emph{long}", tex)
+        self.assertIn(u"_long_", parsed.toDF())
+
+    def testTotalBudget(self):
+        budget = Budget(maxchars=50)
+        text = u"\n\n".join([u"0123456789 _%d_" % i for i in range(6)])
+        parsed = dfLineGroupParser(text, budget=budget)
+        self.assertEqual([part.debug()[0] for part in parsed.parts],
+                         ["Paragraph"] * 3 + ["Unparsed"] * 3)
+        self.assertEqual(len(budget.hits), 3)
+        self.assertEqual(budget.used, 42)
+
+    def testUnlimited(self):
+        text = u"_a_ " * 1000
+        self.assertEqual(dfLineGroupParser(text, budget=Budget(None, None)).toTex(),
+                         dfLineGroupParser(text).toTex())
+
+    def testEscapePlainTex(self):
+        self.assertEqual(escapePlainTex(u"50% & {b} ~ ^"),
+                         u"50\\% \\@\\& \\@\\{b\\@\\} \\@~ \\@\\caret{}")
+
+class ParserProfileTests(DfTestCase):
+    def testProfile(self):
+        text = u"[Title]\n(Author)\n\nSome _text_ with $x^2$, 50% and 1.\n- item"
+        expected = dfLineGroupParser(text).toTex()
+        original = dokuforge.parser.applyMicrotypefeatures
+        with ParserProfile() as profile:
+            self.assertEqual(dfLineGroupParser(text).toTex(), expected)
+        self.assertIs(dokuforge.parser.applyMicrotypefeatures, original)
+        self.assertNotIn("__wrapped__", vars(dokuforge.parser.PLeaf.toTex))
+        report = profile.report()
+        self.assertEqual(report["functions"]["grouplines"]["calls"], 1)
+        self.assertGreater(report["features"]["percent"]["calls"], 0)
+        self.assertIn("SplitSeparators('([\\\\ ])')", report["features"])
+        self.assertEqual(report["linegroups"]["Heading.startshere"]["hits"], 1)
+        self.assertEqual(report["chargroups"]["Mathgroup.startshere"]["hits"], 1)
+        self.assertEqual(report["totex"]["PHeading"]["calls"], 1)
+        for section in report.values():
+            for entry in section.values():
+                self.assertGreaterEqual(entry["time"], 0)
+
 class DokuforgeTitleParserTests(DfTestCase):
     def verifyExportsTo(self, df, tex):
         obtained = dfTitleParser(df).toTex().strip()